@@ -30,7 +30,9 @@ setup(
     packages = find_packages('src'),
 	package_dir = { '': 'src' },
     scripts = [
-		'src/wok-run'
+		'src/wok-run',
+		'src/wok-bench',
+		'src/wok-worker'
 	],
 
     # Project uses reStructuredText, so ensure that the docutils get
@@ -0,0 +1,131 @@
+###############################################################################
+#
+#    Copyright 2009-2011, Universitat Pompeu Fabra
+#
+#    This file is part of Wok.
+#
+#    Wok is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Wok is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses
+#
+###############################################################################
+
+import os
+import os.path
+
+class FlowGenerator(object):
+	"""
+	Generates synthetic flows to benchmark the engine.
+
+	Every flow has layers of width modules. The modules of the first layer are sources
+	(or read the flow input in nested flows) and every other module reads the output
+	of fanin modules of the previous layer. Up to depth flows are nested, every flow
+	includes the next one as a module reading from its first module of the last layer.
+
+	Modules don't need a real implementation, they are meant to be simulated
+	by the dummy job manager.
+	"""
+
+	def __init__(self, name = "bench", layers = 3, width = 1, fanin = 1, depth = 0):
+		if layers < 1 or width < 1:
+			raise Exception("At least one layer of one module is required")
+
+		self.name = name
+		self.layers = layers
+		self.width = width
+		self.fanin = max(1, min(fanin, width))
+		self.depth = max(0, depth)
+
+	@property
+	def num_modules(self):
+		"Number of leaf modules of the generated flows"
+
+		return self.layers * self.width * (self.depth + 1)
+
+	@property
+	def num_sources(self):
+		"Number of modules without inputs"
+
+		return self.width
+
+	def num_tasks(self, partitions):
+		"Number of tasks when every source writes partitions records and the rest of modules have a wsize of 1"
+
+		return self.num_sources + (self.num_modules - self.num_sources) * partitions
+
+	def _flow_name(self, level):
+		if level == 0:
+			return self.name
+		return "{}-{}".format(self.name, level)
+
+	@staticmethod
+	def _module_name(layer, index):
+		return "m{:03d}_{:03d}".format(layer, index)
+
+	def _flow_xml(self, level):
+		nested = level > 0
+		has_sub = level < self.depth
+		last_layer = self.layers - 1
+
+		sb = ['<flow name="{}">\n\n'.format(self._flow_name(level))]
+		sb += ['\t<title>Synthetic flow at level {}</title>\n\n'.format(level)]
+
+		if nested:
+			sb += ['\t<in name="x" />\n\n', '\t<out name="y" />\n\n']
+
+		for layer in xrange(self.layers):
+			for index in xrange(self.width):
+				sb += ['\t<module name="{}">\n'.format(self._module_name(layer, index))]
+
+				if layer == 0:
+					if nested:
+						sb += ['\t\t<in name="x" link="x" />\n']
+				else:
+					for k in xrange(self.fanin):
+						src = self._module_name(layer - 1, (index + k) % self.width)
+						sb += ['\t\t<in name="x{}" link="{}.y" />\n'.format(k, src)]
+
+				if nested and not has_sub and layer == last_layer and index == 0:
+					sb += ['\t\t<out name="y" link="y" />\n']
+				else:
+					sb += ['\t\t<out name="y" />\n']
+
+				sb += ['\t\t<run>noop.py</run>\n', '\t</module>\n\n']
+
+		if has_sub:
+			sb += ['\t<module name="sub">\n',
+					'\t\t<in name="x" link="{}.y" />\n'.format(self._module_name(last_layer, 0))]
+			if nested:
+				sb += ['\t\t<out name="y" link="y" />\n']
+			else:
+				sb += ['\t\t<out name="y" />\n']
+			sb += ['\t\t<flow>{}</flow>\n'.format(self._flow_name(level + 1)), '\t</module>\n\n']
+
+		sb += ['</flow>\n']
+
+		return "".join(sb)
+
+	def generate(self, path):
+		"Writes the flow files into path and returns the path of the root flow"
+
+		if not os.path.exists(path):
+			os.makedirs(path)
+
+		for level in xrange(self.depth + 1):
+			flow_path = os.path.join(path, "{}.flow".format(self._flow_name(level)))
+			f = open(flow_path, "w")
+			try:
+				f.write(self._flow_xml(level))
+			finally:
+				f.close()
+
+		return os.path.join(path, "{}.flow".format(self.name))
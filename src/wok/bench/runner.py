@@ -0,0 +1,172 @@
+###############################################################################
+#
+#    Copyright 2009-2011, Universitat Pompeu Fabra
+#
+#    This file is part of Wok.
+#
+#    Wok is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Wok is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses
+#
+###############################################################################
+
+import os
+import os.path
+import sys
+import time
+import shutil
+import tempfile
+import resource
+
+from wok.config import ConfigBuilder
+from wok.core import runstates
+from wok.core.engine import WokEngine
+from wok.core.metrics import get_metrics
+
+def _timer_summary(timer):
+	count = timer["count"]
+	return dict(
+		count = count,
+		mean = timer["sum"] / count if count > 0 else 0.0,
+		max = timer["max"])
+
+def _peak_rss():
+	"Returns the peak resident set size of the process in bytes"
+
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == "darwin":
+		return rss
+	return rss * 1024
+
+class SchedulerBenchmark(object):
+	"""
+	Runs a synthetic flow through the engine with the dummy job manager
+	and measures the cost of the controller.
+
+	The source modules write partitions records and the rest of modules have a
+	wsize of 1, so every module has partitions tasks. Results are returned as a
+	dictionary ready to be serialized into JSON. As the engine metrics are global
+	to the process only one benchmark should be run per process.
+
+	* Configuration parameters (under wok.bench):
+	- delay: Seconds every simulated task takes. By default 0.
+	- max_cores: Number of tasks the dummy job manager runs at the same time.
+	- poll_interval: Seconds between checks of the instance state. By default 0.05.
+	- keep: Whether to keep the working path after the benchmark. By default false.
+	"""
+
+	def __init__(self, generator, partitions = 100, conf_builder = None):
+		self.generator = generator
+		self.partitions = partitions
+
+		self._conf_builder = conf_builder if conf_builder is not None else ConfigBuilder()
+
+		conf = self._conf_builder()
+		self._delay = conf.get("wok.bench.delay", 0, dtype=float)
+		self._max_cores = conf.get("wok.bench.max_cores", dtype=int)
+		self._poll_interval = conf.get("wok.bench.poll_interval", 0.05, dtype=float)
+		self._keep = conf.get("wok.bench.keep", False, dtype=bool)
+		self._work_path = conf.get("wok.work_path")
+
+	def _create_conf_builder(self, work_path, flow_path):
+		cb = ConfigBuilder()
+		cb.add_value("wok.log.level", "warn")
+		cb.add_value("wok.work_path", work_path)
+		cb.add_value("wok.flow_path", [os.path.dirname(flow_path)])
+		cb.add_value("wok.job_manager", "dummy")
+		cb.add_value("wok.job_managers.dummy.delay", self._delay)
+		cb.add_value("wok.job_managers.dummy.records", self.partitions)
+		if self._max_cores is not None:
+			cb.add_value("wok.job_managers.dummy.max_cores", self._max_cores)
+		cb.add_builder(self._conf_builder)
+		return cb
+
+	def run(self):
+		work_path = self._work_path
+		if work_path is None:
+			work_path = tempfile.mkdtemp(prefix = "wok-bench-")
+
+		try:
+			return self._run(work_path)
+		finally:
+			if not self._keep:
+				shutil.rmtree(work_path, ignore_errors = True)
+
+	def _run(self, work_path):
+		gen = self.generator
+
+		flow_file = gen.generate(os.path.join(work_path, "flows"))
+
+		cb = self._create_conf_builder(work_path, flow_file)
+		conf = cb()
+
+		start_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+		start_time = time.time()
+		engine = WokEngine(conf)
+		engine_init_time = time.time() - start_time
+
+		try:
+			start_time = time.time()
+			engine.create_instance(gen.name, cb, flow_file)
+			instance_init_time = time.time() - start_time
+
+			inst = engine.instance(gen.name)
+
+			start_time = time.time()
+			engine.start(wait = False)
+
+			state = inst.state
+			while state not in [runstates.FINISHED, runstates.FAILED]:
+				time.sleep(self._poll_interval)
+				state = inst.state
+
+			run_time = time.time() - start_time
+		finally:
+			engine.stop()
+
+		end_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+		metrics = get_metrics().to_native()
+
+		num_tasks = metrics.get("wok_engine_tasks_submitted_total", 0)
+		cpu_user = end_usage.ru_utime - start_usage.ru_utime
+		cpu_system = end_usage.ru_stime - start_usage.ru_stime
+
+		return dict(
+			params = dict(
+				layers = gen.layers,
+				width = gen.width,
+				fanin = gen.fanin,
+				depth = gen.depth,
+				partitions = self.partitions,
+				modules = gen.num_modules,
+				tasks = gen.num_tasks(self.partitions),
+				delay = self._delay,
+				max_cores = engine.job_manager.slots),
+			state = str(state),
+			tasks = num_tasks,
+			engine_init_time = engine_init_time,
+			instance_init_time = instance_init_time,
+			run_time = run_time,
+			virtual_time = engine.job_manager.clock,
+			throughput = num_tasks / run_time if run_time > 0 else 0.0,
+			cpu = dict(
+				user = cpu_user,
+				system = cpu_system,
+				per_task = (cpu_user + cpu_system) / num_tasks if num_tasks > 0 else 0.0),
+			peak_rss = _peak_rss(),
+			latency = dict(
+				ready_to_submit = _timer_summary(metrics["wok_task_ready_to_submit_seconds"]),
+				finish_to_join = _timer_summary(metrics["wok_task_finish_to_join_seconds"]),
+				engine_loop = _timer_summary(metrics["wok_engine_loop_seconds"])),
+			metrics = metrics)
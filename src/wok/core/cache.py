@@ -0,0 +1,233 @@
+###############################################################################
+#
+#    Copyright 2009-2011, Universitat Pompeu Fabra
+#
+#    This file is part of Wok.
+#
+#    Wok is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Wok is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses
+#
+###############################################################################
+
+import os
+import os.path
+import shutil
+import sqlite3
+import hashlib
+import json
+import time
+
+from wok import logger
+from wok.core.utils.sync import Synchronizable, synchronized
+from wok.core.portio.pathdata import PathData
+from wok.core.cmd.native import NativeCmdBuilder
+
+# configuration keys that change between instances of the same flow
+_VOLATILE_CONF_KEYS = ["__cwd", "wok.__instance"]
+
+class TaskCache(Synchronizable):
+	"""
+	Content addressed cache of task results.
+
+	A task is identified by a fingerprint of its expanded configuration, the content
+	of the script it runs and the content of its input slices. The output partitions
+	of the tasks that finished successfully are saved in the cache and copied (or linked)
+	into the output partitions of later tasks with the same fingerprint.
+
+	Entries are evicted in least recently used order once the cache exceeds max_size bytes.
+
+	* Configuration parameters:
+	- path: Cache path. By default <wok.work_path>/cache
+	- max_size: Maximum size of the cache in bytes
+	- link: Whether to use hard links instead of copies when restoring outputs.
+	  Only safe when tasks never rewrite the partitions restored from the cache.
+	"""
+
+	def __init__(self, conf, work_path):
+		Synchronizable.__init__(self)
+
+		self._log = logger.get_logger(conf.get("log"), "wok-cache")
+
+		self._path = conf.get("path", os.path.join(work_path, "cache"))
+		if not os.path.exists(self._path):
+			os.makedirs(self._path)
+
+		self._max_size = conf.get("max_size", 10 * 1024 * 1024 * 1024, dtype=long)
+		self._link = conf.get("link", False, dtype=bool)
+
+		self.hits = 0
+		self.misses = 0
+
+		index_file = os.path.join(self._path, "index.db")
+		create = not os.path.exists(index_file)
+		self._conn = sqlite3.connect(index_file, check_same_thread = False)
+		if create:
+			self._conn.execute("""
+			CREATE TABLE entries (
+				fingerprint	TEXT PRIMARY KEY,
+				size		INTEGER,
+				last_access	REAL,
+				hits		INTEGER
+			)""")
+			self._conn.commit()
+
+		self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+	def _entry_path(self, fingerprint):
+		return os.path.join(self._path, fingerprint[0:2], fingerprint)
+
+	@staticmethod
+	def _task_script(task):
+		execution = task.parent.execution
+		if execution is None or execution.conf is None:
+			return None
+
+		script_path = execution.conf.get("script_path")
+		if script_path is None:
+			return None
+
+		return NativeCmdBuilder._task_absolute_path(task, script_path)
+
+	def fingerprint(self, task):
+		"""Returns the fingerprint of a task or None if the task can not be cached.
+		Only tasks running a script and writing into PathData partitions can be cached."""
+
+		for data in task.out_port_data:
+			if not isinstance(data, PathData):
+				return None
+
+		script_path = self._task_script(task)
+		if script_path is None or not os.path.isfile(script_path):
+			return None
+
+		h = hashlib.sha1()
+
+		conf = task.expanded_conf.to_native()
+		for key in _VOLATILE_CONF_KEYS:
+			path = key.split(".")
+			parent = conf
+			for k in path[:-1]:
+				parent = parent.get(k) if isinstance(parent, dict) else None
+			if isinstance(parent, dict) and path[-1] in parent:
+				del parent[path[-1]]
+		h.update(json.dumps(conf, sort_keys = True, default = str))
+
+		f = open(script_path, "rb")
+		try:
+			h.update(f.read())
+		finally:
+			f.close()
+
+		try:
+			for data in task.in_port_data:
+				data.update_hash(h)
+		except Exception:
+			self._log.debug("Unable to read the inputs of task {}, it won't be cached".format(task.id))
+			return None
+
+		return h.hexdigest()
+
+	def _transfer(self, src, dst, link = False):
+		if os.path.exists(dst):
+			os.remove(dst)
+		if link:
+			try:
+				os.link(src, dst)
+				return
+			except OSError:
+				pass
+		shutil.copyfile(src, dst)
+
+	@synchronized
+	def restore(self, task, fingerprint):
+		"""Restores the outputs of a task from the cache.
+		Returns whether there was a cache hit."""
+
+		entry_path = self._entry_path(fingerprint)
+
+		row = self._conn.execute("SELECT hits FROM entries WHERE fingerprint = ?", (fingerprint,)).fetchone()
+		if row is None or not os.path.isdir(entry_path):
+			self.misses += 1
+			return False
+
+		for i, data in enumerate(task.out_port_data):
+			index_path, data_path = data.partition_files()
+			dst_path = os.path.dirname(index_path)
+			if not os.path.exists(dst_path):
+				os.makedirs(dst_path)
+			self._transfer(os.path.join(entry_path, "%03d.index" % i), index_path, self._link)
+			self._transfer(os.path.join(entry_path, "%03d.data" % i), data_path, self._link)
+
+		self._conn.execute("UPDATE entries SET last_access = ?, hits = ? WHERE fingerprint = ?",
+							(time.time(), row[0] + 1, fingerprint))
+		self._conn.commit()
+
+		self.hits += 1
+		return True
+
+	@synchronized
+	def store(self, task, fingerprint):
+		"Saves the outputs of a task that finished successfully"
+
+		entry_path = self._entry_path(fingerprint)
+		if os.path.isdir(entry_path):
+			shutil.rmtree(entry_path)
+		os.makedirs(entry_path)
+
+		size = 0
+		for i, data in enumerate(task.out_port_data):
+			index_path, data_path = data.partition_files()
+			for src, ext in [(index_path, "index"), (data_path, "data")]:
+				dst = os.path.join(entry_path, "%03d.%s" % (i, ext))
+				if os.path.exists(src):
+					shutil.copyfile(src, dst)
+				else:
+					open(dst, "w").close()
+				size += os.path.getsize(dst)
+
+		row = self._conn.execute("SELECT size FROM entries WHERE fingerprint = ?", (fingerprint,)).fetchone()
+		if row is not None:
+			self._size -= row[0]
+
+		self._conn.execute("INSERT OR REPLACE INTO entries (fingerprint, size, last_access, hits) VALUES (?, ?, ?, 0)",
+							(fingerprint, size, time.time()))
+		self._size += size
+
+		self._evict()
+
+		self._conn.commit()
+
+	def _evict(self):
+		if self._size <= self._max_size:
+			return
+
+		cur = self._conn.execute("SELECT fingerprint, size FROM entries ORDER BY last_access")
+		evicted = []
+		for fingerprint, size in cur.fetchall():
+			if self._size <= self._max_size:
+				break
+			shutil.rmtree(self._entry_path(fingerprint), ignore_errors = True)
+			evicted += [(fingerprint,)]
+			self._size -= size
+
+		self._conn.executemany("DELETE FROM entries WHERE fingerprint = ?", evicted)
+
+		self._log.debug("Evicted {} cache entries".format(len(evicted)))
+
+	@synchronized
+	def stats(self):
+		return dict(hits = self.hits, misses = self.misses, size = self._size, max_size = self._max_size)
+
+	@synchronized
+	def close(self):
+		self._conn.close()
@@ -0,0 +1,95 @@
+###############################################################################
+#
+#    Copyright 2009-2011, Universitat Pompeu Fabra
+#
+#    This file is part of Wok.
+#
+#    Wok is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Wok is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses
+#
+###############################################################################
+
+class ModuleCosts(object):
+	"""
+	Execution costs of the modules measured from their finished tasks.
+
+	For every module id it keeps the cost per input record and the total work
+	(sum of the tasks elapsed time) and number of tasks of its last runs. Values
+	are kept as an exponential moving average, so they follow the recent runs
+	of the same module. When the engine journal is enabled they are persisted
+	and shared between engine runs.
+	"""
+
+	def __init__(self, db = None, alpha = 0.3):
+		self._db = db
+		self._alpha = alpha
+
+		# {module_id : [record_cost, samples, work, tasks]}
+		self._costs = {}
+
+	def _entry(self, module_id):
+		if module_id not in self._costs:
+			entry = None
+			if self._db is not None:
+				entry = self._db.module_cost(module_id)
+			if entry is None:
+				entry = (None, 0, None, None)
+			self._costs[module_id] = list(entry)
+
+		return self._costs[module_id]
+
+	def _average(self, prev, value):
+		if prev is None:
+			return value
+		return prev + self._alpha * (value - prev)
+
+	def _persist(self, module_id):
+		if self._db is not None:
+			self._db.module_cost_persist(module_id, *self._costs[module_id])
+
+	def get(self, module_id):
+		"Returns the cost in seconds per record of a module or None if it has never been measured"
+
+		return self._entry(module_id)[0]
+
+	def update(self, module_id, records, elapsed):
+		"Updates the cost of a module with the number of records processed by a task and its elapsed time"
+
+		if records <= 0 or elapsed < 0:
+			return
+
+		entry = self._entry(module_id)
+		entry[0] = self._average(entry[0], elapsed / float(records))
+		entry[1] += 1
+
+		self._persist(module_id)
+
+	def work(self, module_id):
+		"Returns the tuple (work, tasks) of the runs of a module or None if it has never finished"
+
+		entry = self._entry(module_id)
+		if entry[2] is None:
+			return None
+		return (entry[2], entry[3])
+
+	def update_work(self, module_id, work, tasks):
+		"Updates the work of a module with the sum of the elapsed time of its tasks in a run"
+
+		if work < 0 or tasks <= 0:
+			return
+
+		entry = self._entry(module_id)
+		entry[2] = self._average(entry[2], work)
+		entry[3] = self._average(entry[3], float(tasks))
+
+		self._persist(module_id)
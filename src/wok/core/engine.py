@@ -22,25 +22,58 @@
 import os
 import os.path
 import re
+import time
 
 from Queue import Queue, Empty
-from threading import Thread, Condition
+from threading import Thread, Lock, Condition
 from multiprocessing import cpu_count
 
 from wok import logger
 from wok.element import DataList
 from wok.config import ConfigBuilder
 from wok.core import runstates
-#from wok.core.enginedb import SqliteEngineDB
+from wok.core.enginedb import SqliteEngineDB
+from wok.core.cache import TaskCache
+from wok.core.costs import ModuleCosts
+from wok.core.plan import PlanCache
+from wok.core.scheduler import FairShareScheduler
+from wok.core.metrics import get_metrics
 from wok.core.utils.sync import Synchronizable, synchronized
 from wok.core.utils.logs import parse_log
 from wok.core.flow.loader import FlowLoader
 from wok.core.instance import Instance, InstanceController
+from wok.core.jobmgr.base import JobResult
 from wok.core.jobmgr.factory import create_job_manager
 from wok.core.storage.base import StorageContext
 from wok.core.storage.factory import create_storage
 
 
+_metrics = get_metrics()
+_LOOP_TIME = _metrics.timer("wok_engine_loop_seconds", "Time of an engine scheduling round without waiting for events")
+_EVENTS = _metrics.counter("wok_engine_events_total", "Job state changes applied by the engine")
+_TASKS_SUBMITTED = _metrics.counter("wok_engine_tasks_submitted_total", "Tasks submitted to the job manager")
+_READY_TO_SUBMIT_TIME = _metrics.timer("wok_task_ready_to_submit_seconds", "Time from a task being ready to its submission")
+_FINISH_TO_JOIN_TIME = _metrics.timer("wok_task_finish_to_join_seconds", "Time from a job finishing to being joined")
+_QUEUED_TASKS = _metrics.gauge("wok_engine_queued_tasks", "Ready tasks held by the fair share scheduler")
+_ACTIVE_JOBS = _metrics.gauge("wok_engine_active_jobs", "Jobs submitted and not joined yet")
+_COMPLETE_QUEUE = _metrics.gauge("wok_engine_complete_queue", "Finished jobs waiting for completion")
+_READ_LOGS_TIME = _metrics.timer("wok_engine_read_logs_seconds", "Time spent reading the logs of a finished job")
+_JOIN_TIME = _metrics.timer("wok_engine_join_seconds", "Time spent joining a batch of jobs")
+_APPLY_RESULTS_TIME = _metrics.timer("wok_engine_apply_results_seconds", "Time spent updating the tasks of a joined batch")
+
+class _LogTail(object):
+	"Position of the output of a running job already ingested into the logs storage"
+
+	def __init__(self, task):
+		self.task = task
+		self.offset = 0
+		self.closed = False
+		self.lock = Lock()
+
+		# attempt which output is read when the job manager runs several, and the lines ingested
+		self.attempt = None
+		self.lines = 0
+
 class WokEngine(Synchronizable):
 	"""
 	The Wok engine manages the execution of workflow instances.
@@ -81,25 +114,114 @@ class WokEngine(Synchronizable):
 
 		self._job_task_map = {}
 
-		self._logs_threads = []
-		self._logs_queue = Queue()
+		# job state change events notified by the job manager
+		self._events = []
+
+		# finished jobs waiting for their logs to be read and to be joined
+		self._complete_threads = []
+		self._complete_queue = Queue()
+		self._complete_batch_size = wok_conf.get("completion.batch_size", 100, dtype=int)
+
+		# logs of the running jobs by job id
+		self._tail_thread = None
+		self._tails = {}
+		self._tails_lock = Lock()
+		self._tail_cvar = Condition(self._tails_lock)
+		self._tail_interval = wok_conf.get("logs.tail_interval", 5, dtype=float)
 
-		self._join_thread = None
-		self._join_queue = Queue()
+		# ready tasks waiting for their fingerprint before consulting the cache
+		self._fingerprint_thread = None
+		self._fingerprint_queue = Queue()
 
 		self._notified = False
 
+		# whether the run thread is waiting for events, simulated job managers
+		# wait for it before advancing their clock
+		self._idle = False
+		self._idle_cvar = Condition(self._lock)
+
 		self._job_mgr = self._create_job_manager(wok_conf)
 		
 		self._storage = self._create_storage(wok_conf)
 
-		#TODO self._db = SqliteEngineDB(self)
+		self._db = self._create_db(wok_conf)
+
+		self._cache = self._create_cache(wok_conf)
+
+		self._module_costs = ModuleCosts(self._db)
+
+		self._plans = self._create_plans(wok_conf)
+
+		self._scheduler = self._create_scheduler(wok_conf)
+
+		self._restore_state(wok_conf)
+
+	def _create_db(self, wok_conf):
+		db_conf = wok_conf.get("db")
+		if db_conf is None:
+			db_conf = wok_conf.create_element()
+
+		if not db_conf.get("enabled", True, dtype=bool):
+			return None
+
+		return SqliteEngineDB(self, db_conf)
+
+	def _create_scheduler(self, wok_conf):
+		# unless configured the window follows the slots of the job manager, which may change
+		self._share_window = wok_conf.get("share.window", dtype=int)
+		self._share_default_window = wok_conf.get("share.default_window", 1000, dtype=int)
+
+		return FairShareScheduler(self._share_window_size())
+
+	def _share_window_size(self):
+		if self._share_window is not None:
+			return self._share_window
+
+		slots = self._job_mgr.slots
+		if slots is None or slots <= 0:
+			return self._share_default_window
+
+		return 2 * slots
 
-		self._restore_state()
+	def _create_plans(self, wok_conf):
+		plans_conf = wok_conf.get("plans")
+		if plans_conf is None:
+			plans_conf = wok_conf.create_element()
 
-	def _restore_state(self):
-		#TODO restore db state
-		pass
+		if not plans_conf.get("enabled", True, dtype=bool):
+			return None
+
+		return PlanCache(plans_conf, self._work_path, self._flow_path)
+
+	def _create_cache(self, wok_conf):
+		cache_conf = wok_conf.get("cache")
+		if cache_conf is None or not cache_conf.get("enabled", False, dtype=bool):
+			return None
+
+		return TaskCache(cache_conf, self._work_path)
+
+	def _restore_state(self, wok_conf):
+		"Rebuilds the instances journaled by a previous run of the engine"
+
+		if self._db is None or not wok_conf.get("db.restore", True, dtype=bool):
+			return
+
+		for inst_name, flow_file, inst_conf in self._db.instances():
+			self._log.info("Restoring instance {} from {} ...".format(inst_name, flow_file))
+
+			cb = ConfigBuilder()
+			cb.add_element(inst_conf)
+
+			inst = Instance(self, inst_name, cb, flow_file)
+			try:
+				inst.initialize()
+				inst._load_state()
+			except:
+				self._log.exception("Error while restoring instance {}".format(inst_name))
+				continue
+
+			self._instances += [inst]
+			self._instances_map[inst_name] = inst
 	
 	def _create_job_manager(self, wok_conf):
 		jobmgr_name = wok_conf.get("job_manager", "mcore", dtype=str)
@@ -147,14 +269,27 @@ class WokEngine(Synchronizable):
 	@property
 	def storage(self):
 		return self._storage
+
+	@property
+	def db(self):
+		return self._db
+
+	@property
+	def module_costs(self):
+		return self._module_costs
 	
 	@property
 	def flow_loader(self):
 		return self._flow_loader
 
-	@synchronized
+	@property
+	def plans(self):
+		return self._plans
+
 	def create_instance(self, inst_name, conf_builder, flow_file):
-		"Creates a new workflow instance"
+		"""Creates a new workflow instance.
+		The instance is initialized without holding the engine lock,
+		so several instances can be created at the same time."""
 
 		#TODO check in the db
 		if inst_name in self._instances_map:
@@ -170,13 +305,22 @@ class WokEngine(Synchronizable):
 		# Create instance
 		inst = Instance(self, inst_name, cb, flow_file)
 		try:
-			# Initialize instance and register by name
 			inst.initialize()
-			self._instances += [inst]
-			self._instances_map[inst_name] = inst
-			self._cvar.notify()
 
-			#TODO self._db.instance_persist(inst)
+			# Register by name
+			self._lock.acquire()
+			try:
+				if inst_name in self._instances_map:
+					raise Exception("Instance with this name already exists: {}".format(inst_name))
+
+				inst._calculate_critical_path()
+				inst._save_initial_state()
+				self._instances += [inst]
+				self._instances_map[inst_name] = inst
+				self._notified = True
+				self._cvar.notify()
+			finally:
+				self._lock.release()
 		except:
 			self._log.error("Error while creating instance {} for the workflow {} with configuration {}".format(inst_name, flow_file, cb()))
 			raise
@@ -185,24 +329,13 @@ class WokEngine(Synchronizable):
 
 		return inst
 
-	def __queue_adaptative_get(self, queue, start_timeout = 1, max_timeout = 4):
-		timeout = start_timeout
-		msg = None
-		while self._running and msg is None:
-			try:
-				msg = queue.get(timeout=timeout)
-			except Empty:
-				if timeout < max_timeout:
-					timeout += 1
-		return msg
-
-	def __queue_batch_get(self, queue, start_timeout = 1, max_timeout = 4):
+	def __queue_batch_get(self, queue, start_timeout = 1, max_timeout = 4, max_size = 0):
 		timeout = start_timeout
 		msg_batch = []
 		while self._running and len(msg_batch) == 0:
 			try:
 				msg_batch += [queue.get(timeout=timeout)]
-				while not queue.empty():
+				while not queue.empty() and (max_size <= 0 or len(msg_batch) < max_size):
 					msg_batch += [queue.get(timeout=timeout)]
 			except Empty:
 				if timeout < max_timeout:
@@ -220,64 +353,118 @@ class WokEngine(Synchronizable):
 		try:
 			job_mgr.start()
 
-			# Start the logs threads
+			# Start the completion threads
 
 			for i in range(cpu_count()):
-			#for i in range(1):
-				t = Thread(target = self._logs, name = "wok-engine-logs-%d" % i)
-				self._logs_threads += [t]
+				t = Thread(target = self._complete, name = "wok-engine-complete-%d" % i)
+				self._complete_threads += [t]
 				t.start()
 
-			# Start the join thread
+			# Start the thread reading the logs of the running jobs
 
-			self._join_thread = Thread(
-									target = self._join,
-									name = "wok-engine-join")
-			self._join_thread.start()
+			if self._tail_interval > 0:
+				self._tail_thread = Thread(target = self._tail, name = "wok-engine-tail")
+				self._tail_thread.start()
+
+			# Start the thread looking for the ready tasks in the cache
+
+			if self._cache is not None:
+				self._fingerprint_thread = Thread(target = self._fingerprint, name = "wok-engine-fingerprint")
+				self._fingerprint_thread.start()
 
 			self._log.info("Engine run thread ready")
 
+			loop_start = time.time()
+
 			while self._running:
 
 				#self._log.debug("Scheduling new tasks ...")
 
-				# submit tasks ready to be executed
+				# queue tasks ready to be executed
 				for inst in self._instances:
 					tasks = inst.schedule_tasks()
-					if len(tasks) > 0:
-						#self._log.debug("ready_tasks:\n" + "\n".join(["\t" + t.id for t in tasks]))
-						job_ids = job_mgr.submit(tasks)
-						for i, task in enumerate(tasks):
-							self._job_task_map[job_ids[i]] = task
-							task.job_id = job_ids[i]
+					if len(tasks) == 0:
+						continue
+					if self._cache is not None:
+						# they are pushed by the fingerprint thread unless restored from the cache
+						self._fingerprint_queue.put((inst, tasks))
+					else:
+						self._scheduler.push(inst, tasks)
+
+				# the ranks of the modules change as they finish
+				for inst in self._instances:
+					if inst.ranks_changed:
+						self._scheduler.update_ranks(inst)
+						inst.ranks_changed = False
+
+				# submit the share of every instance
+				self._scheduler.window = self._share_window_size()
+				tasks = self._scheduler.release()
+				if len(tasks) > 0:
+					#self._log.debug("ready_tasks:\n" + "\n".join(["\t" + t.id for t in tasks]))
+					job_ids = job_mgr.submit(tasks)
+					now = time.time()
+					for i, task in enumerate(tasks):
+						self._job_task_map[job_ids[i]] = task
+						task.job_id = job_ids[i]
+						_READY_TO_SUBMIT_TIME.observe(now - task.ready_time)
+					_TASKS_SUBMITTED.inc(len(tasks))
+
+				# publish the state of the instances for the monitoring reads
+				for inst in self._instances:
+					inst.publish_snapshot()
 				
+				_QUEUED_TASKS.set(self._scheduler.num_queued)
+				_ACTIVE_JOBS.set(len(self._job_task_map))
+				_COMPLETE_QUEUE.set(self._complete_queue.qsize())
+				_LOOP_TIME.observe(time.time() - loop_start)
+
 				#self._log.debug("Waiting for events ...")
 
-				while not self._notified and self._running:
-					self._cvar.wait(1)
+				self._idle = True
+				self._idle_cvar.notify_all()
+				while not self._notified and len(self._events) == 0 and self._running:
+					self._cvar.wait()
+				self._idle = False
 				self._notified = False
 
 				if not self._running:
 					break
 
-				job_states = job_mgr.state()
-				
-				#self._log.debug("Job states:\n" + "\n".join("\t{}: {}".format(jid, jst) for jid, jst in job_states))
+				loop_start = time.time()
+
+				events = self._events
+				self._events = []
+
+				_EVENTS.inc(len(events))
+
+				#self._log.debug("Job events:\n" + "\n".join("\t{}".format(ev) for ev in events))
 
 				updated_modules = set()
 
-				# detect tasks which state has changed
-				for job_id, state in job_states:
-					task = self._job_task_map[job_id]
+				# apply the state changes notified by the job manager
+				for event in events:
+					job_id = event.job_id
+					task = self._job_task_map.get(job_id)
+					if task is None:
+						self._log.warn("State change notified for an unknown job: {}".format(event))
+						continue
+
+					state = event.state
 					if task.state != state:
-						task.state = state
+						task.instance.change_task_state(task, state)
 						updated_modules.add(task.parent)
 						self._log.debug("Task %s changed state to %s" % (task.id, state))
 
-						# if task has finished, queue it for logs retrieval
-						# otherwise queue it directly for joining
+						if state == runstates.RUNNING and self._tail_interval > 0:
+							with self._tails_lock:
+								self._tails[job_id] = _LogTail(task)
+
+						# if task has finished, queue it for logs retrieval and joining
 						if state in [runstates.FINISHED, runstates.FAILED]:
-							self._logs_queue.put((task, job_id))
+							task.finish_time = time.time()
+							self._scheduler.task_done(task)
+							self._complete_queue.put((task, job_id))
 
 				#self._log.debug("Updating modules state ...\n" + "\n".join("\t{}".format(m.id) for m in sorted(updated_modules)))
 				#self._log.debug("Updating modules state ...")
@@ -290,6 +477,9 @@ class WokEngine(Synchronizable):
 					self._log.debug("Module %s updated state to %s ..." % (m.id, m.state))
 					updated_instances.add(inst)
 
+				if self._db is not None:
+					self._db.flush()
+
 				#for inst in updated_instances:
 				#	self._log.debug(repr(inst))
 
@@ -297,117 +487,297 @@ class WokEngine(Synchronizable):
 			num_exc += 1
 			self._log.exception("Exception in wok-engine run thread (%d)" % num_exc)
 		finally:
+			self._running = False
 			self._lock.release()
-			job_mgr.close()
-			self._lock.acquire()
+			try:
+				job_mgr.close()
+				self._join_threads()
+			finally:
+				self._lock.acquire()
 
 		try:
 			# print instances state before leaving the thread
 			for inst in self._instances:
 				self._log.debug("Instances state:\n" + repr(inst))
 
-			for t in self._logs_threads:
-				t.join()
-
-			self._join_thread.join()
-
 			self._log.info("Engine run thread finished")
 		except:
 			pass
 
-		#TODO self._db.close()
-		
+		if self._cache is not None:
+			self._log.info("Task cache: {}".format(self._cache.stats()))
+			self._cache.close()
+
+		if self._db is not None:
+			self._db.close()
+
 		self._running = False
 
-	def _logs(self):
-		"Log retrieval thread"
+	def _join_threads(self):
+		"Waits for the helper threads to finish. They take the engine lock, so it must not be held."
+
+		with self._tails_lock:
+			self._tail_cvar.notify_all()
 
-		#_log = logger.get_logger(self.conf.get("wok.log"), "wok-engine")
+		for t in self._complete_threads:
+			t.join()
 
-		self._log.info("Engine logs thread ready")
+		if self._tail_thread is not None:
+			self._tail_thread.join()
+
+		if self._fingerprint_thread is not None:
+			self._fingerprint_thread.join()
+
+	def _fingerprint(self):
+		"""Fingerprint thread. It calculates the fingerprints of the ready tasks, which requires
+		reading their scripts and inputs, and restores the results of the ones found in the cache
+		without holding the engine lock. Then it finishes the restored tasks and pushes the rest
+		into the scheduler with a single acquisition of the engine lock."""
+
+		self._log.info("Engine fingerprint thread ready")
 
 		num_exc = 0
 
 		while self._running:
-			# get the next task to retrieve the logs
-			job_info = self.__queue_adaptative_get(self._logs_queue)
-			if job_info is None:
+			batch = self.__queue_batch_get(self._fingerprint_queue)
+			if len(batch) == 0:
 				continue
 
-			task, job_id = job_info
+			lookups = []
+			for inst, tasks in batch:
+				restored_tasks = []
+				pending_tasks = []
+				for task in tasks:
+					try:
+						task.fingerprint = self._cache.fingerprint(task)
+						if task.fingerprint is not None and self._cache.restore(task, task.fingerprint):
+							restored_tasks += [task]
+							continue
+					except:
+						num_exc += 1
+						self._log.exception("Exception in wok-engine fingerprint thread (%d)" % num_exc)
+						task.fingerprint = None
+					pending_tasks += [task]
+				lookups += [(inst, restored_tasks, pending_tasks)]
 
+			self._lock.acquire()
 			try:
-				task.state_msg = "Reading logs"
-				output = self._job_mgr.output(job_id)
+				for inst, restored_tasks, pending_tasks in lookups:
+					if len(restored_tasks) > 0:
+						self._finish_cached_tasks(inst, restored_tasks)
+					if len(pending_tasks) > 0:
+						self._scheduler.push(inst, pending_tasks)
+
+				self._notified = True
+				self._cvar.notify()
+			except:
+				num_exc += 1
+				self._log.exception("Exception in wok-engine fingerprint thread (%d)" % num_exc)
+			finally:
+				self._lock.release()
 
-				self._log.debug("Reading logs for task %s ..." % task.id)
+		self._log.info("Engine fingerprint thread finished")
 
-				task_index = task.index
-				module = task.parent
-				module_id = module.id
-				instance_name = module.instance.name
-				logs_storage = self._storage.logs
+	def _finish_cached_tasks(self, inst, tasks):
+		"Finishes the tasks which results have been restored from the cache. It has to be called with the engine lock held."
 
-				logs = []
-#				last_timestamp = None
-				line = output.readline()
-				while len(line) > 0:
-					timestamp, level, name, text = parse_log(line)
-#					if timestamp is None:
-#						timestamp = last_timestamp
-#					last_timestamp = timestamp
+		updated_modules = set()
+		for task in tasks:
+			result = JobResult()
+			result.state = runstates.FINISHED
+			result.exit_message = "Task results restored from the cache"
+			task.job_result = result
+
+			inst.change_task_state(task, runstates.FINISHED)
+			if self._db is not None:
+				self._db.task_result(task)
+
+			updated_modules.add(task.parent)
+			self._log.debug("Task %s restored from the cache" % task.id)
+
+		for m in updated_modules:
+			inst.update_module_state_from_children(m)
+
+	def _complete(self):
+		"""Completion thread. It takes batches of finished jobs, reads their logs,
+		joins them with a single call to the job manager and updates the tasks
+		with a single acquisition of the engine lock."""
 
-					logs += [(timestamp, level, name, text)]
+		self._log.info("Engine completion thread ready")
 
-					line = output.readline()
+		num_exc = 0
 
-					if len(line) == 0 or len(logs) >= 1000:
-						logs_storage.append(instance_name, module_id, task_index, logs)
-						
-						#self._log.debug("Task %s partial logs:\n%s" % (task.id, "\n".join("\t".join(log) for log in logs)))
+		while self._running:
+			batch = self.__queue_batch_get(self._complete_queue, max_size = self._complete_batch_size)
+			if len(batch) == 0:
+				continue
+
+			for task, job_id in batch:
+				try:
+					with _READ_LOGS_TIME.time():
+						self._read_logs(task, job_id)
+				except:
+					num_exc += 1
+					self._log.exception("Exception in wok-engine completion thread (%d)" % num_exc)
+
+			try:
+				with _JOIN_TIME.time():
+					results = self._job_mgr.join_all([job_id for task, job_id in batch])
+
+				# the run thread may be waiting for it to finish
+				if not self._running:
+					break
 
-						logs = []
+				self._lock.acquire()
+				try:
+					with _APPLY_RESULTS_TIME.time():
+						self._apply_results(batch, results)
+				finally:
+					self._lock.release()
 			except:
 				num_exc += 1
-				self._log.exception("Exception in wok-engine logs thread (%d)" % num_exc)
-
-			finally:
-				self._join_queue.put(job_info)
+				self._log.exception("Exception in wok-engine completion thread (%d)" % num_exc)
 
 		#self._db.clean()
 
-		self._log.info("Engine logs thread finished")
+		self._log.info("Engine completion thread finished")
 
-	def _join(self):
-		"Joiner thread"
+	def _read_logs(self, task, job_id):
+		task.state_msg = "Reading logs"
 
-		self._log.info("Engine join thread ready")
+		with self._tails_lock:
+			tail = self._tails.pop(job_id, None)
 
-		num_exc = 0
+		# catch up from the last position read while the job was running
+		offset = 0
+		if tail is not None:
+			with tail.lock:
+				tail.closed = True
+				offset = tail.offset
 
-		while self._running:
-			try:
-				job_info = self.__queue_adaptative_get(self._join_queue)
-				if job_info is None:
-					continue
+				# the result of another attempt was taken, its output replaces the partial one
+				if tail.attempt is not None and tail.attempt != self._job_mgr.output_attempt(job_id):
+					self._storage.logs.remove_last(task.instance.name, task.parent.id, task.index, tail.lines)
+					offset = 0
 
-				task, job_id = job_info
+		self._log.debug("Reading logs for task %s ..." % task.id)
 
-				self._lock.acquire()
+		self._ingest_logs(task, job_id, offset, final = True)
 
-				task.job_result = self._job_mgr.join(job_id)
-				del self._job_task_map[job_id]
-				task.state_msg = ""
+		if self._cache is not None and task.fingerprint is not None \
+				and task.state == runstates.FINISHED:
+			self._cache.store(task, task.fingerprint)
 
-				self._log.debug("Task %s joined" % task.id)
+	def _apply_results(self, batch, results):
+		"Updates the tasks of a batch with the results of their jobs. It has to be called with the engine lock held."
 
-				self._lock.release()
+		results = dict(results)
 
-			except:
-				num_exc += 1
-				self._log.exception("Exception in wok-engine join thread (%d)" % num_exc)
+		now = time.time()
+
+		notify = False
+		for task, job_id in batch:
+			if task.finish_time is not None:
+				_FINISH_TO_JOIN_TIME.observe(now - task.finish_time)
+
+			task.job_result = results.get(job_id)
+			del self._job_task_map[job_id]
+			task.state_msg = ""
+
+			if self._db is not None:
+				self._db.task_result(task)
+
+			self._log.debug("Task %s joined" % task.id)
+
+			# the rest of a probed module has been partitioned
+			if task.instance.task_joined(task):
+				notify = True
+
+		if notify:
+			self._notified = True
+			self._cvar.notify()
+
+	def _ingest_logs(self, task, job_id, offset, final = False, attempt = None):
+		"""Parses the output of a job, or of one of its attempts, from offset and appends it to the
+		logs storage. Unless final, an incomplete last line is left for the next time.
+		Returns the offset after the last line read and the number of lines ingested."""
+
+		if attempt is None:
+			output = self._job_mgr.output(job_id)
+		else:
+			output = self._job_mgr.output(job_id, attempt)
+
+		count = 0
+		try:
+			output.seek(offset)
+
+			task_index = task.index
+			module = task.parent
+			module_id = module.id
+			instance_name = module.instance.name
+			logs_storage = self._storage.logs
+
+			logs = []
+#			last_timestamp = None
+			line = output.readline()
+			while len(line) > 0:
+				if not final and not line.endswith("\n"):
+					break
+
+				offset += len(line)
+
+				timestamp, level, name, text = parse_log(line)
+#				if timestamp is None:
+#					timestamp = last_timestamp
+#				last_timestamp = timestamp
+
+				logs += [(timestamp, level, name, text)]
+				count += 1
 
-		self._log.info("Engine join thread finished")
+				line = output.readline()
+
+				if len(line) == 0 or len(logs) >= 1000:
+					logs_storage.append(instance_name, module_id, task_index, logs)
+
+					#self._log.debug("Task %s partial logs:\n%s" % (task.id, "\n".join("\t".join(log) for log in logs)))
+
+					logs = []
+
+			if len(logs) > 0:
+				logs_storage.append(instance_name, module_id, task_index, logs)
+		finally:
+			output.close()
+
+		return offset, count
+
+	def _tail(self):
+		"Thread reading the logs of the running jobs periodically"
+
+		self._log.info("Engine tail thread ready")
+
+		while self._running:
+			with self._tails_lock:
+				# woken up when the engine stops
+				if self._running:
+					self._tail_cvar.wait(self._tail_interval)
+				if not self._running:
+					break
+				tails = self._tails.items()
+
+			for job_id, tail in tails:
+				with tail.lock:
+					if tail.closed:
+						continue
+					try:
+						if tail.attempt is None:
+							tail.attempt = self._job_mgr.output_attempt(job_id)
+						tail.offset, count = self._ingest_logs(tail.task, job_id, tail.offset, attempt = tail.attempt)
+						tail.lines += count
+					except:
+						# the output may not be available yet
+						self._log.debug("Unable to read the logs of task %s" % tail.task.id)
+
+		self._log.info("Engine tail thread finished")
 
 	@synchronized
 	def start(self, wait = True):
@@ -456,18 +826,47 @@ class WokEngine(Synchronizable):
 
 		self._running = False
 		self._cvar.notify()
+		self._idle_cvar.notify_all()
+
+		with self._tails_lock:
+			self._tail_cvar.notify_all()
 
 		self._lock.release()
 		self.wait()
 		self._lock.acquire()
 
 	@synchronized
-	def notify(self):
+	def notify(self, event = None):
+		"""Wakes up the engine run thread.
+		Job managers use it to notify job state changes (JobStateChange events)."""
+
+		if event is not None:
+			self._events += [event]
 		self._notified = True
 		self._cvar.notify()
 
 	@synchronized
+	def wait_idle(self, timeout = None):
+		"""Waits until the run thread has applied all the notified events and is waiting for more.
+		Returns whether the engine is idle. Simulated job managers use it to advance their clock
+		only once the engine has reacted to the previous jobs."""
+
+		if timeout is not None:
+			deadline = time.time() + timeout
+
+		while self._running and not (self._idle and not self._notified and len(self._events) == 0):
+			if timeout is None:
+				self._idle_cvar.wait()
+			else:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					break
+				self._idle_cvar.wait(remaining)
+
+		return self._idle and not self._notified and len(self._events) == 0
+
 	def instance(self, name):
+		# lock free, the map is only modified with the engine lock held
 		inst = self._instances_map.get(name)
 		if inst is None:
 			return None
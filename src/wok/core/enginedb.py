@@ -1,57 +1,310 @@
 import os.path
 import sqlite3
+import json
+import time
+
+from wok.element import DataFactory
+from wok.core import runstates
 
 class SqliteEngineDB(object):
-	def __init__(self, engine):
+	"""
+	Journal of the engine state.
+
+	There is a global database with the instances definition and one database
+	per instance where the modules and tasks state transitions are journaled.
+	Writes are committed in batches, either when the number of pending changes
+	reaches batch_size or when commit_interval seconds have passed since the last commit.
+
+	Callers must hold the engine lock.
+	"""
+
+	def __init__(self, engine, conf = None):
 		self._engine = engine
 
-		self._base_path = os.path.join(engine.work_path, "db")
+		if conf is None:
+			conf = engine.conf["wok"].create_element()
+
+		self._base_path = conf.get("path", os.path.join(engine.work_path, "db"))
+		if not os.path.exists(self._base_path):
+			os.makedirs(self._base_path)
+
+		self._batch_size = conf.get("batch_size", 1000, dtype=int)
+		self._commit_interval = conf.get("commit_interval", 5, dtype=float)
 
 		self._global_db_file = os.path.join(self._base_path, "__engine.db")
 		self._global_conn = None
 
 		self._instances_conn = {}
 
+		# number of changes not committed by instance name
+		self._pending = {}
+		self._global_pending = 0
+		self._last_commit = time.time()
+
+		self.__init_global_db()
+
+	def __connect(self, db_file):
+		# connections are shared between the engine threads but always under the engine lock
+		return sqlite3.connect(db_file, check_same_thread = False)
+
 	def __create_global_db(self):
-		conn = sqlite3.connect(self._global_db_file)
-		#TODO create tables
+		conn = self.__connect(self._global_db_file)
+		c = conn.cursor()
+		c.execute("""
+		CREATE TABLE instances (
+			name		TEXT PRIMARY KEY,
+			flow_file	TEXT,
+			conf		TEXT,
+			created		TIMESTAMP
+		)""")
+		conn.commit()
+		c.close()
 		return conn
 
 	def __init_global_db(self):
 		if not os.path.exists(self._global_db_file):
 			self._global_conn = self.__create_global_db()
 		else:
-			self._global_conn = sqlite3.connect(self._global_db_file)
+			self._global_conn = self.__connect(self._global_db_file)
 
-	def __create_instance_db(self, inst_db_file, instance):
-		conn = sqlite3.connect(inst_db_file)
+		self._global_conn.execute("""
+		CREATE TABLE IF NOT EXISTS module_costs (
+			module		TEXT PRIMARY KEY,
+			record_cost	REAL,
+			samples		INTEGER,
+			work		REAL,
+			tasks		REAL
+		)""")
+		self._global_conn.commit()
+
+	def __create_instance_db(self, inst_db_file):
+		conn = self.__connect(inst_db_file)
 		c = conn.cursor()
-		#c.execute("CREATE TABLE logs ()")
+		c.execute("""
+		CREATE TABLE modules (
+			id			TEXT PRIMARY KEY,
+			state		INTEGER,
+			pending		TEXT
+		)""")
+		c.execute("""
+		CREATE TABLE tasks (
+			module			TEXT,
+			idx				INTEGER,
+			state			INTEGER,
+			in_ports		TEXT,
+			out_ports		TEXT,
+			start_time		REAL,
+			end_time		REAL,
+			exit_code		INTEGER,
+			exit_message	TEXT,
+			PRIMARY KEY (module, idx)
+		)""")
 		conn.commit()
 		c.close()
 		return conn
 
-	def __open_instance_conn(self, instance):
-		if instance.name in self._instances_conn:
-			return self._instances_conn[instance.name]
+	def __open_instance_conn(self, instance_name):
+		if instance_name in self._instances_conn:
+			return self._instances_conn[instance_name]
 
-		inst_db_file = os.path.join(self._base_path, "%s.db" % instance.name)
+		inst_db_file = os.path.join(self._base_path, "%s.db" % instance_name)
 
 		if os.path.exists(inst_db_file):
-			conn = sqlite3.connect(inst_db_file)
+			conn = self.__connect(inst_db_file)
 		else:
-			conn = self.__create_instance_db(inst_db_file, instance)
+			conn = self.__create_instance_db(inst_db_file)
 
-		self._instances_conn[instance.name] = conn
+		self._instances_conn[instance_name] = conn
+		self._pending[instance_name] = 0
 
 		return conn
 
-	def __close_instance_conn(self, conn, instance):
+	def __close_instance_conn(self, instance_name):
+		conn = self._instances_conn[instance_name]
+		conn.commit()
 		conn.close()
-		del self._instances_conn[instance.name]
+		del self._instances_conn[instance_name]
+		del self._pending[instance_name]
+
+	def __execute(self, instance_name, sql, params):
+		conn = self.__open_instance_conn(instance_name)
+		conn.execute(sql, params)
+
+		self._pending[instance_name] += 1
+		if self._pending[instance_name] >= self._batch_size:
+			conn.commit()
+			self._pending[instance_name] = 0
+
+	def __executemany(self, instance_name, sql, params):
+		conn = self.__open_instance_conn(instance_name)
+		conn.executemany(sql, params)
+
+		self._pending[instance_name] += len(params)
+		if self._pending[instance_name] >= self._batch_size:
+			conn.commit()
+			self._pending[instance_name] = 0
+
+	@staticmethod
+	def _port_data_to_json(port_data):
+		return json.dumps([data.to_element(key_sep = "/").to_native() for data in port_data])
+
+	# Instances ================================================================
 
 	def instance_persist(self, instance):
-		conn = self.__open_instance_conn(instance)
-		#TODO ...
-		self.__close_instance_conn(conn, instance)
+		"Saves the instance definition and starts an empty journal for it"
+
+		conf = json.dumps(instance.conf.to_native())
+
+		c = self._global_conn.cursor()
+		c.execute("INSERT OR REPLACE INTO instances (name, flow_file, conf, created) VALUES (?, ?, ?, ?)",
+					(instance.name, os.path.abspath(instance.flow_file), conf, time.time()))
+		self._global_conn.commit()
+		c.close()
+
+		conn = self.__open_instance_conn(instance.name)
+		conn.execute("DELETE FROM modules")
+		conn.execute("DELETE FROM tasks")
+		conn.commit()
+
+	def instances(self):
+		"Returns the list of (name, flow_file, conf) of the journaled instances"
+
+		c = self._global_conn.cursor()
+		c.execute("SELECT name, flow_file, conf FROM instances ORDER BY created")
+		instances = []
+		for name, flow_file, conf in c.fetchall():
+			instances += [(name, flow_file, DataFactory.from_native(json.loads(conf)))]
+		c.close()
+		return instances
+
+	def instance_state(self, instance_name):
+		"""Returns the journaled state of an instance as a tuple (modules, tasks) where
+		modules is a map {module_id : (state, pending_range)} and tasks a map {module_id : [task_state]}.
+		Each task_state is a tuple (index, state, in_ports, out_ports, result_fields)."""
+
+		conn = self.__open_instance_conn(instance_name)
+		c = conn.cursor()
+
+		modules = {}
+		c.execute("SELECT id, state, pending FROM modules")
+		for module_id, state, pending in c.fetchall():
+			if pending is not None:
+				pending = tuple(json.loads(pending))
+			modules[module_id] = (runstates.from_id(state), pending)
+
+		tasks = {}
+		c.execute("SELECT module, idx, state, in_ports, out_ports, "
+					"start_time, end_time, exit_code, exit_message FROM tasks ORDER BY module, idx")
+		for row in c.fetchall():
+			module_id, index, state, in_ports, out_ports = row[0:5]
+			task_state = (index, runstates.from_id(state),
+							json.loads(in_ports), json.loads(out_ports), row[5:])
+			if module_id not in tasks:
+				tasks[module_id] = [task_state]
+			else:
+				tasks[module_id] += [task_state]
+
+		c.close()
+		return modules, tasks
+
+	# Modules and tasks ========================================================
+
+	def module_state(self, module):
+		pending = None
+		if module.pending_range is not None:
+			pending = json.dumps(module.pending_range)
+
+		self.__execute(module.instance.name,
+			"INSERT OR REPLACE INTO modules (id, state, pending) VALUES (?, ?, ?)",
+			(module.id, module.state.id, pending))
+
+	def tasks_persist(self, tasks):
+		if len(tasks) == 0:
+			return
+
+		params = []
+		for task in tasks:
+			params += [(task.parent.id, task.index, task.state.id,
+						self._port_data_to_json(task.in_port_data),
+						self._port_data_to_json(task.out_port_data))]
+
+		self.__executemany(tasks[0].instance.name,
+			"INSERT OR REPLACE INTO tasks (module, idx, state, in_ports, out_ports) VALUES (?, ?, ?, ?, ?)",
+			params)
+
+	def task_state(self, task):
+		self.__execute(task.instance.name,
+			"UPDATE tasks SET state = ? WHERE module = ? AND idx = ?",
+			(task.state.id, task.parent.id, task.index))
+
+	def task_result(self, task):
+		result = task.job_result
+		if result is None:
+			return
+
+		self.__execute(task.instance.name,
+			"UPDATE tasks SET start_time = ?, end_time = ?, exit_code = ?, exit_message = ? WHERE module = ? AND idx = ?",
+			(result.start_time, result.end_time, result.exit_code, result.exit_message,
+				task.parent.id, task.index))
+
+	@staticmethod
+	def recorded_tasks(inst_db_file):
+		"""Returns the tasks that finished in the journal of an instance as a map
+		{(module_id, index) : (elapsed_time, exit_code)}. It is used to replay a run."""
+
+		conn = sqlite3.connect(inst_db_file)
+		try:
+			tasks = {}
+			c = conn.execute("SELECT module, idx, start_time, end_time, exit_code FROM tasks "
+								"WHERE start_time IS NOT NULL AND end_time IS NOT NULL")
+			for module_id, index, start_time, end_time, exit_code in c.fetchall():
+				tasks[(module_id, index)] = (max(0.0, end_time - start_time), exit_code)
+			return tasks
+		finally:
+			conn.close()
+
+	# Module costs =============================================================
+
+	def module_cost(self, module_id):
+		"Returns the tuple (record_cost, samples, work, tasks) for a module or None if unknown"
+
+		row = self._global_conn.execute(
+			"SELECT record_cost, samples, work, tasks FROM module_costs WHERE module = ?", (module_id,)).fetchone()
+		if row is None:
+			return None
+		return tuple(row)
+
+	def module_cost_persist(self, module_id, record_cost, samples, work, tasks):
+		self._global_conn.execute(
+			"INSERT OR REPLACE INTO module_costs (module, record_cost, samples, work, tasks) VALUES (?, ?, ?, ?, ?)",
+			(module_id, record_cost, samples, work, tasks))
+		self._global_pending += 1
+
+	# ==========================================================================
+
+	def flush(self, force = False):
+		"Commits the pending changes if the commit interval has passed or force is True"
+
+		now = time.time()
+		if not force and now - self._last_commit < self._commit_interval:
+			return
+
+		for instance_name, conn in self._instances_conn.items():
+			if self._pending[instance_name] > 0:
+				conn.commit()
+				self._pending[instance_name] = 0
+
+		if self._global_pending > 0:
+			self._global_conn.commit()
+			self._global_pending = 0
+
+		self._last_commit = now
+
+	def close(self):
+		for instance_name in self._instances_conn.keys():
+			self.__close_instance_conn(instance_name)
 
+		if self._global_conn is not None:
+			self._global_conn.commit()
+			self._global_conn.close()
+			self._global_conn = None
@@ -166,10 +166,13 @@ class Module(_BaseModule):
 	def __init__(self, name, title = "", desc = "", enabled = True,
 					maxpar = None, wsize = None, serializer = None,
 					conf = None, in_ports = None, out_ports = None,
-					priority = None, depends = None, flow_ref = None, execution = None):
+					priority = None, depends = None, flow_ref = None, execution = None,
+					stream = None):
 		_BaseModule.__init__(self, name, title, desc, enabled, serializer, wsize, maxpar, conf, in_ports, out_ports)
 
 		self.priority = priority
+
+		self.stream = stream
 		
 		if depends is None:
 			self.depends = []
@@ -184,6 +187,8 @@ class Module(_BaseModule):
 		level = _BaseModule.repr_level(self, sb, level)
 		if self.priority is not None:
 			sb.extend([self._INDENT * level, "Priority: ", self.priority, "\n"])
+		if self.stream is not None:
+			sb.extend([self._INDENT * level, "Stream: ", str(self.stream), "\n"])
 		if self.depends is not None and len(self.depends) > 0:
 			sb.extend([self._INDENT * level, "Depends: %s\n" % ", ".join(self.depends)])
 		if self.flow_ref is not None:
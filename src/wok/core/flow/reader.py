@@ -167,6 +167,9 @@ class FlowReader(object):
 			depends = [d.strip() for d in xmle.attrib["depends"].split(",")]
 			mod.depends = [d for d in depends if len(d) > 0]
 
+		if "stream" in xmle.attrib:
+			mod.stream = str_to_bool(xmle.attrib["stream"])
+
 		exec_xml = xmle.find("exec")
 		if exec_xml is None:
 			run_xml = xmle.find("run")
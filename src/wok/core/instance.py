@@ -24,16 +24,27 @@ import sys
 import os.path
 import math
 import re
+import time
 
 from wok import logger
-from wok.element import DataElement
+from wok.element import DataElement, DataFactory
 from wok.core import runstates
 from wok.core.utils.sync import Synchronizable, synchronized
+from wok.core.metrics import get_metrics, timed
 from wok.core.nodes import *
+from wok.core.jobmgr.base import JobResult
+from wok.core.jobmgr.errors import UnknownJob
+from wok.core.portio.pathdata import PathData
+from wok.core.plan import InstancePlan
 
 # 2011-10-06 18:39:46,849 bfast_localalign-0000 INFO  : hello world
 _LOG_RE = re.compile("^(\d\d\d\d-\d\d-\d\d) (\d\d:\d\d:\d\d,\d\d\d) (.*) (DEBUG|INFO|WARN|ERROR) : (.*)$")
 
+_metrics = get_metrics()
+_SCHEDULE_TIME = _metrics.timer("wok_instance_schedule_tasks_seconds", "Time spent scheduling the tasks of an instance")
+_PARTITION_TIME = _metrics.timer("wok_instance_partition_module_seconds", "Time spent partitioning a module")
+_TASKS_SCHEDULED = _metrics.counter("wok_instance_tasks_scheduled_total", "Tasks scheduled by the instances")
+
 class Instance(object):
 
 	_INDENT = "  "
@@ -41,6 +52,7 @@ class Instance(object):
 	def __init__(self, engine, name, conf_builder, flow_file):
 		self.engine = engine
 		self._storage = engine.storage
+		self._db = engine.db
 
 		self.name = name
 		
@@ -55,7 +67,37 @@ class Instance(object):
 		
 		# modules by name
 		self._module_index = None
-	
+
+		# leaf modules ready to be partitioned and scheduled
+		self._ready_modules = []
+
+		# restored tasks that have to be submitted again
+		self._pending_tasks = []
+
+		# port data operations recorded while connecting the ports to compile the plan
+		self._port_ops = None
+
+		# last published snapshot and whether the state changed since then
+		self._snapshot = None
+		self._snapshot_version = 0
+		self._dirty = True
+
+		# native elements of the last snapshot. The parts that never change are serialized
+		# once by module, and modules which state didn't change reuse their last element.
+		self._snapshot_conf = None
+		self._snapshot_static = {}
+		self._snapshot_modules = {}
+
+		# critical path: input sizes already known, which don't change, and the expected
+		# time of the unfinished leaf modules. Input records are converted into seconds
+		# with record_cost for the modules without history.
+		self._cp_sizes = {}
+		self._cp_times = {}
+		self._record_cost = 1.0
+
+		# whether the ranks changed and the queued tasks have to be ordered again
+		self.ranks_changed = False
+
 	def initialize(self):
 		self.conf = self.conf_builder()
 
@@ -71,41 +113,232 @@ class Instance(object):
 
 		self.default_maxpar = wok_conf.get("defaults.maxpar", 0, dtype=int)
 		self.default_wsize = wok_conf.get("defaults.wsize", 1, dtype=int)
-
-		self.root_flow = self.engine.flow_loader.load_from_file(self.flow_file)
+		self.default_stream = wok_conf.get("defaults.stream", False, dtype=bool)
+
+		self._autopart_enabled = wok_conf.get("autopartition.enabled", False, dtype=bool)
+		self._autopart_target_time = wok_conf.get("autopartition.target_time", 60, dtype=float)
+		self._autopart_min_time = wok_conf.get("autopartition.min_time", 5, dtype=float)
+		self._autopart_probe_size = wok_conf.get("autopartition.probe_size", 100, dtype=int)
+		self._autopart_parallelism = wok_conf.get("autopartition.parallelism", 0, dtype=int)
+
+		plans = self.engine.plans
+		plan = None
+		if plans is not None:
+			plan_key = plans.key(self.flow_file, self.conf)
+			plan = plans.get(plan_key)
+
+		if plan is not None:
+			self._build_from_plan(plan)
+		else:
+			self._build()
+			if plans is not None:
+				plans.put(plan_key, InstancePlan.compile(self.root_node, self._port_ops))
+			self._port_ops = None
 
 		wok_conf["__flow.name"] = self.root_flow.name
 		wok_conf["__flow.path"] = os.path.dirname(os.path.abspath(self.flow_file))
 		wok_conf["__flow.file"] = os.path.basename(self.flow_file)
-		
+
+		# initialize the state counters
+		self.root_node.init_counters()
+
+		# index the modules that can be scheduled from the beginning
+		self._ready_modules = []
+		self._init_ready_modules(self.root_node)
+
+		# self._log.debug("Flow node tree:\n" + repr(self.root_node))
+
+	def _build(self):
+		"Creates the nodes tree loading the flows and resolving their ports and dependencies"
+
+		self.root_flow = self.engine.flow_loader.load_from_file(self.flow_file)
+
 		# self._log.debug("\n" + repr(self.root_flow))
 
 		# create nodes tree
 		self.root_node = self._create_tree(self.root_flow, namespace = "")
 
-		# connect ports
+		# connect ports recording the operations for the plan
+		self._port_ops = []
 		self._connect_ports(self.root_node, namespace = self.root_node.name)
 
 		# calculcate dependencies
 		self._calculate_dependencies(self.root_node)
 
+		# find the modules that can receive partitions as they are written
+		self._calculate_streams(self.root_node)
+
 		# calculate priorities
 		for m in self.root_node.modules:
 			self._calculate_priorities(m)
 
-		# TODO self._save_initial_state()
+	def _build_from_plan(self, plan):
+		"Creates the nodes tree from a compiled plan"
 
-		# self._log.debug("Flow node tree:\n" + repr(self.root_node))
+		self.root_flow = plan.root_flow
+
+		self._module_index = {}
+
+		nodes = []
+		for is_leaf, parent_index, namespace, model in plan.modules:
+			parent = nodes[parent_index] if parent_index >= 0 else None
+			if is_leaf:
+				module = LeafModuleNode(instance = self, model = model, parent = parent, namespace = namespace)
+			else:
+				module = FlowNode(instance = self, parent = parent, model = model, namespace = namespace)
+
+			module.set_in_ports(self._create_port_nodes(module, model.in_ports, module.id))
+			module.set_out_ports(self._create_port_nodes(module, model.out_ports, module.id))
+
+			if parent is not None:
+				parent.modules += [module]
+				self._module_index[module.id] = module
+
+			nodes += [module]
+
+		self.root_node = nodes[0]
+
+		def port(ref):
+			module_index, mode, port_index = ref
+			if mode == PORT_MODE_IN:
+				return nodes[module_index].in_ports[port_index]
+			return nodes[module_index].out_ports[port_index]
+
+		for port_ref, link_refs in plan.port_ops:
+			p = port(port_ref)
+			if link_refs is None:
+				p.data = self._storage.create_port_data(p)
+			elif len(link_refs) == 1:
+				p.data = self._storage.create_port_linked_data(p, port(link_refs[0]).data)
+			else:
+				p.data = self._storage.create_port_joined_data(p, [port(ref).data for ref in link_refs])
+
+		for module, depends in zip(nodes, plan.depends):
+			module.depends = set([nodes[i] for i in depends])
+			for dep_mod in module.depends:
+				dep_mod.notify.add(module)
+			module.waiting = set(module.depends)
+
+		for module_index, source_index, stream_ports in plan.streams:
+			module = nodes[module_index]
+			source = nodes[source_index]
+			module.stream_source = source
+			module.stream_ports = list(stream_ports)
+			source.stream_targets += [module]
+
+		for module, (priority, priority_factor) in zip(nodes, plan.priorities):
+			module.priority = priority
+			module.priority_factor = priority_factor
 
 	@property
 	def state(self):
 		return self.root_node.state
 
 	def _save_initial_state(self):
-		raise Exception("Not yet implemented")
+		"Starts the journal of a new instance"
+
+		if self._db is not None:
+			self._db.instance_persist(self)
 
 	def _load_state(self):
-		raise Exception("Not yet implemented")
+		"""Restores the modules and tasks state from the journal.
+		Finished tasks are kept and unfinished ones are queued to be submitted again."""
+
+		if self._db is None:
+			return
+
+		module_states, module_tasks = self._db.instance_state(self.name)
+
+		pending_tasks = []
+		for module_id, module in self._module_index.items():
+			if not module.is_leaf_module or module_id not in module_states:
+				continue
+
+			module_state, module.pending_range = module_states[module_id]
+
+			task_states = module_tasks.get(module_id, [])
+			if len(task_states) == 0:
+				# never partitioned or finished without tasks
+				if module_state == runstates.FINISHED:
+					module.state = runstates.FINISHED
+				continue
+
+			module.tasks = []
+			num_finished = 0
+			for index, state, in_ports, out_ports, result_fields in task_states:
+				task = TaskNode(parent = module, index = index)
+				task.in_port_data = [self._port_data_from_native(pd) for pd in in_ports]
+				task.out_port_data = [self._port_data_from_native(pd) for pd in out_ports]
+				module.tasks += [task]
+
+				if state == runstates.FINISHED:
+					task.state = state
+					task.job_result = result = JobResult()
+					result.state = state
+					result.start_time, result.end_time, result.exit_code, result.exit_message = result_fields
+					num_finished += 1
+				else:
+					self._storage.save_task_config(task)
+					pending_tasks += [task]
+
+			if num_finished == len(module.tasks) and module.pending_range is None:
+				module.state = runstates.FINISHED
+			else:
+				module.state = runstates.WAITING
+
+		# a module receiving partitions is not finished until its source finishes
+		for module in self._module_index.values():
+			if module.stream_source is not None and module.state == runstates.FINISHED \
+					and module.stream_source.state != runstates.FINISHED:
+				module.state = runstates.WAITING
+
+		self._restore_flows_state(self.root_node)
+		self._restore_waiting(self.root_node)
+
+		self.root_node.init_counters()
+
+		self._calculate_critical_path()
+
+		self._ready_modules = []
+		self._init_ready_modules(self.root_node)
+
+		self._pending_tasks = pending_tasks
+
+		# partition the rest of the modules whose probe finished before the journal was closed
+		for module in self._module_index.values():
+			if module.pending_range is not None \
+					and len(module.tasks) == module.tasks_count_by_state.get(runstates.FINISHED, 0):
+				self._partition_remaining(module)
+
+		# stream the partitions that were finished but not journaled as streamed
+		for module in self._module_index.values():
+			source = module.stream_source
+			if source is None or source.state == runstates.FINISHED:
+				continue
+			streamed = set([task.index for task in module.tasks])
+			for task in source.tasks:
+				if task.state == runstates.FINISHED and task.index not in streamed:
+					self._stream_partition(module, task)
+
+		self._log.info("Instance {} restored with {} tasks to resubmit".format(self.name, len(pending_tasks)))
+
+	def _port_data_from_native(self, native):
+		return self._storage.create_port_data_from_conf(DataFactory.from_native(native, key_sep = "/"))
+
+	def _restore_flows_state(self, module):
+		children_states = set()
+		for m in module.modules:
+			if not m.is_leaf_module:
+				self._restore_flows_state(m)
+			children_states.add(m.state)
+
+		if len(children_states) > 0:
+			module.state = self._state_from_children(children_states)
+
+	def _restore_waiting(self, module):
+		module.waiting = set([m for m in module.depends if m.state != runstates.FINISHED])
+		for m in module.modules:
+			self._restore_waiting(m)
 
 	def _create_tree(self, flow_def, parent = None, namespace = ""):
 
@@ -269,6 +502,7 @@ class Instance(object):
 
 			if len(port_def.link) == 0: # link not defined (they are source ports)
 				port.data = self._storage.create_port_data(port)
+				self._port_ops += [(port, None)]
 				#TODO clean port data
 				#self._log.debug(">>> {} -> [{}] {}".format(port.parent.id, id(port.data), port.data))
 
@@ -280,6 +514,7 @@ class Instance(object):
 	
 			port_def = port.model
 			if len(port_def.link) > 0:
+				linked_ports = []
 				linked_data = []
 				for link in port_def.link:
 					link = gid_func(link)
@@ -296,12 +531,14 @@ class Instance(object):
 					if port.serializer is not None and port.serializer != linked_port.serializer:
 						raise Exception("Unmatching serializer found while linking port '{}' [{}] with '{}' [{}]".format(port.id, port.serializer, linked_port.id, linked_port.serializer))
 
+					linked_ports += [linked_port]
 					linked_data += [linked_port.data]
 
 				if len(linked_data) == 1:
 					port.data = self._storage.create_port_linked_data(port, linked_data[0])
 				else:
 					port.data = self._storage.create_port_joined_data(port, linked_data)
+				self._port_ops += [(port, linked_ports)]
 
 		# check that there are no ports without data
 		for port_id, port in ports:
@@ -409,6 +646,43 @@ class Instance(object):
 		for m in module.modules:
 			self._apply_dependencies(m, mod_source_map, mod_name_map, source_map)
 
+	def _calculate_streams(self, module):
+		"""A module can receive the partitions of its source as they are written when
+		streaming is enabled for it, it depends only on a leaf module and all its
+		input ports are linked one to one with output ports of that module."""
+
+		for m in module.modules:
+			if not m.is_leaf_module:
+				self._calculate_streams(m)
+				continue
+
+			if not m.stream or len(m.in_ports) == 0 or len(m.depends) != 1 \
+					or len(m.model.depends) > 0:
+				continue
+
+			source = iter(m.depends).next()
+			if not source.is_leaf_module:
+				continue
+
+			source_data = [port.data for port in source.out_ports]
+			stream_ports = []
+			for port in m.in_ports:
+				index = -1
+				for i, data in enumerate(source_data):
+					if port.data is data and isinstance(data, PathData):
+						index = i
+				if index == -1:
+					break
+				stream_ports += [index]
+
+			if len(stream_ports) != len(m.in_ports):
+				self._log.warn("Module {} can not receive partitions from {} as they are written".format(m.id, source.id))
+				continue
+
+			m.stream_source = source
+			m.stream_ports = stream_ports
+			source.stream_targets += [m]
+
 	def _calculate_priorities(self, module, parent_priority = 0, factor = 1.0):
 		if module.model.priority is not None:
 			priority = module.model.priority
@@ -423,42 +697,216 @@ class Instance(object):
 		for m in module.modules:
 			self._calculate_priorities(m, module.priority, factor)
 
-	def schedule_tasks(self):
-		tasks = []
-		require_rescheduling = True
-		while require_rescheduling:
-			require_rescheduling, tasks = \
-				self._schedule_tasks(self.root_node, tasks)
-		return tasks
+	def _calculate_critical_path(self):
+		"""Ranks the unfinished leaf modules by the longest expected time from their start
+		to the end of the flow, so the tasks of the modules that determine the makespan run
+		first, with the module priority breaking ties. The expected time of a module comes from
+		the work of its previous runs or from its input size when there is no history."""
+
+		costs = self.engine.module_costs
+
+		leaves = [m for m in self._module_index.values()
+					if m.is_leaf_module and m.state != runstates.FINISHED]
 
-	def _schedule_tasks(self, module, tasks):
-		require_rescheduling = False
+		record_costs = [c for c in [costs.get(m.id) for m in leaves] if c is not None]
+		if len(record_costs) > 0:
+			self._record_cost = sum(record_costs) / len(record_costs)
+		else:
+			self._record_cost = 1.0
+
+		estimates = {}
+		self._cp_times = {}
+		for m in leaves:
+			self._cp_times[m] = self._expected_time(m, estimates)
+
+		ranks = {}
+		for m in leaves:
+			self._critical_path_rank(m, ranks)
+
+		for m in leaves:
+			m.rank = ranks[m]
+
+		self.ranks_changed = True
+
+	def _update_critical_path(self, modules, changed = None):
+		"""Updates the expected time of some modules, as their input size may be known now, and of
+		the modules after them whose size is estimated from theirs. Then the ranks are updated
+		backwards from the modules whose time changed and the ones in changed."""
+
+		if changed is None:
+			changed = set()
+
+		estimates = {}
+		visited = set()
+		pending = list(modules)
+		while len(pending) > 0:
+			m = pending.pop()
+			if m in visited or m.state == runstates.FINISHED:
+				continue
+			visited.add(m)
+
+			# the modules after it estimate their size from its size unless it was already known
+			if m not in self._cp_sizes:
+				pending.extend(m.notify)
+
+			if m.is_leaf_module:
+				time = self._expected_time(m, estimates)
+				if time != self._cp_times.get(m):
+					self._cp_times[m] = time
+					changed.add(m)
+
+		while len(changed) > 0:
+			m = changed.pop()
+			if m.state == runstates.FINISHED:
+				continue
+
+			rank = max([n.rank for n in m.notify if n.state != runstates.FINISHED] + [0])
+			rank += self._cp_times.get(m, 0)
+			if rank != m.rank:
+				m.rank = rank
+				changed.update(m.depends)
+				self.ranks_changed = True
+
+	def _expected_time(self, module, estimates):
+		work = self.engine.module_costs.work(module.id)
+		if work is None:
+			return self._expected_size(module, estimates) * self._record_cost
+
+		work_time, num_tasks = work
+		slots = self.engine.job_manager.slots
+		if slots is not None and slots > 0:
+			num_tasks = min(num_tasks, slots)
+		return work_time / max(num_tasks, 1.0)
+
+	def _expected_size(self, module, estimates):
+		"""Returns the input size of a module or the largest one of its dependencies if still unknown.
+		Sizes are cached once known, estimates only for the calculation they are passed to."""
+
+		size = self._cp_sizes.get(module)
+		if size is not None:
+			return size
+
+		if module in estimates:
+			return estimates[module]
+
+		if module.is_leaf_module and len(module.tasks) > 0:
+			task_sizes = [task.size for task in module.tasks]
+			if None not in task_sizes:
+				size = sum(task_sizes)
+		elif len(module.waiting) == 0 and len(module.in_ports) > 0:
+			size = max([port.data.size() for port in module.in_ports])
+
+		if size is not None:
+			# partitions are still being received from the source
+			source = module.stream_source
+			if source is None or source.state == runstates.FINISHED:
+				self._cp_sizes[module] = size
+			else:
+				estimates[module] = size
+			return size
+
+		size = max([self._expected_size(m, estimates) for m in module.depends] + [1])
+		estimates[module] = size
+		return size
+
+	def _critical_path_rank(self, module, ranks):
+		if module in ranks:
+			return ranks[module]
+
+		ranks[module] = 0 # break cycles
+		rank = 0
+		for m in module.notify:
+			if m.state != runstates.FINISHED:
+				rank = max(rank, self._critical_path_rank(m, ranks))
+
+		rank += self._cp_times.get(module, 0)
+		ranks[module] = rank
+		return rank
+
+	def _init_ready_modules(self, module):
 		if module.is_leaf_module:
 			if module.state == runstates.READY and len(module.waiting) == 0:
+				self._ready_modules += [module]
+		else:
+			for m in module.modules:
+				self._init_ready_modules(m)
+
+	@timed(_SCHEDULE_TIME)
+	def schedule_tasks(self):
+		"""Partitions the leaf modules that are ready to run and returns their tasks.
+		Only the modules in the ready index are visited, not the whole tree."""
+
+		tasks = self._pending_tasks
+		self._pending_tasks = []
+
+		while len(self._ready_modules) > 0:
+			ready_modules = self._ready_modules
+			self._ready_modules = []
+
+			for module in ready_modules:
+				if module.state != runstates.READY or len(module.waiting) > 0:
+					continue
+
 				module.tasks = self._partition_module(module)
 				if len(module.tasks) == 0:
+					# finishing may add new modules to the ready index
 					self.change_module_state(module, runstates.FINISHED)
-					require_rescheduling = True
 					#self._log.debug("FINISHED: {}".format(repr(module)))
 				else:
 					#TODO self._storage.remove_task(task) ???
 					for task in module.tasks:
 						self._storage.save_task_config(task)
 
+					module.update_children_count(None, runstates.READY, len(module.tasks))
+					module.update_tasks_count(None, runstates.READY, len(module.tasks))
+
+					if self._db is not None:
+						self._db.tasks_persist(module.tasks)
+
 					tasks += module.tasks
 					self.change_module_state(module, runstates.WAITING)
+
+					# its input size is known now
+					self._update_critical_path([module])
 					#self._log.debug("READY: {}".format(repr(module)))
 					#self._log.debug("tasks: {}".format(repr(tasks)))
-			#TODO elif module.state == runstates.FAILED and retrying:
-		else:
-			for m in module.modules:
-				req_resch, tasks = self._schedule_tasks(m, tasks)
-				require_rescheduling |= req_resch
+				#TODO elif module.state == runstates.FAILED and retrying:
+
+				if module.parent is not None:
+					self.update_module_state_from_children(module.parent)
+
+		if len(tasks) > 0:
+			self._dirty = True
+			_TASKS_SCHEDULED.inc(len(tasks))
+
+		return tasks
 
-			self.update_module_state_from_children(module, recursive = False)
+	def _stream_partition(self, module, source_task):
+		"Creates the task of a module for the partition written by a task of its source"
+
+		task = TaskNode(parent = module, index = source_task.index)
+		for i in module.stream_ports:
+			task.in_port_data.append(source_task.out_port_data[i].get_partition_slice())
+		for port in module.out_ports:
+			task.out_port_data.append(port.data.get_partition(source_task.index))
+
+		module.tasks += [task]
+		self._storage.save_task_config(task)
+
+		module.update_children_count(None, task.state)
+		module.update_tasks_count(None, task.state)
+
+		if self._db is not None:
+			self._db.tasks_persist([task])
+
+		if module.state == runstates.READY:
+			self.change_module_state(module, runstates.WAITING)
+			if module.parent is not None:
+				self.update_module_state_from_children(module.parent)
 
-		return (require_rescheduling, tasks)
+		self._pending_tasks += [task]
 
+	@timed(_PARTITION_TIME)
 	def _partition_module(self, module):
 		# Calculate input sizes and the minimum wsize
 		psizes = []
@@ -498,72 +946,239 @@ class Instance(object):
 					num_partitions = 1
 					self._log.warn("Empty port, no partitioning")
 				else:
-					num_partitions = int(math.ceil(psize / float(mwsize)))
-					maxpar = module.maxpar
-					self._log.debug("{}: maxpar={}".format(module.id, maxpar))
-					if maxpar > 0 and num_partitions > maxpar:
-						mwsize = int(math.ceil(psize / float(maxpar)))
-						num_partitions = int(math.ceil(psize / float(mwsize)))
+					if self._autopart_enabled:
+						mwsize, psize = self._auto_partition(module, psize, mwsize)
+					num_partitions, mwsize = self._num_partitions(module, psize, mwsize)
 					self._log.debug("{}: num_par={}, psize={}, mwsize={}".format(module.id, num_partitions, psize, mwsize))
 
-			start = 0
-			partitions = []
-			for i in xrange(num_partitions):
-				task = TaskNode(parent = module, index = i)
-				tasks += [task]
-				end = min(start + mwsize, psize)
-				size = end - start
-				partitions += [(task, start,  size)]
-				self._log.debug("{}[{:04d}]: start={}, end={}, size={}".format(module.id, i, start, end, size))
-				start += mwsize
-
-			#self._log.debug(repr(partitions))
-
-			for partition in partitions:
-				task, start, size = partition
-				for port in module.in_ports:
-					data = port.data.get_slice(start, size)
-					task.in_port_data.append(data)
-				for port in module.out_ports:
-					data = port.data.get_partition()
-					task.out_port_data.append(data)
+			tasks = self._create_tasks(module, 0, 0, psize, mwsize, num_partitions)
 
 		return tasks
 
-	@staticmethod
-	def change_module_state(module, state):
+	def _num_partitions(self, module, psize, mwsize):
+		"Returns the tuple (num_partitions, wsize) limited by the maxpar of the module"
+
+		num_partitions = int(math.ceil(psize / float(mwsize)))
+		maxpar = module.maxpar
+		self._log.debug("{}: maxpar={}".format(module.id, maxpar))
+		if maxpar > 0 and num_partitions > maxpar:
+			mwsize = int(math.ceil(psize / float(maxpar)))
+			num_partitions = int(math.ceil(psize / float(mwsize)))
+		return num_partitions, mwsize
+
+	def _create_tasks(self, module, first_index, offset, psize, mwsize, num_partitions):
+		"Creates the tasks for the input range [offset, offset + psize) split in partitions of mwsize records"
+
+		tasks = []
+
+		start = offset
+		limit = offset + psize
+		partitions = []
+		for i in xrange(num_partitions):
+			task = TaskNode(parent = module, index = first_index + i)
+			tasks += [task]
+			end = min(start + mwsize, limit)
+			size = end - start
+			task.size = size
+			partitions += [(task, start,  size)]
+			self._log.debug("{}[{:04d}]: start={}, end={}, size={}".format(module.id, task.index, start, end, size))
+			start += mwsize
+
+		#self._log.debug(repr(partitions))
+
+		for partition in partitions:
+			task, start, size = partition
+			for port in module.in_ports:
+				data = port.data.get_slice(start, size)
+				task.in_port_data.append(data)
+			for port in module.out_ports:
+				data = port.data.get_partition()
+				task.out_port_data.append(data)
+
+		return tasks
+
+	def _auto_partition(self, module, psize, mwsize):
+		"""Chooses the partition size of a module from its measured cost per record.
+		Returns the tuple (wsize, psize) with the size of the partitions and the number
+		of records to partition now. When the cost of the module is unknown only a probe
+		task is created and the rest of the input is partitioned once the probe finishes."""
+
+		cost = self.engine.module_costs.get(module.id)
+		if cost is None:
+			probe_size = self._autopart_probe_size
+			if probe_size > 0 and psize > probe_size:
+				module.pending_range = (probe_size, psize - probe_size)
+				self._log.debug("{}: probing with {} of {} records".format(module.id, probe_size, psize))
+				return probe_size, probe_size
+			return mwsize, psize
+
+		wsize = self._auto_wsize(psize, mwsize, cost)
+		self._log.debug("{}: cost={:.6f}s/record, wsize={}".format(module.id, cost, wsize))
+		return wsize, psize
+
+	def _auto_wsize(self, psize, mwsize, cost):
+		"""Returns a partition size that makes tasks last around target_time seconds,
+		but with at least parallelism partitions as far as they last more than min_time seconds"""
+
+		total_time = psize * cost
+		num_partitions = max(1, int(math.ceil(total_time / self._autopart_target_time)))
+		if num_partitions < self._autopart_parallelism:
+			num_partitions = min(self._autopart_parallelism, max(num_partitions, int(total_time / self._autopart_min_time)))
+
+		return max(mwsize, int(math.ceil(psize / float(num_partitions))))
+
+	def _partition_remaining(self, module):
+		"Partitions the input range of a module left after its probe task"
+
+		offset, psize = module.pending_range
+		module.pending_range = None
+
+		mwsize = min([port.wsize for port in module.in_ports])
+		cost = self.engine.module_costs.get(module.id)
+		if cost is not None:
+			mwsize = self._auto_wsize(psize, mwsize, cost)
+		num_partitions, mwsize = self._num_partitions(module, psize, mwsize)
+
+		self._log.debug("{}: num_par={}, psize={}, mwsize={} after probe".format(module.id, num_partitions, psize, mwsize))
+
+		tasks = self._create_tasks(module, len(module.tasks), offset, psize, mwsize, num_partitions)
+		module.tasks += tasks
+
+		for task in tasks:
+			self._storage.save_task_config(task)
+
+		module.update_children_count(None, runstates.READY, len(tasks))
+		module.update_tasks_count(None, runstates.READY, len(tasks))
+
+		if self._db is not None:
+			self._db.tasks_persist(tasks)
+			self._db.module_state(module)
+
+		self._pending_tasks += tasks
+
+		self.update_module_state_from_children(module)
+		if module.state == runstates.READY:
+			self.change_module_state(module, runstates.WAITING)
+
+	def task_joined(self, task):
+		"""Updates the cost of the module of a task once its job result is known.
+		Returns whether new tasks were created for the rest of the module input."""
+
+		module = task.parent
+		result = task.job_result
+		if result is None or result.state != runstates.FINISHED:
+			return False
+
+		if result.start_time is not None and result.end_time is not None:
+			elapsed = result.end_time - result.start_time
+			if task.size is not None:
+				self.engine.module_costs.update(module.id, task.size, elapsed)
+
+			module.joined_work += elapsed
+			module.joined_tasks += 1
+			if module.state == runstates.FINISHED and module.joined_tasks == len(module.tasks):
+				self.engine.module_costs.update_work(module.id, module.joined_work, module.joined_tasks)
+
+		if module.pending_range is None \
+				or len(module.tasks) != module.tasks_count_by_state.get(runstates.FINISHED, 0):
+			return False
+
+		self._partition_remaining(module)
+		return True
+
+	def change_module_state(self, module, state):
 		prev_state = module.state
 		if prev_state == state:
 			return
 
 		module.state = state
+		self._dirty = True
+
+		parent = module.parent
+		if parent is not None:
+			parent.update_children_count(prev_state, state)
+			if module.is_leaf_module:
+				parent.update_modules_count(prev_state, state)
+
+		if self._db is not None and module.is_leaf_module:
+			self._db.module_state(module)
 
 		if state == runstates.FINISHED:
 			for m in module.notify:
 				if module in m.waiting:
 					m.waiting.remove(module)
+					if len(m.waiting) == 0 and m.is_leaf_module and m.state == runstates.READY:
+						self._ready_modules += [m]
+
+			# modules that received all the partitions can finish now
+			for m in module.stream_targets:
+				if len(m.tasks) > 0:
+					self.update_module_state_from_children(m)
+
+			# the critical path changes as modules finish, the longest
+			# path of the modules before it may have gone through it
+			if module.is_leaf_module:
+				self._cp_times.pop(module, None)
+				self._update_critical_path(module.notify, set(module.depends))
+
+	def change_task_state(self, task, state):
+		"Changes the state of a task and updates the counters of its ancestors"
+
+		prev_state = task.state
+		if prev_state == state:
+			return
+
+		task.state = state
+		self._dirty = True
+
+		module = task.parent
+		module.update_children_count(prev_state, state)
+		module.update_tasks_count(prev_state, state)
+
+		if self._db is not None:
+			self._db.task_state(task)
+
+		if state == runstates.FINISHED:
+			for target in module.stream_targets:
+				self._stream_partition(target, task)
+
+	@staticmethod
+	def _state_from_children(children_states):
+		"Derives the state of a module from the set of states of its children"
+
+		if len(children_states) == 1:
+			return iter(children_states).next()
+
+		if runstates.FAILED in children_states:
+			return runstates.FAILED
+		elif runstates.RUNNING in children_states:
+			return runstates.RUNNING
+		elif runstates.WAITING in children_states:
+			return runstates.WAITING
+		elif runstates.PAUSED in children_states:
+			return runstates.PAUSED
+		elif runstates.READY in children_states:
+			return runstates.READY
+		return None
 
 	def update_module_state_from_children(self, module, recursive = True):
-		children_states = set()
-		for m in module.children:
-			children_states.add(m.state)
+		children_states = module.children_count_by_state.keys()
+		if len(children_states) == 0:
+			return
 
 		prev_state = module.state
-		if len(children_states) == 1:
-			state = iter(children_states).next()
-		else:
-			if runstates.FAILED in children_states:
-				state = runstates.FAILED
-			elif runstates.RUNNING in children_states:
-				state = runstates.RUNNING
-			elif runstates.WAITING in children_states:
-				state = runstates.WAITING
-			elif runstates.PAUSED in children_states:
-				state = runstates.PAUSED
-			elif runstates.READY in children_states:
-				state = runstates.READY
-
-		if prev_state != state:
+		state = self._state_from_children(children_states)
+
+		# a module receiving partitions is not finished until its source finishes
+		source = module.stream_source
+		if state == runstates.FINISHED and source is not None and source.state != runstates.FINISHED:
+			state = runstates.WAITING
+
+		# a module with input left to partition after its probe is not finished either
+		if state == runstates.FINISHED and module.pending_range is not None:
+			state = runstates.WAITING
+
+		if state is not None and prev_state != state:
 #			sb = [module.id, " : ", str(prev_state)]
 #			sb += [" --> ", str(state), "  {", str(", ".join(str(s) for s in children_states)), "}"]
 #			if module.parent is not None:
@@ -590,31 +1205,51 @@ class Instance(object):
 		if not isinstance(m, LeafModuleNode):
 			raise Exception("Not a leaf module: %s" % module_id)
 
-		if m.tasks is None or task_index >= len(m.tasks):
+		if m.tasks is None:
 			raise Exception("Task index out of bounds: %d" % task_index)
 
-		return m.tasks[task_index]
+		if task_index < len(m.tasks) and m.tasks[task_index].index == task_index:
+			return m.tasks[task_index]
+
+		# streamed tasks are created in the order their partitions are written
+		for task in m.tasks:
+			if task.index == task_index:
+				return task
+
+		raise Exception("Task index out of bounds: %d" % task_index)
+
+	def stored_task_logs(self, module_id, task_index):
+		"Returns the logs of a task from the logs storage or None. It doesn't require the engine lock."
 
-	def task_logs(self, module_id, task_index):
 		if self._storage.logs.exist(self.name, module_id, task_index):
 			return self._storage.logs.query(self.name, module_id, task_index)
+		return None
+
+	def task_logs(self, module_id, task_index):
+		logs = self.stored_task_logs(module_id, task_index)
+		if logs is not None:
+			return logs
 
 		task = self.task(module_id, task_index)
 		if task.job_id is None:
 			raise Exception("Task has not been submited yet: %s" % task.id)
 
-		job = self.engine.job_manager.job(task.job_id)
-		if job is None:
+		# the job manager knows where the output is, it may not be a file
+		try:
+			f = self.engine.job_manager.output(task.job_id)
+		except UnknownJob:
 			raise Exception("Task job not found: %s" % task.job_id)
-
-		if job.output_file is None or not os.path.exists(job.output_file):
+		except IOError:
 			return []
 
 		logs = []
-		for line in open(job.output_file):
-			timestamp, level, name, text = parse_log(line)
-			logs += [(timestamp, level, name, text)]
-		
+		try:
+			for line in f:
+				timestamp, level, name, text = parse_log(line)
+				logs += [(timestamp, level, name, text)]
+		finally:
+			f.close()
+
 		return logs
 
 	def to_element(self, e = None):
@@ -624,12 +1259,68 @@ class Instance(object):
 		e["name"] = self.name
 		e["conf"] = self.conf
 
-		self.root_node.update_tasks_count_by_state()
-		self.root_node.update_modules_count_by_state()
 		self.root_node.to_element(e.create_element("root"))
 
 		return e
 
+	@property
+	def snapshot(self):
+		return self._snapshot
+
+	def publish_snapshot(self):
+		"""Publishes a new snapshot of the instance state if it changed since the last one
+		and returns the last snapshot. It has to be called with the engine lock held."""
+
+		if self._dirty or self._snapshot is None:
+			if self._snapshot_conf is None:
+				self._snapshot_conf = self.conf.to_native()
+
+			data = dict(
+				name = self.name,
+				conf = self._snapshot_conf,
+				root = self._module_native(self.root_node))
+
+			self._snapshot_version += 1
+			self._snapshot = InstanceSnapshot(self._snapshot_version, self.root_node.state, data)
+			self._dirty = False
+
+		return self._snapshot
+
+	def _module_native(self, module):
+		"""Returns the element of a module as native objects, as its to_element does. Only the modules
+		which state changed since the last snapshot are serialized again, the rest return the
+		same objects, which are never modified once published."""
+
+		if module.is_leaf_module:
+			modules = None
+			modules_count = None
+		else:
+			modules = [self._module_native(m) for m in module.modules]
+			modules_count = dict(module.modules_count_by_state)
+
+		key = (module.state, module.state_msg, module.priority, dict(module.tasks_count_by_state), modules_count)
+
+		last = self._snapshot_modules.get(module)
+		if last is not None and last[0] == key and (modules is None
+				or (len(modules) == len(last[1]) and all([a is b for a, b in zip(modules, last[1])]))):
+			return last[2]
+
+		static = self._snapshot_static.get(module)
+		if static is None:
+			static = self._snapshot_static[module] = BaseModuleNode.to_element(module).to_native()
+
+		native = dict(static)
+		native["state"] = str(module.state)
+		native["state_msg"] = module.state_msg
+		native["priority"] = module.priority
+		native["tasks_count"] = dict([(str(state), cnt) for state, cnt in module.tasks_count_by_state.items()])
+		if modules is not None:
+			native["modules"] = modules
+			native["modules_count"] = dict([(str(state), cnt) for state, cnt in modules_count.items()])
+
+		self._snapshot_modules[module] = (key, modules, native)
+		return native
+
 	def __repr__(self):
 		sb = []
 		self.repr_level(sb, 0)
@@ -641,6 +1332,20 @@ class Instance(object):
 		self.root_node.repr_level(sb, level)
 		return level
 
+class InstanceSnapshot(object):
+	"""
+	Immutable view of the state of an instance published by the engine after every
+	scheduling round. Readers never modify it, so it can be read without the engine lock.
+	"""
+
+	def __init__(self, version, state, data):
+		self.version = version
+		self.timestamp = time.time()
+		self.state = state
+
+		# the instance element as native python objects
+		self.data = data
+
 class InstanceController(Synchronizable):
 	def __init__(self, engine, instance):
 		Synchronizable.__init__(self, engine._lock)
@@ -668,9 +1373,17 @@ class InstanceController(Synchronizable):
 			return False
 		return True
 
-	@synchronized
 	def task_logs(self, module_id, task_index):
-		return self.__instance.task_logs(module_id, task_index)
+		logs = self.__instance.stored_task_logs(module_id, task_index)
+		if logs is not None:
+			return logs
+
+		# the logs are not in the storage yet, read them from the job output
+		self._acquire()
+		try:
+			return self.__instance.task_logs(module_id, task_index)
+		finally:
+			self._release()
 
 	@synchronized
 	def start(self):
@@ -700,6 +1413,22 @@ class InstanceController(Synchronizable):
 	def reload(self):
 		raise Exception("Unimplemented")
 
-	@synchronized
+	def snapshot(self):
+		"Returns the last published snapshot of the instance state without taking the engine lock"
+
+		snapshot = self.__instance.snapshot
+		if snapshot is None:
+			self._acquire()
+			try:
+				snapshot = self.__instance.publish_snapshot()
+			finally:
+				self._release()
+		return snapshot
+
 	def to_element(self, e = None):
-		return self.__instance.to_element(e)
\ No newline at end of file
+		data = DataFactory.from_native(self.snapshot().data)
+		if e is None:
+			return data
+
+		e.merge(data)
+		return e
\ No newline at end of file
@@ -0,0 +1,210 @@
+###############################################################################
+#
+#    Copyright 2009-2011, Universitat Pompeu Fabra
+#
+#    This file is part of Wok.
+#
+#    Wok is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Wok is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses
+#
+###############################################################################
+
+import os
+import socket
+import subprocess
+import base64
+import time
+import multiprocessing as mp
+from threading import Thread, Lock
+
+from wok import logger
+from wok import exit_codes
+from wok.core.jobmgr.protocol import Channel, connect
+
+class WorkerDaemon(object):
+	"""
+	Worker of the workers job manager.
+
+	It connects to the job manager, advertises its slots and runs the tasks dispatched to it,
+	streaming their output and results back. When the connection is lost the running tasks
+	are killed and, unless reconnect is 0, it connects again after reconnect seconds.
+
+	* Configuration parameters:
+	- address: Address of the job manager as tcp://host:port or unix://path
+	- slots: Number of tasks to run at the same time. By default the number of cores
+	- name: Name of the worker. By default the host name
+	- reconnect: Seconds to wait before connecting again. By default 5
+	- log: Logger configuration
+	"""
+
+	def __init__(self, conf):
+		self._log = logger.get_logger(conf.get("log"), "wok-worker")
+
+		self._address = conf.get("address", "tcp://localhost:5800")
+		self._slots = conf.get("slots", mp.cpu_count(), dtype=int)
+		self._name = conf.get("name", "{}-{}".format(socket.gethostname(), os.getpid()))
+		self._reconnect = conf.get("reconnect", 5.0, dtype=float)
+
+		self._lock = Lock()
+		self._running = False
+		self._channel = None
+
+		# processes running by job id
+		self._processes = {}
+
+	def run(self):
+		self._running = True
+
+		while self._running:
+			try:
+				sock = connect(self._address)
+			except socket.error as e:
+				if self._reconnect <= 0:
+					raise
+				self._log.warn("Unable to connect to {}: {}".format(self._address, str(e)))
+				time.sleep(self._reconnect)
+				continue
+
+			with self._lock:
+				self._channel = Channel(sock)
+
+			try:
+				self._serve(self._channel)
+			finally:
+				self._disconnect()
+
+			if self._reconnect <= 0:
+				break
+
+			if self._running:
+				time.sleep(self._reconnect)
+
+	def stop(self):
+		self._running = False
+
+		with self._lock:
+			if self._channel is not None:
+				self._channel.close()
+
+	def _serve(self, channel):
+		channel.send("hello", name = self._name, slots = self._slots)
+
+		msg = channel.receive()
+		if msg is not None and msg.get("type") == "bye":
+			self._log.info("The job manager is closing")
+			return
+
+		if msg is None or msg.get("type") != "welcome":
+			self._log.error("Unexpected handshake from {}".format(self._address))
+			return
+
+		# the job manager is lost when several heartbeats are missed
+		channel.settimeout(3 * msg.get("heartbeat", 5.0))
+
+		self._log.info("Connected to {} as {} with {} slots".format(self._address, self._name, self._slots))
+
+		while True:
+			try:
+				msg = channel.receive()
+			except socket.timeout:
+				self._log.warn("The job manager has not sent heartbeats for a while")
+				break
+			except (socket.error, ValueError) as e:
+				self._log.warn("Failed receiving from the job manager: {}".format(str(e)))
+				break
+
+			if msg is None:
+				self._log.warn("The job manager closed the connection")
+				break
+
+			msg_type = msg.get("type")
+			if msg_type == "run":
+				thread = Thread(target = self._run_task, args = (channel, msg),
+								name = "task-{}".format(msg["job"]))
+				thread.daemon = True
+				thread.start()
+			elif msg_type == "heartbeat":
+				channel.send("heartbeat")
+			elif msg_type == "bye":
+				self._log.info("The job manager is closing")
+				break
+			else:
+				self._log.warn("Unexpected message from the job manager: {}".format(msg_type))
+
+	def _disconnect(self):
+		with self._lock:
+			self._channel.close()
+			self._channel = None
+
+			if len(self._processes) > 0:
+				self._log.warn("Killing {} running tasks".format(len(self._processes)))
+
+			for process in self._processes.values():
+				try:
+					process.terminate()
+				except OSError:
+					pass
+
+	def _run_task(self, channel, msg):
+		job_id = msg["job"]
+
+		self._log.debug("Running job [{}] ...".format(job_id))
+
+		start_time = time.time()
+
+		# json decodes strings as unicode but processes take byte strings
+		args = [arg.encode("utf-8") for arg in [msg["cmd"]] + msg["args"]]
+		env = msg.get("env")
+		if env is not None:
+			env = dict((k.encode("utf-8"), unicode(v).encode("utf-8")) for k, v in env.items())
+
+		try:
+			process = subprocess.Popen(
+								args = args,
+								stdin=None,
+								stdout=subprocess.PIPE,
+								stderr=subprocess.STDOUT,
+								cwd=msg.get("cwd"),
+								env=env,
+								close_fds=True)
+		except Exception as e:
+			self._log.exception(e)
+			channel.send("result", job = job_id, exit_code = exit_codes.EXEC_EXCEPTION,
+						exit_message = "Exception {}".format(str(e)),
+						start_time = start_time, end_time = time.time())
+			return
+
+		with self._lock:
+			self._processes[job_id] = process
+
+		channel.send("started", job = job_id, start_time = start_time)
+
+		try:
+			fd = process.stdout.fileno()
+			while True:
+				data = os.read(fd, 64 * 1024)
+				if len(data) == 0:
+					break
+				channel.send("output", job = job_id, data = base64.b64encode(data))
+
+			process.wait()
+		finally:
+			with self._lock:
+				del self._processes[job_id]
+
+		end_time = time.time()
+
+		self._log.debug("Job [{}] exited with code {}".format(job_id, process.returncode))
+
+		channel.send("result", job = job_id, exit_code = process.returncode,
+					start_time = start_time, end_time = end_time)
@@ -0,0 +1,428 @@
+###############################################################################
+#
+#    Copyright 2009-2011, Universitat Pompeu Fabra
+#
+#    This file is part of Wok.
+#
+#    Wok is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Wok is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses
+#
+###############################################################################
+
+from __future__ import absolute_import
+
+import os
+import os.path
+import re
+import shutil
+import time
+import pipes
+from threading import Thread, Lock, Condition
+from stat import S_IRUSR, S_IWUSR, S_IXUSR, S_IRGRP, S_IXGRP, S_IROTH, S_IXOTH
+
+from wok import exit_codes
+from wok.core import runstates
+from wok.core.jobmgr.base import JobManager, Job
+from wok.core.jobmgr.errors import UnknownJob
+
+# Runs the line of a commands file selected by the index of the array job.
+# Every line has the output file of the task followed by its command.
+_LAUNCHER = """#!/bin/sh
+index=${SGE_TASK_ID:-${SLURM_ARRAY_TASK_ID:-${PBS_ARRAYID:-${PBS_ARRAY_INDEX:-${LSB_JOBINDEX}}}}}
+line=$(sed -n "${index}p" "$1")
+if [ -z "$line" ]; then
+	echo "No task at index $index of $1" >&2
+	exit 1
+fi
+eval "set -- $line"
+output=$1
+shift
+exec "$@" >"$output" 2>&1
+"""
+
+class DrmaaJob(Job):
+	def __init__(self, job_id, task):
+		Job.__init__(self, job_id, task)
+
+		# (cmd, args, env) of the task
+		self.cmd = None
+
+		self.drmaa_id = None
+		self.array = None
+
+class _ArrayJob(object):
+	"The tasks of a module submitted together"
+
+	def __init__(self, name, commands_file):
+		self.name = name
+		self.commands_file = commands_file
+		self.pending = 0
+
+class DrmaaJobManager(JobManager):
+	"""
+	Job manager for DRMAA compatible resource managers (Sun Grid Engine, SLURM, Torque, ...).
+
+	The tasks of every module submitted at once are submitted as a single array job.
+	All the array jobs run the same launcher script, which takes the command of every
+	task from a commands file written per array job. Finished jobs are reaped in bulk by
+	a thread that polls the session every poll_interval seconds.
+
+	With fake enabled the jobs run in the local machine through a stand-in of the drmaa
+	module (see wok.core.jobmgr.fakedrmaa), so it can be tested without a cluster.
+	"""
+
+	def __init__(self, engine, conf):
+		JobManager.__init__(self, "drmaa", engine, conf)
+
+		self._fake = self.conf.get("fake.enabled", False, dtype=bool)
+		if self._fake:
+			from wok.core.jobmgr import fakedrmaa as drmaa
+		else:
+			import drmaa
+		self._drmaa = drmaa
+
+		self._shell_path = os.path.join(self._work_path, "sh")
+
+		self._working_directory = self.conf.get("working_directory")
+		if self._working_directory is not None:
+			self._working_directory = os.path.abspath(self._working_directory)
+
+		self._native_specification = self.conf.get("native_specification")
+		self._poll_interval = self.conf.get("poll_interval", 2.0, dtype=float)
+		self._autorm_sh = self.conf.get("auto_remove.sh", True, dtype=bool)
+
+		self._session = None
+		self._launcher = None
+
+		self._lock = Lock()
+		self._cvar = Condition(self._lock)
+
+		self._running = False
+		self._thread = None
+
+		self._jobs = {}
+
+		# jobs in the resource manager by drmaa id
+		self._drmaa_jobs = {}
+
+		# jobs submitted since the last poll, still to be notified as running
+		self._submitted = []
+
+		self._array_seq = 0
+
+	def start(self):
+		self._log.info("Starting job manager [{}] ...".format(self.name))
+
+		if self._fake:
+			self._session = self._drmaa.Session(slots = self.conf.get("fake.slots", dtype=int))
+		else:
+			self._session = self._drmaa.Session()
+		self._session.initialize()
+
+		sb = ["DRMAA initialized:\n"]
+		sb += ["\tSupported contact strings: {}\n".format(self._session.contact)]
+		sb += ["\tSupported DRM systems: {}\n".format(self._session.drmsInfo)]
+		sb += ["\tSupported DRMAA implementations: {}\n".format(self._session.drmaaImplementation)]
+		sb += ["\tVersion {}".format(self._session.version)]
+		self._log.debug("".join(sb))
+
+		for path in [self._shell_path, self._output_path]:
+			if not os.path.exists(path):
+				os.makedirs(path)
+
+		self._launcher = os.path.join(self._shell_path, "launcher.sh")
+		f = open(self._launcher, "w")
+		try:
+			f.write(_LAUNCHER)
+		finally:
+			f.close()
+		os.chmod(self._launcher, S_IRUSR | S_IWUSR | S_IXUSR | S_IRGRP | S_IXGRP | S_IROTH | S_IXOTH)
+
+		self._running = True
+
+		self._thread = Thread(target = self._poll, name = "{}-poll".format(self.name))
+		self._thread.start()
+
+	@staticmethod
+	def _command_line(output_file, cmd, args, env):
+		sb = [output_file]
+		if len(env) > 0:
+			sb += ["env"] + ["{}={}".format(k, v) for k, v in sorted(env.items())]
+		sb += [cmd] + args
+		return " ".join(pipes.quote(str(arg)) for arg in sb)
+
+	def _submit_array(self, module_id, jobs):
+		"Submits the jobs of a module as an array job. It must be called with the lock held."
+
+		self._array_seq += 1
+		name = re.sub(r"[^\w.-]", "_", "{}-{}".format(module_id, self._array_seq))
+		array = _ArrayJob(name, os.path.join(self._shell_path, "{}.cmd".format(name)))
+
+		lines = []
+		for job in jobs:
+			cmd, args, env = job.cmd
+			lines += [self._command_line(job.output_file, cmd, args, env)]
+
+		f = open(array.commands_file, "w")
+		try:
+			f.write("\n".join(lines) + "\n")
+		finally:
+			f.close()
+
+		jt = self._session.createJobTemplate()
+		try:
+			jt.jobName = name
+			jt.remoteCommand = self._launcher
+			jt.args = [array.commands_file]
+			# the launcher redirects the output of every task into its own file
+			jt.outputPath = ":" + os.devnull
+			jt.joinFiles = True
+			if self._working_directory is not None:
+				jt.workingDirectory = self._working_directory
+			if self._native_specification is not None:
+				jt.nativeSpecification = self._native_specification
+
+			drmaa_ids = self._session.runBulkJobs(jt, 1, len(jobs), 1)
+		finally:
+			self._session.deleteJobTemplate(jt)
+
+		for job, drmaa_id in zip(jobs, drmaa_ids):
+			job.drmaa_id = drmaa_id
+			job.array = array
+			self._drmaa_jobs[drmaa_id] = job
+		array.pending = len(jobs)
+
+		self._log.debug("Submitted {} tasks of {} as array job {}".format(len(jobs), module_id, name))
+
+	def submit(self, tasks):
+		jobs = []
+		for task in tasks:
+			job = DrmaaJob(None, task)
+			job.cmd = self._prepare_cmd(task)
+			jobs += [job]
+
+		job_ids = []
+		with self._lock:
+			# group the tasks by module keeping the submission order
+			modules = []
+			module_jobs = {}
+			for job in jobs:
+				job.id = self._next_id()
+				job.work_path = self._work_path
+				job.output_file = os.path.abspath(os.path.join(self._output_path, "{}.txt".format(job.task.id)))
+				job_ids += [job.id]
+				self._jobs[job.id] = job
+
+				module_id = job.task.parent.id
+				if module_id not in module_jobs:
+					modules += [module_id]
+					module_jobs[module_id] = [job]
+				else:
+					module_jobs[module_id] += [job]
+
+			for module_id in modules:
+				try:
+					self._submit_array(module_id, module_jobs[module_id])
+				except Exception as e:
+					self._log.exception(e)
+					for job in module_jobs[module_id]:
+						job.result.state = runstates.FAILED
+						job.result.exit_code = exit_codes.EXEC_EXCEPTION
+						job.result.exit_message = "Failed submitting the job: {}".format(str(e))
+						job.result.end_time = time.time()
+
+			self._submitted += jobs
+
+			# notify them as running or failed without waiting for the next poll
+			self._cvar.notify_all()
+
+		return job_ids
+
+	def _job_result(self, job, info):
+		result = job.result
+
+		usage = info.resourceUsage or {}
+		try:
+			result.start_time = float(usage.get("start_time", 0))
+			result.end_time = float(usage.get("end_time", 0))
+		except ValueError:
+			pass
+		if result.end_time == 0:
+			result.end_time = time.time()
+		if result.start_time == 0:
+			result.start_time = result.end_time
+
+		exit_code = exit_codes.UNKNOWN
+		sb = ["Task {} (job {})".format(job.task.id, job.drmaa_id)]
+		if info.wasAborted:
+			sb += [" was aborted"]
+			if info.hasCoreDump:
+				sb += [" with core dump"]
+		elif info.hasExited:
+			sb += [" has exited with code {}".format(info.exitStatus)]
+			exit_code = info.exitStatus
+		elif info.hasSignal:
+			sb += [" got signal {}".format(info.terminatedSignal)]
+		else:
+			sb += [" has finished unexpectedly"]
+
+		result.exit_code = exit_code
+		result.exit_message = "".join(sb)
+		result.state = runstates.FINISHED if exit_code == 0 else runstates.FAILED
+
+	def _reap(self):
+		"""Reaps all the jobs finished since the last call in a single pass.
+		It must be called with the lock held. Returns the finished jobs."""
+
+		finished = []
+		while len(self._drmaa_jobs) > 0:
+			try:
+				info = self._session.wait(self._drmaa.Session.JOB_IDS_SESSION_ANY,
+											self._drmaa.Session.TIMEOUT_NO_WAIT)
+			except (self._drmaa.ExitTimeoutException, self._drmaa.InvalidJobException):
+				break
+
+			job = self._drmaa_jobs.pop(info.jobId, None)
+			if job is None:
+				continue
+
+			try:
+				self._job_result(job, info)
+			except Exception as e:
+				self._log.exception(e)
+				job.result.state = runstates.FAILED
+				job.result.exit_code = exit_codes.EXCEPTION_WAITING
+				job.result.exit_message = "There was an exception while waiting for the job to finish: {}".format(e)
+
+			array = job.array
+			array.pending -= 1
+			if array.pending == 0 and self._autorm_sh and os.path.exists(array.commands_file):
+				os.remove(array.commands_file)
+
+			finished += [job]
+
+		return finished
+
+	def _poll(self):
+		while True:
+			with self._lock:
+				if not self._running:
+					break
+
+				submitted = self._submitted
+				self._submitted = []
+
+				try:
+					finished = self._reap()
+				except Exception as e:
+					self._log.exception(e)
+					finished = []
+
+			for job in submitted:
+				if job.result.state is None:
+					self._change_job_state(job, runstates.RUNNING)
+				else:
+					# it failed while submitting
+					finished += [job]
+
+			for job in finished:
+				self._change_job_state(job, job.result.state)
+
+			with self._lock:
+				self._cvar.notify_all()
+				if len(self._submitted) == 0:
+					self._cvar.wait(self._poll_interval)
+
+	def state(self, job_ids = None):
+		states = []
+		with self._lock:
+			if job_ids is None:
+				job_ids = self._jobs.keys()
+			elif not isinstance(job_ids, list):
+				job_ids = [job_ids]
+			for job_id in job_ids:
+				states += [(job_id, self._jobs[job_id].state)]
+		return states
+
+	def output(self, job_id):
+		with self._lock:
+			if job_id not in self._jobs:
+				raise UnknownJob(job_id)
+
+			job = self._jobs[job_id]
+			if not os.path.exists(job.output_file):
+				open(job.output_file, "w").close()
+			return open(job.output_file)
+
+	def join(self, job_id):
+		with self._lock:
+			if job_id not in self._jobs:
+				raise UnknownJob(job_id)
+
+			job = self._jobs[job_id]
+			while self._running and job.state not in [runstates.FINISHED, runstates.FAILED]:
+				self._cvar.wait(2)
+
+			del self._jobs[job_id]
+
+		return job.result
+
+	def join_all(self, job_ids = None):
+		with self._lock:
+			if job_ids is None:
+				job_ids = self._jobs.keys()
+
+			results = []
+			for job_id in job_ids:
+				# the rest of the batch has to be joined anyway
+				if job_id not in self._jobs:
+					self._log.warn("Skipping unknown job {} while joining".format(job_id))
+					continue
+
+				job = self._jobs[job_id]
+				while self._running and job.state not in [runstates.FINISHED, runstates.FAILED]:
+					self._cvar.wait(2)
+
+				del self._jobs[job_id]
+				results += [(job_id, job.result)]
+
+		return results
+
+	def close(self):
+		with self._lock:
+			self._log.info("Stopping job manager [{}] ...".format(self.name))
+
+			self._running = False
+			self._cvar.notify_all()
+
+		if self._thread is not None:
+			self._thread.join()
+
+		if self._session is not None:
+			with self._lock:
+				if len(self._drmaa_jobs) > 0:
+					self._log.warn("Terminating {} jobs".format(len(self._drmaa_jobs)))
+					try:
+						self._session.control(self._drmaa.Session.JOB_IDS_SESSION_ALL,
+												self._drmaa.JobControlAction.TERMINATE)
+					except self._drmaa.DrmaaException as e:
+						self._log.warn("Failed terminating the jobs: {}".format(str(e)))
+
+			self._session.exit()
+			self._session = None
+
+		if self._autorm_sh and os.path.exists(self._shell_path):
+			shutil.rmtree(self._shell_path, ignore_errors = True)
+
+		with self._lock:
+			self._log.info("[{}] stopped".format(self.name))
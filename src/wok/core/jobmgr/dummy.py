@@ -20,13 +20,35 @@
 ###############################################################################
 
 import time
-from random import random
-from Queue import PriorityQueue
+import math
+import heapq
+import random
+from StringIO import StringIO
+from Queue import PriorityQueue, Empty
 import multiprocessing as mp
 from threading import Thread, Lock, Condition
 
 from wok.core import runstates
+from wok.core.enginedb import SqliteEngineDB
 from wok.core.jobmgr.base import JobManager, Job
+from wok.core.jobmgr.errors import UnknownJob
+
+def _lognormal(mean, sigma, low, high):
+	if mean <= 0:
+		return 0.0
+	# parameters of the logarithm of the duration from its mean and standard deviation
+	s = math.sqrt(math.log(1.0 + (sigma / mean) ** 2))
+	mu = math.log(mean) - s * s / 2.0
+	return random.lognormvariate(mu, s)
+
+# functions drawing a duration from (mean, sigma, min, max)
+_DISTRIBUTIONS = {
+	"constant" : lambda mean, sigma, low, high: mean,
+	"uniform" : lambda mean, sigma, low, high: random.uniform(low, high),
+	"normal" : lambda mean, sigma, low, high: random.gauss(mean, sigma),
+	"exponential" : lambda mean, sigma, low, high: random.expovariate(1.0 / mean) if mean > 0 else 0.0,
+	"lognormal" : _lognormal
+}
 
 class DummyJob(Job):
 	def __init__(self, job_id, task):
@@ -34,17 +56,50 @@ class DummyJob(Job):
 
 
 class DummyJobManager(JobManager):
+	"""
+	Job manager that simulates the execution of the tasks without running them.
+
+	Every job takes a duration drawn from a distribution, or replayed from the journal
+	of a previous run, and fails with probability error_ratio. Jobs that finish write
+	as many records into their output partitions as they have in their inputs, or
+	records when the task has no inputs, so the downstream modules are partitioned
+	as if the tasks had really run. It is meant to test and benchmark the engine.
+
+	In simulation mode the durations are not waited for. A virtual clock advances from
+	one job end to the next once the engine has reacted to the previous one, so long
+	runs can be evaluated in a fraction of their real time.
+	"""
+
 	def __init__(self, engine, conf):
 		JobManager.__init__(self, "dummy", engine, conf)
 
 		self._num_cores = self.conf.get("max_cores", mp.cpu_count(), dtype=int)
 
-		self._delay = self.conf.get("delay", 1, dtype=int)
-		self._min_delay = self.conf.get("min_delay", self._delay, dtype=int)
-		self._max_delay = self.conf.get("max_delay", self._delay, dtype=int)
+		self._delay = self.conf.get("delay", 1, dtype=float)
+		self._min_delay = self.conf.get("min_delay", self._delay, dtype=float)
+		self._max_delay = self.conf.get("max_delay", self._delay, dtype=float)
 		self._max_delay = max(self._min_delay, self._max_delay)
 		self._tick = self.conf.get("tick", 0.2, dtype=float)
 		self._error_ratio = self.conf.get("error_ratio", 0, dtype=float)
+		self._records = self.conf.get("records", 0, dtype=int)
+
+		self._distribution = self.conf.get("duration.distribution", "uniform")
+		if self._distribution not in _DISTRIBUTIONS:
+			raise Exception("Unknown duration distribution: {}".format(self._distribution))
+		self._mean = self.conf.get("duration.mean", (self._min_delay + self._max_delay) / 2.0, dtype=float)
+		self._sigma = self.conf.get("duration.sigma", self._mean / 2.0, dtype=float)
+
+		self._replay = None
+		replay_path = self.conf.get("replay")
+		if replay_path is not None:
+			self._replay = SqliteEngineDB.recorded_tasks(replay_path)
+			self._log.info("Replaying the durations of {} tasks from {}".format(len(self._replay), replay_path))
+
+		self._simulation = self.conf.get("simulation", False, dtype=bool)
+
+		# virtual time elapsed since the start in simulation mode
+		self._clock = 0.0
+		self._clock_base = None
 
 		self._running = False
 		self._threads = []
@@ -55,44 +110,154 @@ class DummyJobManager(JobManager):
 		self._jobs = {}
 		
 		self._waiting_queue = PriorityQueue()
+		self._seq = 0
+
+	@property
+	def slots(self):
+		return self._num_cores
+
+	@property
+	def clock(self):
+		"Virtual seconds elapsed in simulation mode"
+
+		return self._clock
+
+	def _duration(self, task):
+		"Returns the tuple (duration, exit_code) of the simulated execution of a task"
+
+		if self._replay is not None:
+			recorded = self._replay.get((task.parent.id, task.index))
+			if recorded is not None:
+				return recorded
+
+		duration = _DISTRIBUTIONS[self._distribution](self._mean, self._sigma, self._min_delay, self._max_delay)
+		exit_code = 1 if random.random() < self._error_ratio else 0
+		return max(0.0, duration), exit_code
+
+	def _write_outputs(self, task):
+		"Writes the records of the simulated task into its output partitions"
+
+		if task.size is not None:
+			size = task.size
+		elif len(task.in_port_data) > 0:
+			size = task.in_port_data[0].size()
+		else:
+			size = self._records
+
+		if size <= 0:
+			return
+
+		for data in task.out_port_data:
+			writer = data.writer()
+			try:
+				writer.write(range(size))
+			finally:
+				writer.close()
+
+	def _finish(self, job, exit_code):
+		"Sets the result of a simulated job, it has to be called after setting result.end_time"
+
+		result = job.result
+
+		if exit_code is not None and exit_code != 0:
+			result.exit_code = exit_code
+			result.exit_message = "Simulated failure"
+			result.state = runstates.FAILED
+			return
+
+		try:
+			self._write_outputs(job.task)
+			result.state = runstates.FINISHED
+		except Exception as e:
+			result.exit_code = 1
+			result.exit_message = "Failed writing the outputs: {}".format(str(e))
+			result.state = runstates.FAILED
 
 	def _run(self):
 		while True:
-			job = self._waiting_queue.get()[1]
+			job = self._waiting_queue.get()[2]
 			if job is None:
 				break
 
 			result = job.result
 
-			delay = self._min_delay + (self._max_delay - self._min_delay) * random()
+			delay, exit_code = self._duration(job.task)
 
 			with self._run_lock:
 				self._log.debug("Simulating task [{}] {} for {:.1f} seconds ...".format(job.id, job.task.id, delay))
 
-			job.state = runstates.RUNNING
-
-			self.engine.notify()
+			self._change_job_state(job, runstates.RUNNING)
 
 			result.start_time = time.time()
 
-			tick = 0.2
 			while delay > 0 and self._running:
-				time.sleep(tick)
-				delay -= tick
-
-			if random() < self._error_ratio:
-				# TODO simulate an exception
-				pass
+				time.sleep(min(self._tick, delay))
+				delay -= self._tick
 
 			result.end_time = time.time()
 
-			result.state = job.state = runstates.FINISHED
-			
-			self.engine.notify()
-			
+			self._finish(job, exit_code)
+
+			self._change_job_state(job, result.state)
+
 			with self._run_lock:
 				self._log.debug("Finished task [{}] {} ...".format(job.id, job.task.id))
-				self._run_cvar.notify()
+				self._run_cvar.notify_all()
+
+	def _joined(self, job_ids):
+		with self._run_lock:
+			for job_id in job_ids:
+				if job_id in self._jobs:
+					self._run_cvar.wait(1)
+					return False
+		return True
+
+	def _simulate(self):
+		"""Runs the jobs on a virtual clock. Before advancing the clock to the end of the next job
+		it waits for the previous one to be joined and for the engine to be idle, so the jobs
+		released by it are started at the virtual time it finished."""
+
+		running = []
+		finished = []
+
+		while self._running:
+			if not self._joined(finished) or not self.engine.wait_idle(1):
+				continue
+
+			finished = []
+
+			# start the waiting jobs on the free cores
+			started = []
+			while len(running) < self._num_cores:
+				try:
+					job = self._waiting_queue.get_nowait()[2]
+				except Empty:
+					break
+
+				duration, exit_code = self._duration(job.task)
+				job.result.start_time = self._clock_base + self._clock
+				heapq.heappush(running, (self._clock + duration, job.id, job, exit_code))
+				started += [job]
+
+			for job in started:
+				self._change_job_state(job, runstates.RUNNING)
+
+			if len(running) == 0:
+				with self._run_lock:
+					if self._running and self._waiting_queue.empty():
+						self._run_cvar.wait(1)
+				continue
+
+			end_time, job_id, job, exit_code = heapq.heappop(running)
+
+			self._clock = end_time
+			job.result.end_time = self._clock_base + self._clock
+
+			self._finish(job, exit_code)
+
+			self._change_job_state(job, job.result.state)
+
+			finished = [job_id]
 
 	def start(self):
 		with self._run_lock:
@@ -100,6 +265,14 @@ class DummyJobManager(JobManager):
 
 		self._running = True
 
+		if self._simulation:
+			self._clock = 0.0
+			self._clock_base = time.time()
+			thread = Thread(target = self._simulate, name = "{}-sim".format(self.name))
+			self._threads.append(thread)
+			thread.start()
+			return
+
 		for i in xrange(self._num_cores):
 			thread = Thread(target = self._run, name = "{}-{:02}".format(self.name, i))
 			self._threads.append(thread)
@@ -113,8 +286,10 @@ class DummyJobManager(JobManager):
 				job_ids += [job_id]
 				job = DummyJob(job_id, task)
 				self._jobs[job_id] = job
-				priority = max(min(1 - task.priority, 1), 0)
-				self._waiting_queue.put((priority, job))
+				priority = (-task.rank, max(min(1 - task.priority, 1), 0))
+				self._waiting_queue.put((priority, self._seq, job))
+				self._seq += 1
+			self._run_cvar.notify_all()
 		return job_ids
 
 	def state(self, job_ids = None):
@@ -128,38 +303,68 @@ class DummyJobManager(JobManager):
 				states += [(job_id, self._jobs[job_id].state)]
 		return states
 
+	def output(self, job_id):
+		with self._run_lock:
+			if job_id not in self._jobs:
+				raise UnknownJob(job_id)
+
+		# simulated tasks don't write anything
+		return StringIO()
+
 	def join(self, job_id):
 		with self._run_lock:
 			if job_id not in self._jobs:
 				raise UnknownJob(job_id)
 
 			job = self._jobs[job_id]
-			while self._running and job.state not in [runstates.FINISHED, runstates.FINISHED]:
-				self._run_cvar.wait(4)
+			while self._running and job.state not in [runstates.FINISHED, runstates.FAILED]:
+				self._run_cvar.wait(2)
+
+			del self._jobs[job_id]
+
+			# the simulation waits for the jobs to be joined
+			self._run_cvar.notify_all()
+
+		return job.result
 
 	def join_all(self, job_ids = None):
 		with self._run_lock:
 			if job_ids is None:
 				job_ids = self._jobs.keys()
 
+			results = []
 			for job_id in job_ids:
+				# the rest of the batch has to be joined anyway
 				if job_id not in self._jobs:
-					raise UnknownJob(job_id)
+					self._log.warn("Skipping unknown job {} while joining".format(job_id))
+					continue
 
 				job = self._jobs[job_id]
-				while self._running and job.state not in [runstates.FINISHED, runstates.FINISHED]:
-					self._run_cvar.wait(4)
+				while self._running and job.state not in [runstates.FINISHED, runstates.FAILED]:
+					self._run_cvar.wait(2)
 
-	def stop(self):
+				del self._jobs[job_id]
+				results += [(job_id, job.result)]
+
+			# the simulation waits for the jobs to be joined
+			self._run_cvar.notify_all()
+
+		return results
+
+	def close(self):
 		with self._run_lock:
 			self._log.info("Stopping {} scheduler ...".format(self.name))
 
 			self._running = False
 
-			self._run_cvar.notify()
+			self._run_cvar.notify_all()
 
-		for i in xrange(self._num_cores):
-			self._waiting_queue.put((0, None))
+		for thread in self._threads:
+			self._waiting_queue.put((-1, 0, None))
 
 		for thread in self._threads:
 			thread.join()
+
+		if self._simulation:
+			with self._run_lock:
+				self._log.info("Simulated {:.1f} seconds of virtual time".format(self._clock))
@@ -21,13 +21,15 @@
 
 from wok.core.jobmgr.errors import *
 from wok.core.jobmgr.dummy import DummyJobManager
-#from wok.core.jobmgr.drmaa import DrmaaJobManager
+from wok.core.jobmgr.drmaa import DrmaaJobManager
 from wok.core.jobmgr.mcore import McoreJobManager
+from wok.core.jobmgr.workers import WorkersJobManager
 
 JOB_MANAGERS = {
 	"dummy" : DummyJobManager,
-#	"drmaa" : DrmaaJobManager,
-	"mcore" : McoreJobManager
+	"drmaa" : DrmaaJobManager,
+	"mcore" : McoreJobManager,
+	"workers" : WorkersJobManager
 }
 
 def create_job_manager(name, engine, conf):
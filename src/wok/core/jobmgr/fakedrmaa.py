@@ -0,0 +1,359 @@
+###############################################################################
+#
+#    Copyright 2009-2011, Universitat Pompeu Fabra
+#
+#    This file is part of Wok.
+#
+#    Wok is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Wok is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses
+#
+###############################################################################
+
+"""
+Stand-in for the drmaa module that runs the jobs in the local machine.
+
+It implements the part of the DRMAA session API used by the drmaa job manager, so the
+whole path can be tested without a cluster. Jobs run in a local queue of slots workers
+with the environment variable SGE_TASK_ID set to the index of the bulk jobs, as in
+Sun Grid Engine.
+"""
+
+import os
+import subprocess
+import time
+import multiprocessing as mp
+from collections import namedtuple
+from threading import Thread, Lock, Condition
+
+class DrmaaException(Exception):
+	pass
+
+class ExitTimeoutException(DrmaaException):
+	pass
+
+class InvalidJobException(DrmaaException):
+	pass
+
+class NoActiveSessionException(DrmaaException):
+	pass
+
+class JobState(object):
+	UNDETERMINED = "undetermined"
+	QUEUED_ACTIVE = "queued_active"
+	RUNNING = "running"
+	DONE = "done"
+	FAILED = "failed"
+
+class JobControlAction(object):
+	SUSPEND = "suspend"
+	RESUME = "resume"
+	HOLD = "hold"
+	RELEASE = "release"
+	TERMINATE = "terminate"
+
+JobInfo = namedtuple("JobInfo", ["jobId", "hasExited", "hasSignal", "terminatedSignal",
+								"hasCoreDump", "wasAborted", "exitStatus", "resourceUsage"])
+
+class JobTemplate(object):
+	PARAMETRIC_INDEX = "$drmaa_incr_ph$"
+	HOME_DIRECTORY = "$drmaa_hd_ph$"
+	WORKING_DIRECTORY = "$drmaa_wd_ph$"
+
+	def __init__(self):
+		self.jobName = None
+		self.remoteCommand = None
+		self.args = []
+		self.jobEnvironment = {}
+		self.workingDirectory = None
+		self.outputPath = None
+		self.errorPath = None
+		self.joinFiles = False
+		self.nativeSpecification = None
+
+class _FakeJob(object):
+	def __init__(self, job_id, index, jt):
+		self.id = job_id
+		self.index = index
+
+		# the template can be changed or deleted once the job is submitted
+		self.command = [jt.remoteCommand] + list(jt.args or [])
+		self.env = dict(jt.jobEnvironment or {})
+		self.cwd = jt.workingDirectory
+		self.output_path = jt.outputPath
+		self.error_path = jt.errorPath
+		self.join_files = jt.joinFiles
+
+		self.state = JobState.QUEUED_ACTIVE
+		self.process = None
+		self.aborted = False
+		self.start_time = None
+		self.end_time = None
+		self.returncode = None
+
+	def path(self, path):
+		"Removes the host from a path and replaces the placeholders"
+
+		if path is None:
+			return None
+		if ":" in path:
+			path = path.split(":", 1)[1]
+		cwd = self.cwd or os.getcwd()
+		return path.replace(JobTemplate.PARAMETRIC_INDEX, str(self.index)) \
+					.replace(JobTemplate.WORKING_DIRECTORY, cwd) \
+					.replace(JobTemplate.HOME_DIRECTORY, os.path.expanduser("~"))
+
+class Session(object):
+	TIMEOUT_WAIT_FOREVER = -1
+	TIMEOUT_NO_WAIT = 0
+
+	JOB_IDS_SESSION_ANY = "DRMAA_JOB_IDS_SESSION_ANY"
+	JOB_IDS_SESSION_ALL = "DRMAA_JOB_IDS_SESSION_ALL"
+
+	def __init__(self, contactString = None, slots = None):
+		self.contact = contactString or "local"
+		self.drmsInfo = "wok fake DRM"
+		self.drmaaImplementation = "wok.core.jobmgr.fakedrmaa"
+		self.version = (1, 0)
+
+		self._slots = slots or mp.cpu_count()
+
+		self._lock = Lock()
+		self._cvar = Condition(self._lock)
+
+		self._active = False
+		self._threads = []
+		self._next_id = 1
+
+		# jobs not reaped yet by id and queued jobs in submission order
+		self._jobs = {}
+		self._queue = []
+
+	def initialize(self, contactString = None):
+		if contactString is not None:
+			self.contact = contactString
+
+		self._active = True
+		for i in xrange(self._slots):
+			thread = Thread(target = self._run, name = "fakedrmaa-{:02}".format(i))
+			thread.daemon = True
+			self._threads.append(thread)
+			thread.start()
+
+	def exit(self):
+		with self._lock:
+			if not self._active:
+				raise NoActiveSessionException()
+			self._active = False
+			self._terminate(self._jobs.values())
+			self._cvar.notify_all()
+
+		for thread in self._threads:
+			thread.join()
+		self._threads = []
+
+	def _check_active(self):
+		if not self._active:
+			raise NoActiveSessionException()
+
+	def createJobTemplate(self):
+		self._check_active()
+		return JobTemplate()
+
+	def deleteJobTemplate(self, jt):
+		pass
+
+	def runJob(self, jt):
+		with self._lock:
+			self._check_active()
+			job_id = str(self._next_id)
+			self._next_id += 1
+			self._submit([_FakeJob(job_id, 1, jt)])
+		return job_id
+
+	def runBulkJobs(self, jt, beginIndex, endIndex, step):
+		with self._lock:
+			self._check_active()
+			array_id = self._next_id
+			self._next_id += 1
+			jobs = [_FakeJob("{}.{}".format(array_id, index), index, jt)
+					for index in xrange(beginIndex, endIndex + 1, step)]
+			self._submit(jobs)
+		return [job.id for job in jobs]
+
+	def _submit(self, jobs):
+		for job in jobs:
+			self._jobs[job.id] = job
+		self._queue.extend(jobs)
+		self._cvar.notify_all()
+
+	def _job(self, job_id):
+		if job_id not in self._jobs:
+			raise InvalidJobException("Unknown job: {}".format(job_id))
+		return self._jobs[job_id]
+
+	def jobStatus(self, jobId):
+		with self._lock:
+			self._check_active()
+			return self._job(jobId).state
+
+	def control(self, jobId, action):
+		if action != JobControlAction.TERMINATE:
+			raise DrmaaException("Unsupported action: {}".format(action))
+
+		with self._lock:
+			self._check_active()
+			if jobId == self.JOB_IDS_SESSION_ALL:
+				self._terminate(self._jobs.values())
+			else:
+				self._terminate([self._job(jobId)])
+
+	def _terminate(self, jobs):
+		for job in jobs:
+			if job.state == JobState.QUEUED_ACTIVE:
+				self._queue.remove(job)
+				job.state = JobState.FAILED
+				job.aborted = True
+			elif job.state == JobState.RUNNING and job.process is not None:
+				try:
+					job.process.terminate()
+				except OSError:
+					pass
+		self._cvar.notify_all()
+
+	def _finished(self, job):
+		return job.state in [JobState.DONE, JobState.FAILED]
+
+	def _deadline(self, timeout):
+		if timeout == self.TIMEOUT_WAIT_FOREVER:
+			return None
+		return time.time() + timeout
+
+	def _wait_until(self, condition, deadline):
+		"Waits with the lock held until condition() is true or raises ExitTimeoutException"
+
+		while not condition():
+			self._check_active()
+			if deadline is None:
+				self._cvar.wait(1)
+			else:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					raise ExitTimeoutException()
+				self._cvar.wait(min(remaining, 1))
+
+	def synchronize(self, jobIds, timeout = TIMEOUT_WAIT_FOREVER, dispose = False):
+		with self._lock:
+			self._check_active()
+			if self.JOB_IDS_SESSION_ALL in jobIds:
+				jobs = self._jobs.values()
+			else:
+				jobs = [self._job(job_id) for job_id in jobIds]
+
+			self._wait_until(lambda: all(self._finished(job) for job in jobs), self._deadline(timeout))
+
+			if dispose:
+				for job in jobs:
+					del self._jobs[job.id]
+
+	def wait(self, jobId, timeout = TIMEOUT_WAIT_FOREVER):
+		"Waits for a job, or any when jobId is JOB_IDS_SESSION_ANY, to finish and reaps it"
+
+		with self._lock:
+			self._check_active()
+
+			if jobId == self.JOB_IDS_SESSION_ANY:
+				if len(self._jobs) == 0:
+					raise InvalidJobException("No jobs left in the session")
+				found = []
+				def condition():
+					for job in self._jobs.itervalues():
+						if self._finished(job):
+							found.append(job)
+							return True
+					return False
+				self._wait_until(condition, self._deadline(timeout))
+				job = found[0]
+			else:
+				job = self._job(jobId)
+				self._wait_until(lambda: self._finished(job), self._deadline(timeout))
+
+			del self._jobs[job.id]
+
+		returncode = job.returncode
+		has_signal = returncode is not None and returncode < 0
+		return JobInfo(
+			jobId = job.id,
+			hasExited = returncode is not None and returncode >= 0,
+			hasSignal = has_signal,
+			terminatedSignal = str(-returncode) if has_signal else None,
+			hasCoreDump = False,
+			wasAborted = job.aborted,
+			exitStatus = returncode if returncode is not None and returncode >= 0 else 0,
+			resourceUsage = dict(
+				start_time = str(job.start_time or 0),
+				end_time = str(job.end_time or 0)))
+
+	def _run(self):
+		while True:
+			with self._lock:
+				while self._active and len(self._queue) == 0:
+					self._cvar.wait(1)
+				if not self._active:
+					break
+				job = self._queue.pop(0)
+				job.state = JobState.RUNNING
+				job.start_time = time.time()
+
+			self._execute(job)
+
+			with self._lock:
+				job.end_time = time.time()
+				if job.returncode == 0:
+					job.state = JobState.DONE
+				else:
+					job.state = JobState.FAILED
+				self._cvar.notify_all()
+
+	def _execute(self, job):
+		env = dict(os.environ)
+		env.update(job.env)
+		env["SGE_TASK_ID"] = str(job.index)
+		env["JOB_ID"] = job.id.split(".")[0]
+
+		output_path = job.path(job.output_path) or os.devnull
+		error_path = job.path(job.error_path) or os.devnull
+
+		output = error = None
+		try:
+			output = open(output_path, "w")
+			if job.join_files:
+				stderr = subprocess.STDOUT
+			else:
+				error = open(error_path, "w")
+				stderr = error
+
+			process = subprocess.Popen(job.command, stdin=None, stdout=output, stderr=stderr,
+									cwd=job.cwd, env=env, close_fds=True)
+			with self._lock:
+				job.process = process
+				if not self._active:
+					process.terminate()
+			job.returncode = process.wait()
+		except (IOError, OSError):
+			job.aborted = True
+			job.returncode = None
+		finally:
+			job.process = None
+			for f in [output, error]:
+				if f is not None:
+					f.close()
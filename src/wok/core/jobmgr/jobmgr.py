@@ -79,6 +79,20 @@ class JobManager(object):
 
 		return cmd, args, env
 
+	def _change_job_state(self, job, state):
+		"""Changes the state of a job and notifies the engine with a state change event.
+		It should be called without holding any job manager lock."""
+
+		prev_state = job.state
+		job.state = state
+		self.engine.notify(JobStateChange(job.id, prev_state, state, job.result))
+
+	@property
+	def slots(self):
+		"Number of jobs that can run at the same time or None if unknown."
+
+		return None
+
 	def start(self):
 		"Start the job manager."
 
@@ -100,13 +114,19 @@ class JobManager(object):
 
 		raise Exception("Abstract method unimplemented")
 
+	def output_attempt(self, job_id):
+		"""Returns the attempt of a job which output is returned by output(job_id), or None if jobs
+		have a single attempt. Then output(job_id, attempt) returns the output of an attempt."""
+
+		return None
+
 	def join(self, job_id):
 		"Retrieve the job results and delete the job from memory."
 
 		raise Exception("Abstract method unimplemented")
 
 	def join_all(self, job_ids = None):
-		"Retrieve the jobs results and delete them from memory."
+		"Retrieve the jobs results and delete them from memory. Unknown jobs are skipped."
 
 		raise Exception("Abstract method unimplemented")
 
@@ -114,6 +134,18 @@ class JobManager(object):
 		"Close the job manager and free resources."
 		raise Exception("Abstract method unimplemented")
 
+class JobStateChange(object):
+	"Represents a job state transition notified to the engine."
+
+	def __init__(self, job_id, prev_state, state, result = None):
+		self.job_id = job_id
+		self.prev_state = prev_state
+		self.state = state
+		self.result = result
+
+	def __str__(self):
+		return "{}: {} --> {}".format(self.job_id, self.prev_state, self.state)
+
 class JobResult(object):
 	"Represents the results of a job execution."
 
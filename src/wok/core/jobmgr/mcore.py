@@ -21,28 +21,340 @@
 
 import os
 import os.path
-from Queue import PriorityQueue, Empty
+import sys
+import re
+import heapq
+import fcntl
+import errno
+import shutil
 import multiprocessing as mp
+from StringIO import StringIO
 from threading import Thread, Lock, Condition
-import subprocess
 import tempfile
 import time
 
 from wok import exit_codes
+from wok.element import DataElement
 from wok.core import runstates
-from wok.core.jobmgr.base import JobManager, Job
+from wok.core.metrics import get_metrics, timed
+from wok.core.jobmgr.base import JobManager, Job, JobResult
+from wok.core.jobmgr.errors import UnknownJob
+from wok.core.jobmgr.runners import ProcessRunner, PoolRunner, ZygoteRunner
+from wok.core.jobmgr.segments import SegmentLog
+from wok.core.portio.pathdata import PathData
+
+_metrics = get_metrics()
+_SUBMIT_TIME = _metrics.timer("wok_mcore_submit_seconds", "Time spent submitting tasks to the mcore job manager")
+_WAITING_JOBS = _metrics.gauge("wok_mcore_waiting_jobs", "Jobs waiting for free resources")
+_FREE_CORES = _metrics.gauge("wok_mcore_free_cores", "Cores not allocated to running jobs")
+_AVAILABLE_MEMORY = _metrics.gauge("wok_mcore_available_memory_bytes", "Memory available in the machine for new processes")
+
+_MEMORY_UNITS = {
+	"" : 1,
+	"K" : 1024,
+	"M" : 1024 ** 2,
+	"G" : 1024 ** 3,
+	"T" : 1024 ** 4
+}
+
+def parse_memory(value):
+	"Parses a memory size in bytes with an optional unit suffix (K, M, G, T). Example: 512M"
+
+	m = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$", str(value), re.IGNORECASE)
+	if m is None:
+		raise Exception("Invalid memory size: {}".format(value))
+
+	return long(float(m.group(1)) * _MEMORY_UNITS[m.group(2).upper()])
+
+def module_names(value):
+	"Parses a list of python modules given either as a list or as a string separated by commas or spaces"
+
+	if value is None:
+		return []
+	if isinstance(value, basestring):
+		return [name for name in re.split(r"[\s,]+", value) if len(name) > 0]
+	return [str(name) for name in value]
+
+def physical_memory():
+	"Returns the physical memory of the machine in bytes"
+
+	try:
+		return long(os.sysconf("SC_PAGE_SIZE")) * os.sysconf("SC_PHYS_PAGES")
+	except (ValueError, OSError, AttributeError):
+		return sys.maxint
+
+def available_memory():
+	"Returns the memory available in the machine for new processes in bytes or None if unknown"
+
+	try:
+		f = open("/proc/meminfo")
+		try:
+			info = {}
+			for line in f:
+				fields = line.split()
+				if len(fields) >= 2:
+					info[fields[0].rstrip(":")] = long(fields[1]) * 1024
+		finally:
+			f.close()
+	except (IOError, ValueError):
+		return None
+
+	if "MemAvailable" in info:
+		return info["MemAvailable"]
+
+	# kernels older than 3.14 don't estimate it
+	if "MemFree" in info:
+		return info["MemFree"] + info.get("Buffers", 0) + info.get("Cached", 0)
+
+	return None
+
+def process_rss(pid):
+	"Returns the resident memory of a process in bytes or None if unknown"
+
+	try:
+		f = open("/proc/{}/statm".format(pid))
+		try:
+			return long(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+		finally:
+			f.close()
+	except (IOError, ValueError, IndexError, OSError):
+		return None
 
 class McoreJob(Job):
 	def __init__(self, job_id, task):
 		Job.__init__(self, job_id, task)
 
+		# attempts currently running
+		self.attempts = []
+		self.num_attempts = 0
+
+		# every attempt by number, to read its output, and the one which output is the job output
+		self.attempts_by_number = {}
+		self.output_attempt = 0
+
+		# whether an attempt has already finished and its result was taken
+		self.committed = False
+
+		# resources required by every attempt
+		self.cpu = 1
+		self.memory = 0
+
+		# times lower priority jobs have been run ahead of it while it was the first waiting
+		self.skips = 0
+
+		# output of the attempt committed or running when it is captured through pipes
+		self.capture = None
+
+class McoreAttempt(object):
+	"An execution of the task of a job. Several attempts run at once when the job is speculated."
+
+	def __init__(self, job, number):
+		self.job = job
+		self.number = number
+		self.process = None
+		self.start_time = time.time()
+		self.output_name = None
+		self.output_file = None
+		self.capture = None
+		self.cancelled = False
+		self.result = JobResult()
+
+		# whether the resources of the job are allocated for this attempt
+		self.allocated = False
+
+		# resident memory of its process when last sampled and the maximum sampled
+		self.rss = 0
+		self.peak_rss = 0
+
+class _OutputCapture(object):
+	"""Output of an attempt read from a named pipe by a thread. It is kept in memory up to
+	memory_limit bytes and appended in blocks to the segment log of its instance."""
+
+	def __init__(self, log, name, fifo, memory_limit, block_size = 64 * 1024):
+		self._log = log
+		self._name = name
+		self._fifo = fifo
+		self._memory_limit = memory_limit
+		self._block_size = block_size
+
+		self._lock = Lock()
+		self._thread = None
+
+		self._memory = []
+		self._memory_size = 0
+		# whether it outgrew the memory limit and has to be read from the segment log
+		self._spilled = False
+
+		# data not appended to the log yet
+		self._pending = []
+		self._pending_size = 0
+
+	def start(self, fd):
+		self._thread = Thread(target = self._read, args = (fd,), name = "capture-{}".format(self._name))
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _read(self, fd):
+		try:
+			while True:
+				try:
+					data = os.read(fd, self._block_size)
+				except OSError as e:
+					if e.errno == errno.EINTR:
+						continue
+					raise
+				if len(data) == 0:
+					break
+				self._write(data)
+		finally:
+			os.close(fd)
+			self.flush()
+
+	def _write(self, data):
+		with self._lock:
+			if not self._spilled:
+				self._memory += [data]
+				self._memory_size += len(data)
+				if self._memory_size > self._memory_limit:
+					self._spilled = True
+					self._memory = []
+
+			self._pending += [data]
+			self._pending_size += len(data)
+			if self._pending_size >= self._block_size:
+				self._flush()
+
+	def _flush(self):
+		if self._pending_size > 0:
+			self._log.append(self._name, "".join(self._pending))
+			self._pending = []
+			self._pending_size = 0
+
+	def flush(self):
+		with self._lock:
+			self._flush()
+
+	def join(self):
+		"Waits until all the output is read, once every writer closed the pipe"
+
+		if self._thread is not None:
+			self._thread.join()
+		try:
+			os.remove(self._fifo)
+		except OSError:
+			pass
+
+	def open(self):
+		"Returns a file with the output captured so far"
+
+		with self._lock:
+			if not self._spilled:
+				return StringIO("".join(self._memory))
+			self._flush()
+
+		return StringIO(self._log.read(self._name))
 
 class McoreJobManager(JobManager):
+	"""
+	Multi-core job manager.
+
+	Tasks are placed according to the cpu and memory declared in the resources of their
+	modules, so a task never runs unless there are enough free cores and memory for it.
+	The highest priority task that fits in the free resources is the next one to run.
+
+	When speculation is enabled, jobs that run for more than factor times the median
+	duration of the finished jobs of the same module are executed again by the idle cores.
+	Every attempt writes into private partition files, the first attempt to finish
+	successfully commits its outputs and the rest are killed.
+
+	With admission enabled, the memory available in the machine and the resident memory
+	of the running tasks are sampled every interval seconds. A task is held back unless
+	the memory available, minus what the running tasks are still expected to grow and
+	min_free, leaves room for the peak resident memory observed in the last tasks of its
+	module. There is always at least one task running.
+
+	The output of the tasks is written into a file per task unless output capture is pipe.
+	Then it is read through a named pipe, kept in memory for the engine to ingest it and
+	appended to a segment log per instance (see SegmentLog) instead.
+
+	Tasks run in a new process each unless the runner is pool, then python tasks
+	run in persistent worker interpreters with wok preloaded, or zygote, then they
+	run in a child forked from a warm interpreter. Modules can choose their runner
+	and the modules to preload in their execution configuration.
+	"""
+
 	def __init__(self, engine, conf):
 		JobManager.__init__(self, "mcore", engine, conf)
 
 		self._num_cores = self.conf.get("max_cores", mp.cpu_count(), dtype=int)
 
+		max_memory = self.conf.get("max_memory")
+		if max_memory is not None:
+			self._max_memory = parse_memory(max_memory)
+		else:
+			self._max_memory = physical_memory()
+
+		self._free_cores = self._num_cores
+		self._free_memory = self._max_memory
+
+		self._speculation = self.conf.get("speculation.enabled", False, dtype=bool)
+		self._spec_factor = self.conf.get("speculation.factor", 2.0, dtype=float)
+		self._spec_min_samples = self.conf.get("speculation.min_samples", 3, dtype=int)
+		self._spec_max_attempts = self.conf.get("speculation.max_attempts", 2, dtype=int)
+
+		self._max_skips = self.conf.get("backfill.max_skips", 10, dtype=int)
+
+		self._admission = self.conf.get("admission.enabled", False, dtype=bool)
+		self._sample_interval = self.conf.get("admission.interval", 1.0, dtype=float)
+		min_free = self.conf.get("admission.min_free")
+		if min_free is not None:
+			self._min_free = parse_memory(min_free)
+		else:
+			self._min_free = physical_memory() / 10
+
+		if self._admission and available_memory() is None:
+			self._log.warn("The available memory can not be sampled, admission control disabled")
+			self._admission = False
+
+		# last available memory sampled and whether tasks are being held back
+		self._available_memory = None
+		self._holding = False
+
+		capture = self.conf.get("output.capture", "file")
+		if capture not in ["file", "pipe"]:
+			raise Exception("Unknown output capture: {}".format(capture))
+		self._capture = capture == "pipe"
+		self._segment_size = parse_memory(self.conf.get("output.segment_size", "64M"))
+		self._capture_memory = parse_memory(self.conf.get("output.memory_limit", "1M"))
+
+		# segment logs by instance name
+		self._segment_logs = {}
+
+		# where the named pipes are created
+		self._fifo_path = None
+		if self._capture:
+			self._fifo_path = tempfile.mkdtemp(prefix = "wok-mcore-")
+
+		self._runner = self.conf.get("runner", "process")
+
+		max_worker_memory = self.conf.get("pool.max_memory")
+		if max_worker_memory is not None:
+			max_worker_memory = parse_memory(max_worker_memory)
+
+		self._runners = {
+			"process" : ProcessRunner(),
+			"pool" : PoolRunner(
+				max_tasks = self.conf.get("pool.max_tasks", 100, dtype=int),
+				max_memory = max_worker_memory,
+				preload = module_names(self.conf.get("pool.preload")),
+				log = self._log),
+			"zygote" : ZygoteRunner(
+				preload = module_names(self.conf.get("zygote.preload")),
+				log = self._log) }
+
+		if self._runner not in self._runners:
+			raise Exception("Unknown runner: {}".format(self._runner))
+
 		self._running = False
 		self._kill_threads = False
 		self._threads = []
@@ -50,128 +362,540 @@ class McoreJobManager(JobManager):
 		self._run_lock = Lock()
 		self._run_cvar = Condition(self._run_lock)
 
+		# notified when jobs are submitted or resources released
+		self._sched_cvar = Condition(self._run_lock)
+
+		# only notified when closing, so memory is sampled at a regular pace
+		self._sample_cvar = Condition(self._run_lock)
+
 		self._jobs = {}
 
-		self._waiting_queue = PriorityQueue()
+		# heap of ((-rank, priority), seq, job) for the jobs waiting to run
+		self._waiting = []
+		self._seq = 0
 
 		self._task_output_files = {}
 
+		# durations of the last finished jobs by module id
+		self._durations = {}
+
+		# attempts with their resources allocated
+		self._allocated = set()
+
+		# peak resident memory of the last finished jobs by module id
+		self._peak_rss = {}
+
+	@property
+	def slots(self):
+		return self._num_cores
+
 	def _next_job(self):
-		element = None
-		while element is None:
-			try:
-				element = self._waiting_queue.get(timeout=1)
-			except Empty:
-				element = None
+		"Returns the next (job, attempt) to run or None when the thread has to finish"
+
+		with self._run_lock:
+			while self._running:
+				job = self._pop_fitting_job()
+				if job is not None:
+					attempt = self._new_attempt(job)
+					self._allocate(attempt)
+					return job, attempt
+
+				# there may be idle cores, look for stragglers
+				if self._speculation and len(self._waiting) == 0:
+					attempt = self._speculate()
+					if attempt is not None:
+						self._allocate(attempt)
+						return attempt.job, attempt
+
+				self._sched_cvar.wait(1)
+
+		return None
+
+	def _fits(self, job):
+		return job.cpu <= self._free_cores and job.memory <= self._free_memory and self._admits(job)
+
+	def _expected_memory(self, job):
+		"Returns the memory a job is expected to use from its declared memory and the peaks of its module"
+
+		peaks = self._peak_rss.get(job.task.parent.id)
+		if peaks is None:
+			return job.memory
+		return max(job.memory, max(peaks))
+
+	def _admits(self, job):
+		"Whether the available memory leaves room for a job, according to the last sample"
+
+		if not self._admission or self._available_memory is None or len(self._allocated) == 0:
+			return True
+
+		# memory the running tasks are expected to take yet
+		growth = 0
+		for attempt in self._allocated:
+			growth += max(0, self._expected_memory(attempt.job) - attempt.rss)
+
+		headroom = self._available_memory - growth - self._min_free
+		if self._expected_memory(job) <= headroom:
+			self._holding = False
+			return True
+
+		if not self._holding:
+			self._log.info("Holding back tasks, {} bytes available and {} expected to be taken by the running tasks".format(
+							self._available_memory, growth))
+			self._holding = True
+
+		return False
+
+	def _sample_memory(self):
+		"Samples the available memory and the resident memory of the running tasks"
+
+		while True:
+			with self._run_lock:
+				if not self._running:
+					break
+				processes = [(attempt, attempt.process) for attempt in self._allocated
+								if attempt.process is not None]
+
+			available = available_memory()
+			samples = []
+			for attempt, process in processes:
+				pid = getattr(process, "pid", None)
+				if pid is not None:
+					samples += [(attempt, process_rss(pid))]
+
+			with self._run_lock:
+				self._available_memory = available
+				if available is not None:
+					_AVAILABLE_MEMORY.set(available)
+
+				for attempt, rss in samples:
+					if rss is not None:
+						attempt.rss = rss
+						attempt.peak_rss = max(attempt.peak_rss, rss)
+
+				# waiting jobs may fit now
+				self._sched_cvar.notify_all()
+
+				self._sample_cvar.wait(self._sample_interval)
+
+	def _pop_fitting_job(self):
+		"""Removes and returns the highest priority waiting job that fits in the free resources.
+		While the first waiting job doesn't fit lower priority jobs are run ahead of it, but once
+		that happened max_skips times the resources are reserved for it until it fits."""
+
+		if len(self._waiting) == 0:
+			return None
+
+		head = self._waiting[0][2]
+		if self._fits(head):
+			heapq.heappop(self._waiting)
+			return head
+
+		if head.skips >= self._max_skips:
+			return None
+
+		skipped = [heapq.heappop(self._waiting)]
+		job = None
+		while len(self._waiting) > 0:
+			element = heapq.heappop(self._waiting)
+			if self._fits(element[2]):
+				job = element[2]
+				break
+			skipped += [element]
+
+		for element in skipped:
+			heapq.heappush(self._waiting, element)
+
+		if job is not None:
+			head.skips += 1
+			if head.skips == self._max_skips:
+				self._log.debug("Reserving resources for task [{}] {}".format(head.id, head.task.id))
 
-		return element[1]
+		return job
+
+	def _allocate(self, attempt):
+		job = attempt.job
+		self._free_cores -= job.cpu
+		self._free_memory -= job.memory
+		attempt.allocated = True
+		self._allocated.add(attempt)
+
+		_WAITING_JOBS.set(len(self._waiting))
+		_FREE_CORES.set(self._free_cores)
+
+	def _release(self, attempt):
+		if not attempt.allocated:
+			return
+
+		job = attempt.job
+		self._free_cores += job.cpu
+		self._free_memory += job.memory
+		attempt.allocated = False
+		self._allocated.discard(attempt)
+
+		if attempt.peak_rss > 0:
+			module_id = job.task.parent.id
+			peaks = self._peak_rss.get(module_id)
+			if peaks is None:
+				peaks = self._peak_rss[module_id] = []
+			peaks += [attempt.peak_rss]
+			if len(peaks) > 20:
+				del peaks[0]
+
+		_FREE_CORES.set(self._free_cores)
+
+		self._sched_cvar.notify_all()
+
+	def _task_resources(self, task):
+		"Returns the cores and memory (in bytes) required by a task"
+
+		resources = task.parent.resources
+
+		cpu = resources.get("cpu", 1, dtype=int)
+		if cpu < 1:
+			cpu = 1
+		elif cpu > self._num_cores:
+			self._log.warn("Task {} requires {} cores but only {} are available".format(
+							task.id, cpu, self._num_cores))
+			cpu = self._num_cores
+
+		memory = resources.get("memory")
+		if memory is None:
+			memory = 0
+		else:
+			memory = parse_memory(memory)
+			if memory > self._max_memory:
+				self._log.warn("Task {} requires {} bytes of memory but only {} are available".format(
+								task.id, memory, self._max_memory))
+				memory = self._max_memory
+
+		return cpu, memory
+
+	def _task_runner(self, task):
+		"Returns the runner of a task and the modules it has to preload"
+
+		runner = self._runner
+		preload = []
+
+		execution = task.parent.execution
+		if execution is not None and isinstance(execution.conf, DataElement):
+			runner = execution.conf.get("runner", runner)
+			preload = module_names(execution.conf.get("preload"))
+
+		if runner not in self._runners:
+			self._log.warn("Unknown runner {} for task {}, running it in a new process".format(runner, task.id))
+			runner = "process"
+
+		return self._runners[runner], preload
+
+	def _new_attempt(self, job):
+		attempt = McoreAttempt(job, job.num_attempts)
+		job.num_attempts += 1
+		job.attempts += [attempt]
+		job.attempts_by_number[attempt.number] = attempt
+		return attempt
+
+	@staticmethod
+	def _speculable(task):
+		"Only tasks writing into path partitions can run several attempts at once"
+
+		for data in task.out_port_data:
+			if not isinstance(data, PathData):
+				return False
+		return True
+
+	def _median_duration(self, module_id):
+		durations = self._durations.get(module_id)
+		if durations is None or len(durations) < self._spec_min_samples:
+			return None
+
+		durations = sorted(durations)
+		return durations[len(durations) / 2]
+
+	def _speculate(self):
+		"Returns a new attempt for the first straggler job found or None"
+
+		now = time.time()
+		for job in self._jobs.values():
+			if job.state != runstates.RUNNING or job.committed or len(job.attempts) == 0 \
+					or job.num_attempts >= self._spec_max_attempts:
+				continue
+
+			median = self._median_duration(job.task.parent.id)
+			if median is None or now - job.attempts[-1].start_time <= self._spec_factor * median:
+				continue
+
+			if not self._fits(job):
+				continue
+
+			if not self._speculable(job.task):
+				continue
+
+			self._log.info("Speculating task [{}] {} after {:.1f} seconds (median {:.1f})".format(
+							job.id, job.task.id, now - job.attempts[-1].start_time, median))
+
+			return self._new_attempt(job)
+
+		return None
 
 	def _run(self):
 		while True:
-			job = self._next_job()
-			if job is None:
+			next_job = self._next_job()
+			if next_job is None:
 				break
 
-			task = job.task
-			task_id = task.id
-			
-			result = job.result
+			job, attempt = next_job
 
-			with self._run_lock:
+			try:
+				self._run_attempt(job, attempt)
+			finally:
+				with self._run_lock:
+					self._release(attempt)
+
+	def _run_attempt(self, job, attempt):
+		task = job.task
+		task_id = task.id
+
+		result = attempt.result
+
+		with self._run_lock:
+			if attempt.number == 0:
 				self._log.debug("Running task [{}] {} ...".format(job.id, job.task.id))
+			else:
+				self._log.debug("Running task [{}] {} (attempt {}) ...".format(job.id, job.task.id, attempt.number))
 
-			job.state = runstates.RUNNING
+		if attempt.number == 0:
+			self._change_job_state(job, runstates.RUNNING)
 
-			self.engine.notify()
+		# Prepare command
+		cmd, args, env = self._prepare_cmd(task)
 
-			# Prepare command
-			cmd, args, env = self._prepare_cmd(task)
+		# Every attempt writes into its own partition files while speculating
+		private_outputs = self._speculation and self._speculable(task)
+		if private_outputs:
+			args += ["-D", "attempt={}".format(attempt.number)]
 
-			# Run command
+		# Run command
 
-			if task_id not in self._task_output_files:
-				work_path = self.conf.get("work_path")
-				if work_path is not None:
-					work_path = os.path.abspath(work_path)
-				else:
-					work_path = tempfile.mkdtemp(prefix = "wok-" + task_id + "-")
+		if task_id not in self._task_output_files:
+			work_path = self.conf.get("work_path")
+			if work_path is not None:
+				work_path = os.path.abspath(work_path)
+			else:
+				work_path = tempfile.mkdtemp(prefix = "wok-" + task_id + "-")
 
-				default_output_path = os.path.join(work_path, "output")
-				if not os.path.exists(default_output_path):
-					os.makedirs(default_output_path)
+			default_output_path = os.path.join(work_path, "output")
+			if not os.path.exists(default_output_path):
+				os.makedirs(default_output_path)
 
-				output_path = self.conf.get("output_path", default_output_path)
-				output_file = os.path.abspath(os.path.join(
-								output_path, "{}.txt".format(task_id)))
+			output_path = self.conf.get("output_path", default_output_path)
+			if attempt.number == 0:
+				output_name = task_id
+			else:
+				output_name = "{}.{}".format(task_id, attempt.number)
+			attempt.output_name = output_name
 
+			if not self._capture:
+				output_file = os.path.abspath(os.path.join(output_path, output_name + ".txt"))
 				#self._task_output_files[task_id] = (work_path, output_file)
+				attempt.output_file = output_file
+
+			if attempt.number == 0:
 				job.work_path = work_path
-				job.output_file = output_file
+				job.output_file = attempt.output_file
 
-			#o = open(self._task_output_files[task_id][1], "a")
-			o = open(job.output_file, "w")
+		#o = open(self._task_output_files[task_id][1], "a")
+		if self._capture:
+			o = self._open_capture(job, attempt)
+		else:
+			o = open(attempt.output_file, "w")
 
-			cwd = self.conf.get("working_directory")
-			if cwd is not None:
-				cwd = os.path.abspath(cwd)
+		cwd = self.conf.get("working_directory")
+		if cwd is not None:
+			cwd = os.path.abspath(cwd)
 
-			args = [cmd] + args
+		args = [cmd] + args
 
-			result.start_time = time.time()
+		result.start_time = time.time()
 
-			try:
-				p = subprocess.Popen(
-									args = args,
-									stdin=None,
-									stdout=o,
-									stderr=subprocess.STDOUT,
-									cwd=cwd,
-									env=env)
-
-				while not self._kill_threads and p.poll() is None:
-					time.sleep(1)
-
-				if self._kill_threads:
-					p.terminate()
-					self._log.warn("Not waiting for Popen.terminate(). Should I do?")
-					o.close()
-					return
-
-				result.end_time = time.time()
-
-				if p.returncode == 0:
-					result.state = job.state = runstates.FINISHED
-				else:
-					result.state = job.state = runstates.FAILED
-				result.exit_code = p.returncode
-				result.exit_message = "Task exited with return code {}".format(result.exit_code)
-
-				#TODO take task results
+		try:
+			runner, preload = self._task_runner(task)
+			p = runner.start(args, o, cwd, env, preload)
 
-			except Exception as e:
-				result.end_time = time.time()
-
-				self._log.exception(e)
-				import traceback
-				result.state = job.state = runstates.FAILED
-				result.exit_code = exit_codes.EXEC_EXCEPTION
-				result.exit_message = "Exception {}".format(str(e))
-				result.exception_trace = traceback.format_exc()
-			finally:
-				o.close()
+			with self._run_lock:
+				attempt.process = p
+				# it may have been cancelled while starting
+				if attempt.cancelled or self._kill_threads:
+					self._terminate(p)
+
+			# block until the child exits, cancelling or closing terminate it
+			p.wait()
+
+			result.end_time = time.time()
+
+			with self._run_lock:
+				attempt.process = None
+				# the resources can be reused while the result is processed
+				self._release(attempt)
+
+			if self._kill_threads:
+				self._log.warn("Task [{}] {} killed while closing".format(job.id, task_id))
+				return
+
+			if p.returncode == 0:
+				result.state = runstates.FINISHED
+			else:
+				result.state = runstates.FAILED
+			result.exit_code = p.returncode
+			result.exit_message = "Task exited with return code {}".format(result.exit_code)
+
+			#TODO take task results
+
+		except Exception as e:
+			result.end_time = time.time()
 
+			self._log.exception(e)
+			import traceback
+			result.state = runstates.FAILED
+			result.exit_code = exit_codes.EXEC_EXCEPTION
+			result.exit_message = "Exception {}".format(str(e))
+			result.exception_trace = traceback.format_exc()
+		finally:
+			o.close()
+			if attempt.capture is not None:
+				attempt.capture.join()
+
+		with self._run_lock:
+			committed = self._attempt_finished(job, attempt, private_outputs)
+
+		if not committed:
+			return
+
+		self._change_job_state(job, result.state)
+
+		with self._run_lock:
+			if result.state == runstates.FINISHED:
+				self._log.debug("Task finished [{}] {}".format(job.id, job.task.id))
+			else:
+				sb = ["Task failed [{}] {}: {}".format(job.id, job.task.id, result.exit_message)]
+				if result.exception_trace is not None:
+					sb += ["\n", result.exception_trace]
+				self._log.error("".join(sb))
+
+			self._run_cvar.notify()
+
+	def _segment_log(self, instance_name):
+		with self._run_lock:
+			log = self._segment_logs.get(instance_name)
+			if log is None:
+				log = self._segment_logs[instance_name] = SegmentLog(
+						os.path.join(self._output_path, instance_name), self._segment_size)
+			return log
+
+	def _open_capture(self, job, attempt):
+		"""Creates a named pipe for the output of an attempt and starts reading it.
+		Returns the pipe opened for writing, runners either write into it or open it by name."""
+
+		fifo = os.path.join(self._fifo_path, "{}.{}".format(job.id, attempt.number))
+		os.mkfifo(fifo, 0600)
+
+		fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+
+		# opening it doesn't block as there is a reader already, and it keeps the pipe
+		# open until the attempt finishes, whenever the runner opens it
+		o = open(fifo, "w")
+
+		fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+
+		# the tasks of other attempts must not inherit them, or the reader
+		# wouldn't get the end of file until they finish too
+		for f in [fd, o.fileno()]:
+			fcntl.fcntl(f, fcntl.F_SETFD, fcntl.fcntl(f, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+		attempt.capture = _OutputCapture(self._segment_log(job.task.instance.name),
+								attempt.output_name, fifo, self._capture_memory)
+		attempt.capture.start(fd)
+
+		if attempt.number == 0:
 			with self._run_lock:
-				if result.state == runstates.FINISHED:
-					self._log.debug("Task finished [{}] {}".format(job.id, job.task.id))
-				else:
-					sb = ["Task failed [{}] {}: {}".format(job.id, job.task.id, result.exit_message)]
-					if result.exception_trace is not None:
-						sb += ["\n", result.exception_trace]
-					self._log.error("".join(sb))
+				job.capture = attempt.capture
+
+		return o
+
+	def _attempt_finished(self, job, attempt, private_outputs):
+		"""Decides whether the result of an attempt becomes the result of the job.
+		It must be called with the run lock held. Returns whether the attempt was committed."""
+
+		job.attempts.remove(attempt)
+		result = attempt.result
+
+		if job.committed or attempt.cancelled:
+			self._log.debug("Discarding task [{}] {} (attempt {})".format(job.id, job.task.id, attempt.number))
+			if private_outputs:
+				self._discard_outputs(job.task, attempt)
+			return False
+
+		if result.state != runstates.FINISHED and len(job.attempts) > 0:
+			self._log.warn("Task [{}] {} (attempt {}) failed while other attempts are running: {}".format(
+							job.id, job.task.id, attempt.number, result.exit_message))
+			if private_outputs:
+				self._discard_outputs(job.task, attempt)
+			return False
+
+		job.committed = True
+
+		# kill the rest of attempts
+		for other in job.attempts:
+			other.cancelled = True
+			if other.process is not None:
+				self._terminate(other.process)
 
-				self._run_cvar.notify()
+		if private_outputs:
+			if result.state == runstates.FINISHED:
+				try:
+					for data in job.task.out_port_data:
+						data.commit_attempt(attempt.number)
+				except Exception as e:
+					self._log.exception(e)
+					result.state = runstates.FAILED
+					result.exit_code = exit_codes.EXEC_EXCEPTION
+					result.exit_message = "Failed committing the outputs: {}".format(str(e))
+			else:
+				self._discard_outputs(job.task, attempt)
 
-			self.engine.notify()
+		if result.state == runstates.FINISHED:
+			module_id = job.task.parent.id
+			durations = self._durations.get(module_id)
+			if durations is None:
+				durations = self._durations[module_id] = []
+			durations += [result.end_time - result.start_time]
+			if len(durations) > 100:
+				del durations[0]
+
+		job.result = result
+		job.output_file = attempt.output_file
+		job.capture = attempt.capture
+		job.output_attempt = attempt.number
+
+		return True
+
+	@staticmethod
+	def _terminate(process):
+		"""Terminates a process not reaped yet. The thread running it is blocked waiting for it,
+		so the process is never polled from here, which could reap it before that thread."""
+
+		if process.returncode is None:
+			try:
+				process.terminate()
+			except OSError:
+				pass
+
+	def _discard_outputs(self, task, attempt):
+		for data in task.out_port_data:
+			try:
+				data.discard_attempt(attempt.number)
+			except Exception as e:
+				self._log.warn("Failed removing the outputs of task {} (attempt {}): {}".format(
+								task.id, attempt.number, str(e)))
 
 	def start(self):
 		with self._run_lock:
@@ -184,6 +908,12 @@ class McoreJobManager(JobManager):
 			self._threads.append(thread)
 			thread.start()
 
+		if self._admission:
+			thread = Thread(target = self._sample_memory, name = "{}-memory".format(self.name))
+			self._threads.append(thread)
+			thread.start()
+
+	@timed(_SUBMIT_TIME)
 	def submit(self, tasks):
 		job_ids = []
 		with self._run_lock:
@@ -191,9 +921,13 @@ class McoreJobManager(JobManager):
 				job_id = self._next_id()
 				job_ids += [job_id]
 				job = McoreJob(job_id, task)
+				job.cpu, job.memory = self._task_resources(task)
 				self._jobs[job_id] = job
-				priority = max(min(1 - task.priority, 1), 0)
-				self._waiting_queue.put((priority, job))
+				priority = (-task.rank, max(min(1 - task.priority, 1), 0))
+				heapq.heappush(self._waiting, (priority, self._seq, job))
+				self._seq += 1
+			_WAITING_JOBS.set(len(self._waiting))
+			self._sched_cvar.notify_all()
 		return job_ids
 
 	def state(self, job_ids = None):
@@ -207,13 +941,32 @@ class McoreJobManager(JobManager):
 				states += [(job_id, self._jobs[job_id].state)]
 		return states
 
-	def output(self, job_id):
+	def output_attempt(self, job_id):
 		with self._run_lock:
 			if job_id not in self._jobs:
 				raise UnknownJob(job_id)
 
-			job = self._jobs[job_id]
-			return open(job.output_file)
+			return self._jobs[job_id].output_attempt
+
+	def output(self, job_id, attempt = None):
+		with self._run_lock:
+			if job_id not in self._jobs:
+				raise UnknownJob(job_id)
+
+			# the job has the output of the attempt committed
+			source = self._jobs[job_id]
+			if attempt is not None:
+				source = source.attempts_by_number[attempt]
+
+			if not self._capture:
+				return open(source.output_file)
+			capture = source.capture
+
+		# it may not have started yet
+		if capture is None:
+			return StringIO()
+
+		return capture.open()
 
 	def join(self, job_id):
 		with self._run_lock:
@@ -235,8 +988,10 @@ class McoreJobManager(JobManager):
 
 			results = []
 			for job_id in job_ids:
+				# the rest of the batch has to be joined anyway
 				if job_id not in self._jobs:
-					raise UnknownJob(job_id)
+					self._log.warn("Skipping unknown job {} while joining".format(job_id))
+					continue
 
 				job = self._jobs[job_id]
 				while self._running and job.state not in [runstates.FINISHED, runstates.FAILED]:
@@ -256,9 +1011,8 @@ class McoreJobManager(JobManager):
 			self._kill_threads = False
 
 			self._run_cvar.notify()
-
-		for _ in xrange(self._num_cores):
-			self._waiting_queue.put((0, None))
+			self._sched_cvar.notify_all()
+			self._sample_cvar.notify_all()
 
 		for thread in self._threads:
 			timeout = 30
@@ -266,7 +1020,23 @@ class McoreJobManager(JobManager):
 				thread.join(1)
 				timeout -= 1
 				if timeout == 0:
-					self._kill_threads = True
+					with self._run_lock:
+						self._kill_threads = True
+						for job in self._jobs.values():
+							for attempt in job.attempts:
+								if attempt.process is not None:
+									self._terminate(attempt.process)
+
+		for runner in self._runners.values():
+			runner.close()
+
+		with self._run_lock:
+			for log in self._segment_logs.values():
+				log.close()
+			self._segment_logs = {}
+
+		if self._fifo_path is not None:
+			shutil.rmtree(self._fifo_path, ignore_errors = True)
 
 		with self._run_lock:
 			self._log.info("[{}] stopped".format(self.name))
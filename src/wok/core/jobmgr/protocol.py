@@ -0,0 +1,112 @@
+###############################################################################
+#
+#    Copyright 2009-2011, Universitat Pompeu Fabra
+#
+#    This file is part of Wok.
+#
+#    Wok is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Wok is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses
+#
+###############################################################################
+
+import os
+import socket
+import json
+from threading import Lock
+
+def parse_address(address):
+	"""Parses an address as tcp://host:port, host:port or unix://path.
+	Returns a tuple (family, address) to use with sockets."""
+
+	if address.startswith("unix://"):
+		return socket.AF_UNIX, address[len("unix://"):]
+
+	if address.startswith("tcp://"):
+		address = address[len("tcp://"):]
+
+	host, sep, port = address.rpartition(":")
+	if len(sep) == 0 or not port.isdigit():
+		raise Exception("Invalid address: {}".format(address))
+
+	return socket.AF_INET, (host, int(port))
+
+def listen(address, backlog = 64):
+	"Returns a socket listening at an address"
+
+	family, addr = parse_address(address)
+	sock = socket.socket(family, socket.SOCK_STREAM)
+	if family == socket.AF_UNIX:
+		if os.path.exists(addr):
+			os.remove(addr)
+	else:
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	sock.bind(addr)
+	sock.listen(backlog)
+	return sock
+
+def connect(address):
+	"Returns a socket connected to an address"
+
+	family, addr = parse_address(address)
+	sock = socket.socket(family, socket.SOCK_STREAM)
+	try:
+		sock.connect(addr)
+	except:
+		sock.close()
+		raise
+	return sock
+
+class Channel(object):
+	"""
+	Messages exchanged by the workers job manager and the worker daemons.
+
+	Every message is a JSON object with a type in its own line. Sending is thread safe
+	but there must be only one thread receiving.
+	"""
+
+	def __init__(self, sock):
+		self._sock = sock
+		self._rfile = sock.makefile("rb")
+		self._lock = Lock()
+
+	def settimeout(self, timeout):
+		self._sock.settimeout(timeout)
+
+	def send(self, type, **fields):
+		"Sends a message and returns whether it could be sent"
+
+		fields["type"] = type
+		data = json.dumps(fields) + "\n"
+		with self._lock:
+			try:
+				self._sock.sendall(data)
+				return True
+			except socket.error:
+				return False
+
+	def receive(self):
+		"Returns the next message or None if the connection was closed"
+
+		line = self._rfile.readline()
+		if len(line) == 0:
+			return None
+		return json.loads(line)
+
+	def close(self):
+		"Closes the connection, a thread blocked receiving gets None"
+
+		try:
+			self._sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		self._sock.close()
@@ -0,0 +1,187 @@
+###############################################################################
+#
+#    Copyright 2009-2011, Universitat Pompeu Fabra
+#
+#    This file is part of Wok.
+#
+#    Wok is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Wok is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses
+#
+###############################################################################
+
+"""
+Python worker of the pool runner of the mcore job manager.
+
+It reads requests as JSON lines from the standard input with the script to run, its
+arguments and the file where its output goes, runs the script as if it was the main
+module of a new interpreter and replies with a JSON line with the exit code and the
+maximum resident memory of the worker.
+
+Usage: python -m wok.core.jobmgr.pyworker [module ...]
+
+The modules given as arguments are imported before running any task.
+"""
+
+import os
+import sys
+import logging
+import runpy
+import json
+import traceback
+import resource
+
+# preloaded, tasks find them already imported
+import wok
+import wok.config
+import wok.logger
+import wok.task
+import wok.core.storage.factory
+
+def _exit_code(code):
+	if code is None:
+		return 0
+	if isinstance(code, (int, long)):
+		return code
+	sys.stderr.write("{}\n".format(code))
+	return 1
+
+def _reset_logging():
+	"Removes the handlers and levels set by the last task so the next one configures logging again"
+
+	loggers = [logging.root] + [l for l in logging.Logger.manager.loggerDict.values()
+								if isinstance(l, logging.Logger)]
+	for log in loggers:
+		for handler in log.handlers[:]:
+			try:
+				handler.flush()
+				handler.close()
+			except Exception:
+				pass
+			log.removeHandler(handler)
+		log.setLevel(logging.NOTSET)
+		log.disabled = False
+		log.propagate = True
+
+	logging.root.setLevel(logging.WARNING)
+
+def redirect_output(path):
+	"Sends the standard output and error to the end of a file"
+
+	sys.stdout.flush()
+	sys.stderr.flush()
+
+	fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+	os.dup2(fd, 1)
+	os.dup2(fd, 2)
+	os.close(fd)
+
+def run_script(request):
+	"Runs the script of a request as the main module and returns its exit code"
+
+	# json decodes strings as unicode but the arguments of a process are byte strings
+	script = request["script"].encode("utf-8")
+	args = [arg.encode("utf-8") for arg in request["args"]]
+
+	sys.argv = [script] + args
+	sys.path.insert(0, os.path.dirname(script))
+
+	try:
+		runpy.run_path(script, run_name = "__main__")
+		exit_code = 0
+	except SystemExit as e:
+		exit_code = _exit_code(e.code)
+	except:
+		traceback.print_exc()
+		exit_code = 1
+
+	try:
+		sys.stdout.flush()
+		sys.stderr.flush()
+	except Exception:
+		pass
+
+	return exit_code
+
+def open_channels():
+	"""Moves the requests and replies channels apart from the standard file descriptors,
+	these belong to the tasks. Returns the file descriptors of the requests, replies and
+	the original standard error."""
+
+	channels = (os.dup(0), os.dup(1), os.dup(2))
+
+	null = os.open(os.devnull, os.O_RDWR)
+	for fd in [0, 1]:
+		os.dup2(null, fd)
+	os.close(null)
+
+	return channels
+
+def run_task(request, modules, stderr):
+	"""Runs the script of a request and returns its exit code.
+	The standard error of the worker is restored from the stderr file descriptor after the task."""
+
+	argv = sys.argv
+	path = sys.path[:]
+	environ = dict(os.environ)
+	cwd = os.getcwd()
+
+	redirect_output(request["output"])
+
+	try:
+		exit_code = run_script(request)
+	finally:
+		_reset_logging()
+
+		# forget the modules imported by the task, they could keep state between tasks
+		for name in sys.modules.keys():
+			if name not in modules:
+				del sys.modules[name]
+
+		sys.argv = argv
+		sys.path[:] = path
+		os.environ.clear()
+		os.environ.update(environ)
+		os.chdir(cwd)
+
+		# output between tasks is discarded
+		null = os.open(os.devnull, os.O_WRONLY)
+		os.dup2(null, 1)
+		os.close(null)
+		os.dup2(stderr, 2)
+
+	return exit_code
+
+def main():
+	for name in sys.argv[1:]:
+		__import__(name)
+
+	requests, replies, stderr = open_channels()
+	requests = os.fdopen(requests, "r")
+	replies = os.fdopen(replies, "w")
+
+	modules = set(sys.modules.keys())
+
+	while True:
+		line = requests.readline()
+		if len(line) == 0:
+			break
+
+		exit_code = run_task(json.loads(line), modules, stderr)
+
+		rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+		replies.write(json.dumps(dict(exit_code = exit_code, rss = rss)) + "\n")
+		replies.flush()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,415 @@
+###############################################################################
+#
+#    Copyright 2009-2011, Universitat Pompeu Fabra
+#
+#    This file is part of Wok.
+#
+#    Wok is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Wok is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses
+#
+###############################################################################
+
+import os
+import os.path
+import subprocess
+import json
+import signal
+from threading import Thread, Lock, Condition
+
+import wok
+
+_WORKER_MODULE = "wok.core.jobmgr.pyworker"
+_ZYGOTE_MODULE = "wok.core.jobmgr.zygote"
+
+def _python_env(env):
+	"Returns the environment for a python interpreter that has to find wok whatever the PYTHONPATH of the tasks is"
+
+	env = dict(env) if env is not None else dict(os.environ)
+	wok_path = os.path.dirname(os.path.dirname(os.path.abspath(wok.__file__)))
+	if "PYTHONPATH" in env:
+		env["PYTHONPATH"] = os.pathsep.join([wok_path, env["PYTHONPATH"]])
+	else:
+		env["PYTHONPATH"] = wok_path
+	return env
+
+def _runner_key(cmd, cwd, env, preload):
+	return (cmd, cwd, tuple(sorted(env.items())) if env is not None else None, tuple(preload))
+
+class ProcessRunner(object):
+	"Runs every task in a new process"
+
+	def start(self, args, output, cwd = None, env = None, preload = None):
+		return subprocess.Popen(
+							args = args,
+							stdin=None,
+							stdout=output,
+							stderr=subprocess.STDOUT,
+							cwd=cwd,
+							env=env,
+							close_fds=True)
+
+	def close(self):
+		pass
+
+class _Worker(object):
+	"A python interpreter with wok preloaded that runs scripts sent through its standard input"
+
+	def __init__(self, cmd, cwd, env, preload):
+		self.process = subprocess.Popen(
+							args = [cmd, "-m", _WORKER_MODULE] + preload,
+							stdin=subprocess.PIPE,
+							stdout=subprocess.PIPE,
+							cwd=cwd,
+							env=_python_env(env),
+							close_fds=True)
+
+		self.tasks = 0
+
+	def send(self, request):
+		self.process.stdin.write(json.dumps(request) + "\n")
+		self.process.stdin.flush()
+
+	def receive(self):
+		"Returns the reply to the last request or None if the worker died"
+
+		line = self.process.stdout.readline()
+		if len(line) == 0:
+			return None
+		return json.loads(line)
+
+	def close(self):
+		try:
+			self.process.stdin.close()
+		except IOError:
+			pass
+		self.process.wait()
+
+class _PooledProcess(object):
+	"A task running in a pool worker. It looks like a process to the job manager."
+
+	def __init__(self, pool, key, worker):
+		self._pool = pool
+		self._key = key
+		self._worker = worker
+		self.returncode = None
+
+		self._lock = Lock()
+		self._finished = False
+		self._killed = False
+
+	@property
+	def pid(self):
+		return self._worker.process.pid
+
+	def wait(self):
+		if self.returncode is not None:
+			return self.returncode
+
+		reply = None
+		try:
+			reply = self._worker.receive()
+		except (IOError, ValueError):
+			pass
+
+		with self._lock:
+			self._finished = True
+			killed = self._killed
+
+		if reply is None:
+			# the worker died or was killed, report how and don't reuse it
+			self.returncode = self._worker.process.wait()
+			if self.returncode == 0:
+				self.returncode = -1
+			self._pool._discard(self._worker)
+		else:
+			self.returncode = reply["exit_code"]
+			if killed:
+				self._pool._discard(self._worker)
+			else:
+				self._pool._release(self._key, self._worker, reply.get("rss", 0))
+
+		return self.returncode
+
+	def terminate(self):
+		# there is no way to stop a script running inside the worker but killing it
+		with self._lock:
+			if self._finished:
+				return
+			self._killed = True
+			self._worker.process.terminate()
+
+class PoolRunner(object):
+	"""
+	Runs python tasks in persistent worker interpreters.
+
+	Workers are started with wok already imported, so the tasks don't pay the
+	interpreter startup and imports. The scripts are executed in the worker through
+	runpy with the same arguments they would have in their own process. After every
+	task the arguments, environment, working directory, logging configuration and the
+	modules imported by the task are restored. Workers are recycled after max_tasks
+	tasks or once their resident memory exceeds max_memory bytes.
+
+	Workers are shared by the tasks with the same interpreter, environment, working
+	directory and modules to preload.
+	"""
+
+	def __init__(self, max_tasks = 100, max_memory = None, preload = None, log = None):
+		self._max_tasks = max_tasks
+		self._max_memory = max_memory
+		self._preload = preload or []
+		self._log = log
+
+		self._lock = Lock()
+
+		# idle workers by (cmd, cwd, env, preload)
+		self._idle = {}
+
+		self._workers = set()
+		self._closed = False
+
+	def start(self, args, output, cwd = None, env = None, preload = None):
+		cmd, script, script_args = args[0], args[1], args[2:]
+		preload = self._preload + (preload or [])
+		key = _runner_key(cmd, cwd, env, preload)
+
+		with self._lock:
+			if self._closed:
+				raise Exception("The worker pool is closed")
+
+			idle = self._idle.get(key)
+			worker = idle.pop() if idle else None
+
+		if worker is None:
+			worker = _Worker(cmd, cwd, env, preload)
+			with self._lock:
+				self._workers.add(worker)
+			if self._log is not None:
+				self._log.debug("Started pool worker {} for {}".format(worker.process.pid, cmd))
+
+		worker.tasks += 1
+		worker.send(dict(
+			script = os.path.abspath(script),
+			args = script_args,
+			output = os.path.abspath(output.name)))
+
+		return _PooledProcess(self, key, worker)
+
+	def _release(self, key, worker, rss):
+		recycle = worker.tasks >= self._max_tasks \
+				or (self._max_memory is not None and rss > self._max_memory)
+
+		with self._lock:
+			if not recycle and not self._closed:
+				if key not in self._idle:
+					self._idle[key] = [worker]
+				else:
+					self._idle[key] += [worker]
+				return
+
+		if self._log is not None:
+			self._log.debug("Recycling pool worker {} after {} tasks and {} bytes of memory".format(
+							worker.process.pid, worker.tasks, rss))
+
+		self._discard(worker)
+
+	def _discard(self, worker):
+		with self._lock:
+			self._workers.discard(worker)
+
+		worker.close()
+
+	def close(self):
+		with self._lock:
+			self._closed = True
+			workers = list(self._workers)
+			self._workers.clear()
+			self._idle = {}
+
+		for worker in workers:
+			if worker.process.returncode is None:
+				worker.close()
+
+class _ForkedProcess(object):
+	"A task running in a child of a zygote. It looks like a process to the job manager."
+
+	def __init__(self, zygote, request_id):
+		self._zygote = zygote
+		self._id = request_id
+		self.returncode = None
+
+		# known once the zygote forks the child
+		self.pid = None
+
+		self._cvar = Condition(Lock())
+
+	def _exited(self, exit_code):
+		with self._cvar:
+			self.returncode = exit_code
+			self._cvar.notify_all()
+
+	def wait(self):
+		with self._cvar:
+			while self.returncode is None:
+				self._cvar.wait(1)
+			return self.returncode
+
+	def terminate(self):
+		# the zygote knows whether the child is still running, so signals never reach a reused pid
+		with self._cvar:
+			if self.returncode is None:
+				self._zygote.send(dict(id = self._id, signal = signal.SIGTERM))
+
+class _Zygote(object):
+	"A python interpreter with wok preloaded that forks a child for every task"
+
+	def __init__(self, cmd, cwd, env, preload, log = None):
+		self._log = log
+
+		self.process = subprocess.Popen(
+							args = [cmd, "-m", _ZYGOTE_MODULE] + preload,
+							stdin=subprocess.PIPE,
+							stdout=subprocess.PIPE,
+							cwd=cwd,
+							env=_python_env(env),
+							close_fds=True)
+
+		self._lock = Lock()
+		self._seq = 0
+
+		# children running by request id
+		self._children = {}
+
+		self.alive = True
+
+		self._reader = Thread(target = self._read, name = "zygote-{}".format(self.process.pid))
+		self._reader.daemon = True
+		self._reader.start()
+
+	def send(self, request):
+		with self._lock:
+			if not self.alive:
+				return
+			try:
+				self.process.stdin.write(json.dumps(request) + "\n")
+				self.process.stdin.flush()
+			except IOError:
+				pass
+
+	def fork(self, script, args, output):
+		with self._lock:
+			request_id = self._seq
+			self._seq += 1
+			child = _ForkedProcess(self, request_id)
+			if self.alive:
+				self._children[request_id] = child
+
+		if not self.alive:
+			child._exited(-1)
+			return child
+
+		self.send(dict(id = request_id, script = script, args = args, output = output))
+
+		return child
+
+	def _read(self):
+		while True:
+			try:
+				line = self.process.stdout.readline()
+			except IOError:
+				line = ""
+			if len(line) == 0:
+				break
+
+			reply = json.loads(line)
+			with self._lock:
+				if "exit_code" not in reply:
+					child = self._children.get(reply["id"])
+					if child is not None:
+						child.pid = reply["pid"]
+					continue
+
+				child = self._children.pop(reply["id"], None)
+			if child is not None:
+				child._exited(reply["exit_code"])
+
+		returncode = self.process.wait()
+
+		with self._lock:
+			self.alive = False
+			children = self._children.values()
+			self._children = {}
+
+		if len(children) > 0 and self._log is not None:
+			self._log.error("Zygote {} exited with code {} while running {} tasks".format(
+							self.process.pid, returncode, len(children)))
+
+		# the exit code of the children is lost with the zygote
+		for child in children:
+			child._exited(returncode if returncode != 0 else -1)
+
+	def close(self):
+		with self._lock:
+			try:
+				self.process.stdin.close()
+			except IOError:
+				pass
+
+		# the zygote exits once its children do
+		self._reader.join()
+
+class ZygoteRunner(object):
+	"""
+	Runs python tasks in children forked from a warm interpreter.
+
+	A zygote process imports wok and the modules to preload once and then forks a copy
+	on write child for every task, which runs the script as the main module. Tasks start
+	in milliseconds but, unlike in the pool runner, each one has its own address space.
+
+	There is a zygote for every interpreter, environment, working directory and list of
+	modules to preload.
+	"""
+
+	def __init__(self, preload = None, log = None):
+		self._preload = preload or []
+		self._log = log
+
+		self._lock = Lock()
+		self._zygotes = {}
+		self._closed = False
+
+	def start(self, args, output, cwd = None, env = None, preload = None):
+		cmd, script, script_args = args[0], args[1], args[2:]
+		preload = self._preload + (preload or [])
+		key = _runner_key(cmd, cwd, env, preload)
+
+		with self._lock:
+			if self._closed:
+				raise Exception("The zygote runner is closed")
+
+			zygote = self._zygotes.get(key)
+			if zygote is None or not zygote.alive:
+				zygote = self._zygotes[key] = _Zygote(cmd, cwd, env, preload, self._log)
+				if self._log is not None:
+					self._log.debug("Started zygote {} for {} preloading [{}]".format(
+									zygote.process.pid, cmd, ", ".join(preload)))
+
+		return zygote.fork(os.path.abspath(script), script_args, os.path.abspath(output.name))
+
+	def close(self):
+		with self._lock:
+			self._closed = True
+			zygotes = self._zygotes.values()
+			self._zygotes = {}
+
+		for zygote in zygotes:
+			zygote.close()
@@ -0,0 +1,143 @@
+###############################################################################
+#
+#    Copyright 2009-2011, Universitat Pompeu Fabra
+#
+#    This file is part of Wok.
+#
+#    Wok is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Wok is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses
+#
+###############################################################################
+
+import os
+import os.path
+import re
+
+from wok.core.utils.sync import Synchronizable, synchronized
+
+_SEGMENT_RE = re.compile(r"^(\d{8})\.seg$")
+
+class SegmentLog(Synchronizable):
+	"""
+	Append-only log with the raw output of the tasks of an instance.
+
+	Output is appended in blocks to segment files of up to segment_size bytes, a new
+	segment is started when the current one is full. Every block is recorded in an index
+	file as a line with the name of its output, segment, offset and length, so the output
+	of a task can be retrieved although it is interleaved with the output of other tasks.
+	"""
+
+	def __init__(self, path, segment_size = 64 * 1024 * 1024):
+		Synchronizable.__init__(self)
+
+		self._path = path
+		self._segment_size = segment_size
+
+		if not os.path.exists(path):
+			os.makedirs(path)
+
+		# blocks of every output as a list of (segment, offset, length) by name
+		self._blocks = {}
+
+		index_path = os.path.join(path, "index")
+		if os.path.exists(index_path):
+			self._load_index(index_path)
+
+		segments = sorted(int(m.group(1)) for m in
+							[_SEGMENT_RE.match(name) for name in os.listdir(path)] if m is not None)
+		self._segment = segments[-1] if len(segments) > 0 else 1
+
+		self._index = open(index_path, "a")
+		self._file = None
+		self._open_segment()
+
+	def _load_index(self, index_path):
+		f = open(index_path)
+		try:
+			for line in f:
+				fields = line.rstrip("\n").split("\t")
+				if len(fields) != 4:
+					# the last line may be incomplete after a crash
+					continue
+				name, segment, offset, length = fields
+				self._add_block(name, (int(segment), long(offset), int(length)))
+		finally:
+			f.close()
+
+	def _add_block(self, name, block):
+		if name not in self._blocks:
+			self._blocks[name] = [block]
+		else:
+			self._blocks[name] += [block]
+
+	def _segment_path(self, segment):
+		return os.path.join(self._path, "{:08d}.seg".format(segment))
+
+	def _open_segment(self):
+		self._file = open(self._segment_path(self._segment), "ab")
+		self._file.seek(0, os.SEEK_END)
+		self._offset = self._file.tell()
+
+	@synchronized
+	def append(self, name, data):
+		"Appends a block of the output with the given name"
+
+		if len(data) == 0:
+			return
+
+		if self._offset > 0 and self._offset + len(data) > self._segment_size:
+			self._file.close()
+			self._segment += 1
+			self._open_segment()
+
+		block = (self._segment, self._offset, len(data))
+		self._file.write(data)
+		self._file.flush()
+		self._offset += len(data)
+
+		# the index never points to data not written yet
+		self._index.write("{}\t{}\t{}\t{}\n".format(name, *block))
+		self._index.flush()
+
+		self._add_block(name, block)
+
+	@synchronized
+	def read(self, name):
+		"Returns the output with the given name"
+
+		sb = []
+		files = {}
+		try:
+			for segment, offset, length in self._blocks.get(name, []):
+				if segment not in files:
+					path = self._segment_path(segment)
+					if not os.path.exists(path):
+						continue
+					files[segment] = open(path, "rb")
+				f = files[segment]
+				f.seek(offset)
+				sb += [f.read(length)]
+		finally:
+			for f in files.values():
+				f.close()
+
+		return "".join(sb)
+
+	@synchronized
+	def close(self):
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+		if self._index is not None:
+			self._index.close()
+			self._index = None
@@ -0,0 +1,485 @@
+###############################################################################
+#
+#    Copyright 2009-2011, Universitat Pompeu Fabra
+#
+#    This file is part of Wok.
+#
+#    Wok is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Wok is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses
+#
+###############################################################################
+
+import os
+import os.path
+import socket
+import heapq
+import base64
+import time
+from threading import Thread, Lock, Condition
+
+from wok import exit_codes
+from wok.core import runstates
+from wok.core.jobmgr.base import JobManager, Job
+from wok.core.jobmgr.errors import UnknownJob
+from wok.core.jobmgr.protocol import Channel, listen, parse_address
+
+class WorkersJob(Job):
+	def __init__(self, job_id, task):
+		Job.__init__(self, job_id, task)
+
+		self.cmd = None
+		self.args = None
+		self.env = None
+
+		# slots taken from the worker running it
+		self.cpu = 1
+		self.priority = 0
+
+		# the worker running it and how many times it has been dispatched
+		self.worker = None
+		self.attempts = 0
+
+		self.output = None
+
+class _Worker(object):
+	"A worker daemon connected to the job manager"
+
+	def __init__(self, channel, address):
+		self.channel = channel
+		self.name = str(address)
+		self.slots = 0
+		self.free = 0
+		self.last_seen = time.time()
+
+		# jobs running in the worker by id
+		self.jobs = {}
+
+class WorkersJobManager(JobManager):
+	"""
+	Job manager that runs the tasks in worker daemons (wok-worker), possibly in other machines.
+
+	The workers connect to the address the job manager listens at and advertise their slots.
+	Tasks are dispatched by priority to the worker with more free slots that fits them, their
+	output is streamed back into the output files of the job manager and their results are
+	notified as soon as they finish. Workers exchange heartbeats with the job manager, the
+	tasks of a worker that is lost are dispatched again up to max_retries times.
+
+	Workers must see the flows, scripts and storage in the same paths as the engine.
+	"""
+
+	def __init__(self, engine, conf):
+		JobManager.__init__(self, "workers", engine, conf)
+
+		self._address = self.conf.get("address", "tcp://localhost:5800")
+		self._heartbeat = self.conf.get("heartbeat", 5.0, dtype=float)
+		self._timeout = self.conf.get("timeout", 3 * self._heartbeat, dtype=float)
+		self._max_retries = self.conf.get("max_retries", 3, dtype=int)
+
+		self._working_directory = self.conf.get("working_directory")
+		if self._working_directory is not None:
+			self._working_directory = os.path.abspath(self._working_directory)
+
+		self._lock = Lock()
+		self._cvar = Condition(self._lock)
+
+		# only notified when closing, so heartbeats are sent at a regular pace
+		self._monitor_cvar = Condition(self._lock)
+
+		self._running = False
+		self._socket = None
+		self._threads = []
+
+		self._workers = set()
+
+		self._jobs = {}
+
+		# heap of ((-rank, priority), seq, job) for the jobs waiting for a worker
+		self._waiting = []
+		self._seq = 0
+
+	@property
+	def slots(self):
+		# the capacity of the workers connected now
+		with self._lock:
+			return sum(worker.slots for worker in self._workers)
+
+	def _start_thread(self, target, name, *args):
+		thread = Thread(target = target, name = name, args = args)
+		thread.daemon = True
+		self._threads.append(thread)
+		thread.start()
+
+	def start(self):
+		with self._lock:
+			self._log.info("Starting job manager [{}] at {} ...".format(self.name, self._address))
+
+		self._socket = listen(self._address)
+		# accept can not be interrupted by closing the socket, check periodically whether to stop
+		self._socket.settimeout(1)
+
+		self._running = True
+
+		self._start_thread(self._accept, "{}-accept".format(self.name))
+		self._start_thread(self._monitor, "{}-monitor".format(self.name))
+
+	def _accept(self):
+		while self._running:
+			try:
+				sock, address = self._socket.accept()
+			except socket.timeout:
+				continue
+			except socket.error as e:
+				if self._running:
+					self._log.warn("Failed accepting a worker: {}".format(str(e)))
+				continue
+
+			sock.settimeout(None)
+			if sock.family == socket.AF_INET:
+				sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+			worker = _Worker(Channel(sock), address)
+			self._start_thread(self._serve, "{}-{}".format(self.name, worker.name), worker)
+
+	def _monitor(self):
+		"Sends heartbeats and disconnects the workers that don't answer them"
+
+		while True:
+			with self._lock:
+				self._monitor_cvar.wait(self._heartbeat)
+				if not self._running:
+					break
+				workers = list(self._workers)
+
+			now = time.time()
+			for worker in workers:
+				if now - worker.last_seen > self._timeout:
+					self._log.warn("Worker {} has not answered for {:.1f} seconds, disconnecting it".format(
+									worker.name, now - worker.last_seen))
+					worker.channel.close()
+				else:
+					worker.channel.send("heartbeat")
+
+	def _serve(self, worker):
+		channel = worker.channel
+
+		try:
+			msg = channel.receive()
+		except (socket.error, ValueError):
+			msg = None
+
+		if msg is None or msg.get("type") != "hello":
+			self._log.warn("Unexpected handshake from {}".format(worker.name))
+			channel.close()
+			return
+
+		worker.name = msg.get("name", worker.name)
+		worker.slots = worker.free = max(int(msg.get("slots", 1)), 1)
+
+		with self._lock:
+			if not self._running:
+				channel.send("bye")
+				channel.close()
+				return
+
+			channel.send("welcome", heartbeat = self._heartbeat)
+
+			self._log.info("Worker {} connected with {} slots".format(worker.name, worker.slots))
+			self._workers.add(worker)
+			messages = self._dispatch()
+
+		self._send(messages)
+
+		while True:
+			try:
+				msg = channel.receive()
+			except (socket.error, ValueError) as e:
+				self._log.warn("Failed receiving from worker {}: {}".format(worker.name, str(e)))
+				msg = None
+
+			if msg is None:
+				break
+
+			worker.last_seen = time.time()
+
+			msg_type = msg.get("type")
+			if msg_type == "started":
+				self._job_started(worker, msg)
+			elif msg_type == "output":
+				self._job_output(worker, msg)
+			elif msg_type == "result":
+				self._job_result(worker, msg)
+			elif msg_type != "heartbeat":
+				self._log.warn("Unexpected message from worker {}: {}".format(worker.name, msg_type))
+
+		self._worker_lost(worker)
+
+	def _dispatch(self):
+		"""Assigns the waiting jobs to the workers with free slots.
+		It must be called with the lock held. Returns the messages to send."""
+
+		messages = []
+		skipped = []
+		while len(self._waiting) > 0:
+			free_slots = max([worker.free for worker in self._workers] + [0])
+			if free_slots == 0:
+				break
+
+			element = heapq.heappop(self._waiting)
+			job = element[2]
+
+			# the best worker is the one with more free slots among the ones the job fits in
+			workers = [w for w in self._workers if w.free >= min(job.cpu, w.slots)]
+			if len(workers) == 0:
+				skipped += [element]
+				continue
+
+			worker = max(workers, key = lambda w: w.free)
+			job.cpu = min(job.cpu, worker.slots)
+			worker.free -= job.cpu
+			worker.jobs[job.id] = job
+			job.worker = worker
+			job.attempts += 1
+
+			messages += [(worker, dict(job = job.id, cmd = job.cmd, args = job.args,
+								env = job.env, cwd = self._working_directory))]
+
+		for element in skipped:
+			heapq.heappush(self._waiting, element)
+
+		return messages
+
+	def _send(self, messages):
+		# a worker failing to receive is detected by its thread when the connection closes
+		for worker, msg in messages:
+			self._log.debug("Dispatching job [{}] to worker {}".format(msg["job"], worker.name))
+			worker.channel.send("run", **msg)
+
+	def _job_started(self, worker, msg):
+		with self._lock:
+			job = worker.jobs.get(msg["job"])
+			if job is None:
+				return
+
+			if job.output is None:
+				job.output = open(job.output_file, "w")
+
+			job.result.start_time = msg.get("start_time", time.time())
+
+			changed = job.state != runstates.RUNNING
+
+		if changed:
+			self._change_job_state(job, runstates.RUNNING)
+
+	def _job_output(self, worker, msg):
+		with self._lock:
+			job = worker.jobs.get(msg["job"])
+			if job is None or job.output is None:
+				return
+			output = job.output
+
+		output.write(base64.b64decode(msg["data"]))
+		output.flush()
+
+	def _job_result(self, worker, msg):
+		with self._lock:
+			job = worker.jobs.pop(msg["job"], None)
+			if job is None:
+				return
+
+			worker.free += job.cpu
+			job.worker = None
+
+			if job.output is not None:
+				job.output.close()
+				job.output = None
+
+			result = job.result
+			result.start_time = msg.get("start_time", result.start_time)
+			result.end_time = msg.get("end_time", time.time())
+			result.exit_code = msg["exit_code"]
+			if result.exit_code == 0:
+				result.state = runstates.FINISHED
+			else:
+				result.state = runstates.FAILED
+			result.exit_message = msg.get("exit_message",
+							"Task exited with return code {}".format(result.exit_code))
+
+			if result.state == runstates.FINISHED:
+				self._log.debug("Task finished [{}] {} in worker {}".format(job.id, job.task.id, worker.name))
+			else:
+				self._log.error("Task failed [{}] {} in worker {}: {}".format(
+								job.id, job.task.id, worker.name, result.exit_message))
+
+			messages = self._dispatch()
+
+		self._send(messages)
+
+		self._change_job_state(job, result.state)
+
+		with self._lock:
+			self._cvar.notify_all()
+
+	def _worker_lost(self, worker):
+		failed = []
+		with self._lock:
+			worker.channel.close()
+
+			if worker not in self._workers:
+				return
+
+			self._workers.remove(worker)
+
+			if self._running:
+				self._log.warn("Worker {} disconnected while running {} tasks".format(worker.name, len(worker.jobs)))
+			else:
+				self._log.info("Worker {} disconnected".format(worker.name))
+
+			for job in worker.jobs.values():
+				job.worker = None
+				if job.output is not None:
+					job.output.close()
+					job.output = None
+
+				if self._running and job.attempts <= self._max_retries:
+					heapq.heappush(self._waiting, (job.priority, self._seq, job))
+					self._seq += 1
+				else:
+					result = job.result
+					result.state = runstates.FAILED
+					result.end_time = time.time()
+					result.exit_code = exit_codes.EXEC_EXCEPTION
+					result.exit_message = "Lost worker {}".format(worker.name)
+					failed += [job]
+
+			worker.jobs = {}
+
+			messages = self._dispatch()
+
+		self._send(messages)
+
+		for job in failed:
+			self._change_job_state(job, runstates.FAILED)
+
+		with self._lock:
+			self._cvar.notify_all()
+
+	def submit(self, tasks):
+		jobs = []
+		for task in tasks:
+			job = WorkersJob(None, task)
+			job.cmd, job.args, job.env = self._prepare_cmd(task)
+			job.cpu = max(task.parent.resources.get("cpu", 1, dtype=int), 1)
+			job.priority = (-task.rank, max(min(1 - task.priority, 1), 0))
+			jobs += [job]
+
+		if not os.path.exists(self._output_path):
+			os.makedirs(self._output_path)
+
+		job_ids = []
+		with self._lock:
+			for job in jobs:
+				job.id = self._next_id()
+				job.work_path = self._work_path
+				job.output_file = os.path.abspath(os.path.join(self._output_path, "{}.txt".format(job.task.id)))
+				job_ids += [job.id]
+				self._jobs[job.id] = job
+				heapq.heappush(self._waiting, (job.priority, self._seq, job))
+				self._seq += 1
+
+			messages = self._dispatch()
+
+		self._send(messages)
+
+		return job_ids
+
+	def state(self, job_ids = None):
+		states = []
+		with self._lock:
+			if job_ids is None:
+				job_ids = self._jobs.keys()
+			elif not isinstance(job_ids, list):
+				job_ids = [job_ids]
+			for job_id in job_ids:
+				states += [(job_id, self._jobs[job_id].state)]
+		return states
+
+	def output(self, job_id):
+		with self._lock:
+			if job_id not in self._jobs:
+				raise UnknownJob(job_id)
+
+			job = self._jobs[job_id]
+			if not os.path.exists(job.output_file):
+				open(job.output_file, "w").close()
+			return open(job.output_file)
+
+	def join(self, job_id):
+		with self._lock:
+			if job_id not in self._jobs:
+				raise UnknownJob(job_id)
+
+			job = self._jobs[job_id]
+			while self._running and job.state not in [runstates.FINISHED, runstates.FAILED]:
+				self._cvar.wait(2)
+
+			del self._jobs[job_id]
+
+		return job.result
+
+	def join_all(self, job_ids = None):
+		with self._lock:
+			if job_ids is None:
+				job_ids = self._jobs.keys()
+
+			results = []
+			for job_id in job_ids:
+				# the rest of the batch has to be joined anyway
+				if job_id not in self._jobs:
+					self._log.warn("Skipping unknown job {} while joining".format(job_id))
+					continue
+
+				job = self._jobs[job_id]
+				while self._running and job.state not in [runstates.FINISHED, runstates.FAILED]:
+					self._cvar.wait(2)
+
+				del self._jobs[job_id]
+				results += [(job_id, job.result)]
+
+		return results
+
+	def close(self):
+		with self._lock:
+			self._log.info("Stopping job manager [{}] ...".format(self.name))
+
+			self._running = False
+			self._cvar.notify_all()
+			self._monitor_cvar.notify_all()
+
+			workers = list(self._workers)
+
+		# workers kill their running tasks and wait for another job manager
+		for worker in workers:
+			worker.channel.send("bye")
+			worker.channel.close()
+
+		for thread in self._threads:
+			thread.join(30)
+
+		if self._socket is not None:
+			self._socket.close()
+			family, addr = parse_address(self._address)
+			if family == socket.AF_UNIX and os.path.exists(addr):
+				os.remove(addr)
+
+		with self._lock:
+			self._log.info("[{}] stopped".format(self.name))
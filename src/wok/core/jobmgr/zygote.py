@@ -0,0 +1,164 @@
+###############################################################################
+#
+#    Copyright 2009-2011, Universitat Pompeu Fabra
+#
+#    This file is part of Wok.
+#
+#    Wok is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Wok is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses
+#
+###############################################################################
+
+"""
+Fork server of the zygote runner of the mcore job manager.
+
+It imports wok and the modules given as arguments once and forks a child for every
+request read as a JSON line from the standard input, so the tasks start with everything
+already imported but each one in its own address space. Requests are either
+{id, script, args, output} to run a script or {id, signal} to send a signal to the child
+running a previous request. Once a child is forked a JSON line {id, pid} is replied and
+when it exits a JSON line {id, exit_code}, a negative exit code is the signal that killed it.
+
+Usage: python -m wok.core.jobmgr.zygote [module ...]
+"""
+
+import os
+import sys
+import errno
+import fcntl
+import signal
+import select
+import random
+import logging
+import json
+import traceback
+
+from wok.core.jobmgr.pyworker import open_channels, redirect_output, run_script
+
+def _child(request, fds):
+	"Runs a request in the forked child, never returns"
+
+	exit_code = 1
+	try:
+		signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+		for fd in fds:
+			os.close(fd)
+
+		# the children would share the random state of the parent otherwise
+		random.seed()
+
+		redirect_output(request["output"])
+
+		exit_code = run_script(request)
+
+		logging.shutdown()
+	except:
+		traceback.print_exc()
+	finally:
+		os._exit(exit_code)
+
+def _exit_status(status):
+	if os.WIFSIGNALED(status):
+		return -os.WTERMSIG(status)
+	return os.WEXITSTATUS(status)
+
+def main():
+	for name in sys.argv[1:]:
+		__import__(name)
+
+	requests, replies, stderr = open_channels()
+	os.close(stderr)
+	replies = os.fdopen(replies, "w")
+
+	# SIGCHLD wakes up the select through this pipe
+	wakeup_r, wakeup_w = os.pipe()
+	for fd in [wakeup_r, wakeup_w]:
+		fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+	def sigchld(signum, frame):
+		try:
+			os.write(wakeup_w, "x")
+		except OSError:
+			pass
+
+	signal.signal(signal.SIGCHLD, sigchld)
+
+	# running children by pid and pid by request id
+	children = {}
+	pids = {}
+
+	buf = ""
+	inputs = [requests, wakeup_r]
+
+	while requests in inputs or len(children) > 0:
+		try:
+			ready = select.select(inputs, [], [])[0]
+		except select.error as e:
+			if e.args[0] == errno.EINTR:
+				continue
+			raise
+
+		if wakeup_r in ready:
+			try:
+				os.read(wakeup_r, 4096)
+			except OSError:
+				pass
+
+			while len(children) > 0:
+				try:
+					pid, status = os.waitpid(-1, os.WNOHANG)
+				except OSError as e:
+					if e.errno == errno.EINTR:
+						continue
+					break
+				if pid == 0:
+					break
+
+				request_id = children.pop(pid)
+				del pids[request_id]
+				replies.write(json.dumps(dict(id = request_id, exit_code = _exit_status(status))) + "\n")
+				replies.flush()
+
+		if requests in ready:
+			data = os.read(requests, 65536)
+			if len(data) == 0:
+				# no more requests, finish once the running children exit
+				inputs.remove(requests)
+				continue
+
+			buf += data
+			while "\n" in buf:
+				line, buf = buf.split("\n", 1)
+				request = json.loads(line)
+				request_id = request["id"]
+
+				if "signal" in request:
+					if request_id in pids:
+						try:
+							os.kill(pids[request_id], request["signal"])
+						except OSError:
+							pass
+					continue
+
+				pid = os.fork()
+				if pid == 0:
+					_child(request, [requests, replies.fileno(), wakeup_r, wakeup_w])
+
+				children[pid] = request_id
+				pids[request_id] = pid
+
+				replies.write(json.dumps(dict(id = request_id, pid = pid)) + "\n")
+				replies.flush()
+
+if __name__ == "__main__":
+	main()
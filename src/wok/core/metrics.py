@@ -0,0 +1,181 @@
+###############################################################################
+#
+#    Copyright 2009-2011, Universitat Pompeu Fabra
+#
+#    This file is part of Wok.
+#
+#    Wok is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Wok is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses
+#
+###############################################################################
+
+import time
+from threading import Lock
+
+def _render(sb, name, type, desc, samples):
+	if desc:
+		sb += ["# HELP ", name, " ", desc, "\n"]
+	sb += ["# TYPE ", name, " ", type, "\n"]
+	for sample_name, value in samples:
+		sb += [sample_name, " ", repr(value) if isinstance(value, float) else str(value), "\n"]
+
+class Counter(object):
+	"Monotonically increasing value"
+
+	def __init__(self, name, desc):
+		self.name = name
+		self.desc = desc
+		self._lock = Lock()
+		self._value = 0
+
+	def inc(self, n = 1):
+		with self._lock:
+			self._value += n
+
+	def to_native(self):
+		return self._value
+
+	def render(self, sb):
+		_render(sb, self.name, "counter", self.desc, [(self.name, self._value)])
+
+class Gauge(object):
+	"Value that can go up and down, like a queue depth"
+
+	def __init__(self, name, desc):
+		self.name = name
+		self.desc = desc
+		self._value = 0
+
+	def set(self, value):
+		self._value = value
+
+	def to_native(self):
+		return self._value
+
+	def render(self, sb):
+		_render(sb, self.name, "gauge", self.desc, [(self.name, self._value)])
+
+class _TimerContext(object):
+	def __init__(self, timer):
+		self._timer = timer
+		self._start = None
+
+	def __enter__(self):
+		self._start = time.time()
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self._timer.observe(time.time() - self._start)
+		return False
+
+class Timer(object):
+	"Number, sum and maximum of observed durations in seconds"
+
+	def __init__(self, name, desc):
+		self.name = name
+		self.desc = desc
+		self._lock = Lock()
+		self._count = 0
+		self._sum = 0.0
+		self._max = 0.0
+
+	def observe(self, seconds):
+		with self._lock:
+			self._count += 1
+			self._sum += seconds
+			if seconds > self._max:
+				self._max = seconds
+
+	def time(self):
+		"Returns a context manager that observes the time spent inside it"
+
+		return _TimerContext(self)
+
+	def to_native(self):
+		with self._lock:
+			return dict(count = self._count, sum = self._sum, max = self._max)
+
+	def render(self, sb):
+		with self._lock:
+			count, total, max_value = self._count, self._sum, self._max
+
+		_render(sb, self.name, "summary", self.desc,
+				[(self.name + "_count", count), (self.name + "_sum", total)])
+		_render(sb, self.name + "_max", "gauge", "", [(self.name + "_max", max_value)])
+
+def timed(timer):
+	"Decorator observing the time spent in a function with a Timer"
+
+	def wrap(f):
+		def timed_function(*args, **kw):
+			start = time.time()
+			try:
+				return f(*args, **kw)
+			finally:
+				timer.observe(time.time() - start)
+		return timed_function
+	return wrap
+
+class Metrics(object):
+	"""
+	Registry of the controller metrics.
+
+	Metrics are created the first time they are requested by name and
+	rendered in the Prometheus text exposition format.
+	"""
+
+	def __init__(self):
+		self._lock = Lock()
+		self._metrics = {}
+
+	def _get(self, cls, name, desc):
+		with self._lock:
+			metric = self._metrics.get(name)
+			if metric is None:
+				metric = self._metrics[name] = cls(name, desc)
+			elif not isinstance(metric, cls):
+				raise Exception("Metric {} already registered as a {}".format(name, metric.__class__.__name__))
+			return metric
+
+	def counter(self, name, desc = ""):
+		return self._get(Counter, name, desc)
+
+	def gauge(self, name, desc = ""):
+		return self._get(Gauge, name, desc)
+
+	def timer(self, name, desc = ""):
+		return self._get(Timer, name, desc)
+
+	def to_native(self):
+		"Returns the values of the metrics by name"
+
+		with self._lock:
+			metrics = self._metrics.values()
+
+		return dict((metric.name, metric.to_native()) for metric in metrics)
+
+	def to_text(self):
+		with self._lock:
+			metrics = sorted(self._metrics.values(), key = lambda m: m.name)
+
+		sb = []
+		for metric in metrics:
+			metric.render(sb)
+		return "".join(sb)
+
+_metrics = Metrics()
+
+def get_metrics():
+	"Returns the metrics registry of the process"
+
+	return _metrics
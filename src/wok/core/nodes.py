@@ -19,11 +19,28 @@
 #
 ###############################################################################
 
+import time
+
 from wok.element import DataElement
 
 from wok.core import runstates
 from wok.core.flow.model import PORT_MODE_IN, PORT_MODE_OUT
 
+def _update_count(count, state, delta):
+	"Adds delta to the counter of a state, removing it when it reaches zero"
+
+	if state is None or delta == 0:
+		return
+
+	cnt = count.get(state, 0) + delta
+	if cnt > 0:
+		count[state] = cnt
+	elif state in count:
+		del count[state]
+
+def _count_to_native(count):
+	return dict([(str(state), cnt) for state, cnt in count.items()])
+
 class Node(object):
 
 	_INDENT = "  "
@@ -89,6 +106,9 @@ class BaseModuleNode(ModelNode):
 		self.priority = None
 		self.priority_factor = None
 
+		# longest expected time from its start to the end of the flow
+		self.rank = 0.0
+
 		# set of modules that should finish before it can start
 		self.depends = set()
 
@@ -98,6 +118,21 @@ class BaseModuleNode(ModelNode):
 		# set of modules to notify it has finished
 		self.notify = set()
 
+		# module which partitions are streamed into this module as they are written
+		self.stream_source = None
+
+		# index of the source output port linked with each input port when streaming
+		self.stream_ports = []
+
+		# modules receiving the partitions of this module as they are written
+		self.stream_targets = []
+
+		# input range (start, size) left to partition after a probe task
+		self.pending_range = None
+
+		# number of direct children of each state {<state, count>}
+		self._children_count_by_state = {}
+
 		# number of tasks of each state {<state, count>}
 		self._tasks_count_by_state = {}
 
@@ -202,6 +237,30 @@ class BaseModuleNode(ModelNode):
 	def tasks_count_by_state(self):
 		return self._tasks_count_by_state
 
+	@property
+	def children_count_by_state(self):
+		return self._children_count_by_state
+
+	def init_counters(self):
+		"Initializes the state counters from the current state of the children"
+
+		raise Exception("Unimplemented")
+
+	def update_children_count(self, prev_state, state, count = 1):
+		"Updates the direct children counters when some children change their state"
+
+		_update_count(self._children_count_by_state, prev_state, -count)
+		_update_count(self._children_count_by_state, state, count)
+
+	def update_tasks_count(self, prev_state, state, count = 1):
+		"Updates the tasks counters of this module and its ancestors"
+
+		module = self
+		while module is not None:
+			_update_count(module._tasks_count_by_state, prev_state, -count)
+			_update_count(module._tasks_count_by_state, state, count)
+			module = module.parent
+
 	@property
 	def has_children(self):
 		return False
@@ -222,7 +281,7 @@ class BaseModuleNode(ModelNode):
 		e["wsize"] = self.wsize
 		e["conf"] = self.conf
 		e["resources"] = self.resources
-		e.create_element("tasks_count", self._tasks_count_by_state)
+		e.create_element("tasks_count", _count_to_native(self._tasks_count_by_state))
 
 		ports = e.create_element("ports")
 		in_ports = ports.create_list("in")
@@ -243,6 +302,8 @@ class BaseModuleNode(ModelNode):
 			sb.extend([self._INDENT * level, "Priority factor: ", str(self.priority_factor), "\n"])
 		if self.depends is not None and len(self.depends) > 0:
 			sb.extend([self._INDENT * level, "Depends: ", ", ".join([m.id for m in self.depends]), "\n"])
+		if self.stream_source is not None:
+			sb.extend([self._INDENT * level, "Stream from: ", self.stream_source.id, "\n"])
 		if self.waiting is not None and len(self.waiting) > 0:
 			sb.extend([self._INDENT * level, "Waiting: ", ", ".join([m.id for m in self.waiting]), "\n"])
 		if self.notify is not None and len(self.notify) > 0:
@@ -308,33 +369,35 @@ class FlowNode(BaseModuleNode):
 
 	@property
 	def modules_count_by_state(self):
-		return self.__modules_count_by_state
+		return self._modules_count_by_state
+
+	def init_counters(self):
+		self._children_count_by_state = {}
+		self._tasks_count_by_state = {}
+		self._modules_count_by_state = {}
 
-	def update_tasks_count_by_state(self):
-		count = {}
-		for module in self.modules:
-			mcount = module.update_tasks_count_by_state()
-			for state, cnt in mcount.items():
-				s = str(state)
-				if s not in count:
-					count[s] = cnt
-				else:
-					count[s] += cnt
-		self._tasks_count_by_state = count
-		return count
-
-	def update_modules_count_by_state(self):
-		count = {}
 		for module in self.modules:
-			mcount = module.update_modules_count_by_state()
-			for state, cnt in mcount.items():
-				s = str(state)
-				if s not in count:
-					count[s] = cnt
-				else:
-					count[s] += cnt
-		self._modules_count_by_state = count
-		return count
+			module.init_counters()
+
+			_update_count(self._children_count_by_state, module.state, 1)
+
+			for state, cnt in module.tasks_count_by_state.items():
+				_update_count(self._tasks_count_by_state, state, cnt)
+
+			if module.is_leaf_module:
+				_update_count(self._modules_count_by_state, module.state, 1)
+			else:
+				for state, cnt in module.modules_count_by_state.items():
+					_update_count(self._modules_count_by_state, state, cnt)
+
+	def update_modules_count(self, prev_state, state, count = 1):
+		"Updates the leaf modules counters of this flow and its ancestors"
+
+		module = self
+		while module is not None:
+			_update_count(module._modules_count_by_state, prev_state, -count)
+			_update_count(module._modules_count_by_state, state, count)
+			module = module.parent
 
 	def to_element(self, e = None):
 		e = BaseModuleNode.to_element(self, e)
@@ -342,7 +405,7 @@ class FlowNode(BaseModuleNode):
 		for module in self.modules:
 			mlist.append(module.to_element())
 
-		e.create_element("modules_count", self._modules_count_by_state)
+		e.create_element("modules_count", _count_to_native(self._modules_count_by_state))
 		return e
 
 class LeafModuleNode(BaseModuleNode):
@@ -351,10 +414,20 @@ class LeafModuleNode(BaseModuleNode):
 
 		self.tasks = []
 
+		# elapsed time and number of the tasks joined
+		self.joined_work = 0.0
+		self.joined_tasks = 0
+
 	@property
 	def execution(self):
 		return self.model.execution
 
+	@property
+	def stream(self):
+		if self.model.stream is not None:
+			return self.model.stream
+		return self.instance.default_stream
+
 	@property
 	def is_leaf_module(self):
 		return True
@@ -375,30 +448,21 @@ class LeafModuleNode(BaseModuleNode):
 	def flow_path(self):
 		return self.parent.flow_path
 
-	def update_tasks_count_by_state(self):
-		count = {}
+	@property
+	def modules_count_by_state(self):
+		return { self.state : 1 }
+
+	def init_counters(self):
+		self._children_count_by_state = {}
 		for task in self.tasks:
-			s = str(task.state)
-			if s not in count:
-				count[s] = 1
-			else:
-				count[s] += 1
-		self._tasks_count_by_state = count
-		return count
+			_update_count(self._children_count_by_state, task.state, 1)
+		self._tasks_count_by_state = dict(self._children_count_by_state)
 
-	def update_modules_count_by_state(self):
-		return { str(self.state) : 1 }
-	
 	def repr_level(self, sb, level):
 		level = BaseModuleNode.repr_level(self, sb, level)
 		sb.extend([self._INDENT * level, "Tasks: ", str(len(self.tasks)), "\n"])
 		level += 1
-		tasks_by_state = {}
-		for t in self.tasks:
-			if t.state not in tasks_by_state:
-				tasks_by_state[t.state] = 1
-			else:
-				tasks_by_state[t.state] += 1
+		tasks_by_state = self._children_count_by_state
 		for state in sorted(tasks_by_state, key=lambda s: s.id):
 			sb.extend([self._INDENT * level, str(state), ": ", str(tasks_by_state[state]), "\n"])
 		return level - 1
@@ -415,9 +479,19 @@ class TaskNode(Node):
 		self.in_port_data = []
 		self.out_port_data = []
 
+		# number of input records
+		self.size = None
+
 		self.job_id = None
 		self.job_result = None
 
+		# when the task became ready and when its job finished
+		self.ready_time = time.time()
+		self.finish_time = None
+
+		# fingerprint used by the task results cache
+		self.fingerprint = None
+
 	@property
 	def instance(self):
 		return self.parent.instance
@@ -432,7 +506,12 @@ class TaskNode(Node):
 
 	@property
 	def priority(self):
-		return self.parent.priority + (self.index / self.parent.priority_factor * 10.0)
+		# tasks of the same module are ordered by submission
+		return self.parent.priority
+
+	@property
+	def rank(self):
+		return self.parent.rank
 
 	@property
 	def conf(self):
@@ -0,0 +1,226 @@
+###############################################################################
+#
+#    Copyright 2009-2011, Universitat Pompeu Fabra
+#
+#    This file is part of Wok.
+#
+#    Wok is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Wok is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses
+#
+###############################################################################
+
+import os
+import os.path
+import hashlib
+import cPickle as pickle
+
+from wok import logger
+from wok.core.utils.sync import Synchronizable, synchronized
+from wok.core.flow.model import PORT_MODE_IN, PORT_MODE_OUT
+
+# changes whenever the plans structure changes to discard the old ones
+_PLAN_VERSION = 1
+
+def _file_digest(path):
+	h = hashlib.sha1()
+	f = open(path, "rb")
+	try:
+		h.update(f.read())
+	finally:
+		f.close()
+	return h.hexdigest()
+
+class InstancePlan(object):
+	"""
+	Topology of an instance compiled into flat tables, so new instances of the
+	same flow can create their nodes without loading the flows, resolving the
+	port links and calculating the dependencies again.
+
+	Modules are numbered in pre-order, the root flow is the first one.
+
+	- modules: (is_leaf, parent_index, namespace, model) of every module.
+	- port_ops: (port_ref, link_refs) in the order the port data has to be created,
+	  where link_refs is None for source ports. A port_ref is (module_index, mode, port_index).
+	- depends: indices of the modules every module depends on.
+	- streams: (module_index, source_index, stream_ports) of the streamed modules.
+	- priorities: (priority, priority_factor) of every module before the critical path.
+	- flow_files: (path, digest) of the flow files it was compiled from.
+	"""
+
+	def __init__(self, modules, port_ops, depends, streams, priorities, flow_files):
+		self.version = _PLAN_VERSION
+		self.modules = modules
+		self.port_ops = port_ops
+		self.depends = depends
+		self.streams = streams
+		self.priorities = priorities
+		self.flow_files = flow_files
+
+	@property
+	def root_flow(self):
+		return self.modules[0][3]
+
+	@staticmethod
+	def compile(root_node, port_ops):
+		"""Compiles the plan of an instance from its nodes tree and the port
+		data operations recorded while connecting its ports"""
+
+		nodes = []
+		def visit(module):
+			nodes.append(module)
+			for m in module.modules:
+				visit(m)
+		visit(root_node)
+
+		index = dict([(m, i) for i, m in enumerate(nodes)])
+
+		port_refs = {}
+		for i, m in enumerate(nodes):
+			for j, port in enumerate(m.in_ports):
+				port_refs[port] = (i, PORT_MODE_IN, j)
+			for j, port in enumerate(m.out_ports):
+				port_refs[port] = (i, PORT_MODE_OUT, j)
+
+		modules = []
+		flow_paths = set()
+		for m in nodes:
+			parent_index = index[m.parent] if m.parent is not None else -1
+			modules += [(m.is_leaf_module, parent_index, m.namespace, m.model)]
+			if not m.is_leaf_module and m.model.path is not None:
+				flow_paths.add(m.model.path)
+
+		ops = []
+		for port, links in port_ops:
+			if links is not None:
+				links = [port_refs[p] for p in links]
+			ops += [(port_refs[port], links)]
+
+		depends = [[index[d] for d in m.depends] for m in nodes]
+
+		streams = [(index[m], index[m.stream_source], list(m.stream_ports))
+						for m in nodes if m.stream_source is not None]
+
+		priorities = [(m.priority, m.priority_factor) for m in nodes]
+
+		flow_files = [(path, _file_digest(path)) for path in sorted(flow_paths)]
+
+		return InstancePlan(modules, ops, depends, streams, priorities, flow_files)
+
+	def is_valid(self):
+		"Checks whether the flow files it was compiled from have not changed"
+
+		if self.version != _PLAN_VERSION:
+			return False
+
+		for path, digest in self.flow_files:
+			if not os.path.isfile(path) or _file_digest(path) != digest:
+				return False
+		return True
+
+class PlanCache(Synchronizable):
+	"""
+	Compiled instance plans kept in memory and on disk.
+
+	Plans are identified by the path and content of the root flow file, the flow path
+	used to resolve sub-flows and wok.defaults.stream, the only configuration value that
+	changes the topology. The sub-flow files are checked before using a plan.
+
+	Plans are kept pickled in memory too, so every instance gets its own copy of the
+	flow models and the changes of one instance don't leak into the others.
+
+	* Configuration parameters:
+	- enabled: Whether to use the compiled plans. By default true.
+	- path: Where plans are saved. By default <wok.work_path>/plans
+	"""
+
+	def __init__(self, conf, work_path, flow_path):
+		Synchronizable.__init__(self)
+
+		self._log = logger.get_logger(conf.get("log"), "wok-plans")
+
+		self._path = conf.get("path", os.path.join(work_path, "plans"))
+		if not os.path.exists(self._path):
+			os.makedirs(self._path)
+
+		self._flow_path = [os.path.abspath(path) for path in flow_path]
+
+		# pickled plans by key
+		self._plans = {}
+
+	def key(self, flow_file, conf):
+		"Returns the key of the plan of a flow file with an instance configuration"
+
+		h = hashlib.sha1()
+		h.update(str(_PLAN_VERSION))
+		h.update(os.path.abspath(flow_file))
+		h.update(_file_digest(flow_file))
+		for path in self._flow_path:
+			h.update(path)
+		h.update(str(conf.get("wok.defaults.stream", False, dtype=bool)))
+		return h.hexdigest()
+
+	def _plan_path(self, key):
+		return os.path.join(self._path, "{}.plan".format(key))
+
+	@synchronized
+	def get(self, key):
+		"Returns the plan for a key or None if there is no valid plan"
+
+		data = self._plans.get(key)
+		if data is None:
+			plan_path = self._plan_path(key)
+			if not os.path.exists(plan_path):
+				return None
+
+			try:
+				f = open(plan_path, "rb")
+				try:
+					data = f.read()
+				finally:
+					f.close()
+			except:
+				self._log.exception("Error reading the plan {}".format(plan_path))
+				return None
+
+		try:
+			plan = pickle.loads(data)
+		except:
+			self._log.exception("Error loading the plan {}".format(key))
+			self._plans.pop(key, None)
+			return None
+
+		if not plan.is_valid():
+			self._log.debug("Discarding the outdated plan {}".format(key))
+			self._plans.pop(key, None)
+			return None
+
+		self._plans[key] = data
+		return plan
+
+	@synchronized
+	def put(self, key, plan):
+		plan_path = self._plan_path(key)
+		tmp_path = plan_path + ".tmp"
+		try:
+			# later changes of the instance that compiled it don't get into the plan
+			data = pickle.dumps(plan, pickle.HIGHEST_PROTOCOL)
+			self._plans[key] = data
+
+			f = open(tmp_path, "wb")
+			try:
+				f.write(data)
+			finally:
+				f.close()
+			os.rename(tmp_path, plan_path)
+		except:
+			self._log.exception("Error saving the plan {}".format(plan_path))
@@ -114,7 +114,7 @@ class FileDataReader(DataReader):
 	def is_opened(self):
 		return self._data_f is not None
 
-	def next(self):
+	def next_raw(self):
 		if self._size == 0:
 			raise StopIteration()
 
@@ -122,12 +122,14 @@ class FileDataReader(DataReader):
 			self.open()
 
 		data = self._data_f.readline().rstrip()
-		data = self._serializer.unmarshall(data)
 
 		self._size -= 1
 
 		return data
 
+	def next(self):
+		return self._serializer.unmarshall(self.next_raw())
+
 	def __repr__(self):
 		sb = [self._path]
 		if self._start != 0 and self._size != -1:
@@ -125,7 +125,7 @@ class MultiDataReader(DataReader):
 	def is_opened(self):
 		return self._reader is not None
 
-	def next(self):
+	def _next(self, raw):
 		if self._size == 0:
 			raise StopIteration()
 
@@ -135,7 +135,10 @@ class MultiDataReader(DataReader):
 		value = None
 		while value is None:
 			try:
-				value = self._reader.next()
+				if raw:
+					value = self._reader.next_raw()
+				else:
+					value = self._reader.next()
 			except StopIteration:
 				self._source_index += 1
 				if self._source_index >= len(self._sources):
@@ -150,6 +153,12 @@ class MultiDataReader(DataReader):
 		
 		return value
 
+	def next(self):
+		return self._next(raw = False)
+
+	def next_raw(self):
+		return self._next(raw = True)
+
 	def __repr__(self):
 		sb = ["{", ", ".join([repr(s) for s in self._sources]), "}"]
 		if self._start != 0 and self._size != -1:
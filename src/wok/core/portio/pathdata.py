@@ -24,13 +24,21 @@ import struct
 
 from wok.core.portio.base import PortData, DataReader, DataWriter
 
+def _partition_file(path, partition, ext, attempt = None):
+	"Returns the path of a partition file, or the private one of an execution attempt"
+
+	name = "%06d.%s" % (partition, ext)
+	if attempt is not None:
+		name = "%s.attempt-%d" % (name, attempt)
+	return os.path.join(path, name)
+
 class PathData(PortData):
 
 	TYPE_NAME = "path_data"
 
 	def __init__(self, serializer = None, path = None, partition = -1,
 					start = 0, size = -1, conf = None, port_desc = None,
-					factory = None):
+					factory = None, attempt = None):
 
 		PortData.__init__(self, serializer, conf, port_desc, factory)
 
@@ -39,11 +47,15 @@ class PathData(PortData):
 			self._partition = conf.get("partition", partition, dtype=int)
 			self._start = conf.get("start", start, dtype=int)
 			self._size = conf.get("size", size, dtype=int)
+			self._attempt = conf.get("attempt", attempt)
+			if self._attempt is not None:
+				self._attempt = int(self._attempt)
 		else:
 			self._path = path
 			self._partition = partition
 			self._start = start
 			self._size = size
+			self._attempt = attempt
 
 		self._last_partition = 0
 
@@ -54,6 +66,8 @@ class PathData(PortData):
 		e["partition"] = self._partition
 		e["start"] = self._start
 		e["size"] = self._size
+		if self._attempt is not None:
+			e["attempt"] = self._attempt
 		return e
 
 	def reset(self):
@@ -97,6 +111,49 @@ class PathData(PortData):
 		return PathData(self._serializer, self._path, partition = partition,
 						port_desc = self.port_desc)
 	
+	def get_partition_slice(self):
+		"Returns a slice with all the values written into the partition"
+
+		if self._partition == -1:
+			raise Exception("The partition is unknown for {}".format(self._path))
+
+		return PathData(self._serializer, self._path, self._partition,
+						0, self._partition_size(self._partition), port_desc = self.port_desc)
+
+	def partition_files(self):
+		"Returns the paths of the index and data files of the partition"
+
+		if self._partition == -1:
+			raise Exception("The partition is unknown for {}".format(self._path))
+
+		return (os.path.join(self._path, "%06d.index" % self._partition),
+				os.path.join(self._path, "%06d.data" % self._partition))
+
+	def commit_attempt(self, attempt):
+		"Replaces the partition files with the ones written by an execution attempt"
+
+		if self._partition == -1:
+			raise Exception("The partition is unknown for {}".format(self._path))
+
+		for ext in ["index", "data"]:
+			src = _partition_file(self._path, self._partition, ext, attempt)
+			dst = _partition_file(self._path, self._partition, ext)
+			if os.path.exists(src):
+				os.rename(src, dst)
+			elif os.path.exists(dst):
+				os.remove(dst)
+
+	def discard_attempt(self, attempt):
+		"Removes the partition files written by an execution attempt"
+
+		if self._partition == -1:
+			raise Exception("The partition is unknown for {}".format(self._path))
+
+		for ext in ["index", "data"]:
+			path = _partition_file(self._path, self._partition, ext, attempt)
+			if os.path.exists(path):
+				os.remove(path)
+
 	def size(self):
 		if not os.path.exists(self._path):
 			self._size = 0
@@ -125,7 +182,7 @@ class PathData(PortData):
 		if self._partition == -1:
 			raise Exception("A writer can not be created without knowing the partition")
 
-		return PartitionDataWriter(self._serializer, self._path, self._partition)
+		return PartitionDataWriter(self._serializer, self._path, self._partition, self._attempt)
 		
 	def __repr__(self):
 		sb = [self._path]
@@ -176,7 +233,7 @@ class PartitionDataReader(DataReader):
 	def is_opened(self):
 		return self._data_f is not None
 
-	def next(self):
+	def next_raw(self):
 		if self._size == 0:
 			raise StopIteration()
 
@@ -198,14 +255,16 @@ class PartitionDataReader(DataReader):
 		pos = struct.unpack("Q", d)[0]
 		self._data_f.seek(pos)
 		data = self._data_f.readline().rstrip()
-		data = self._serializer.unmarshall(data)
-		
+
 		self._size -= 1
 
 		return data
+
+	def next(self):
+		return self._serializer.unmarshall(self.next_raw())
 	
 class PartitionDataWriter(DataWriter):
-	def __init__(self, serializer, path, partition):
+	def __init__(self, serializer, path, partition, attempt = None):
 		DataWriter.__init__(self, serializer)
 
 		self._path = path
@@ -214,8 +273,8 @@ class PartitionDataWriter(DataWriter):
 		if not os.path.exists(path):
 			os.makedirs(path)
 		
-		self._index_path = os.path.join(path, "%06d.index" % partition)
-		self._data_path = os.path.join(path, "%06d.data" % partition)
+		self._index_path = _partition_file(path, partition, "index", attempt)
+		self._data_path = _partition_file(path, partition, "data", attempt)
 
 		self._index_f = None
 		self._data_f = None
@@ -29,7 +29,7 @@ class PortData(object):
 
 		if conf is not None:
 			self._serializer = conf.get("serializer", DEFAULT_SERIALIZER_NAME)
-			self.port_desc = conf.get("port_desc")
+			port_desc = conf.get("port", port_desc)
 		else:
 			if serializer is None:
 				self._serializer = DEFAULT_SERIALIZER_NAME
@@ -82,6 +82,18 @@ class PortData(object):
 		"""Get a port data writer"""
 		raise Exception("Port doesn't support writing")
 
+	def update_hash(self, h):
+		"""Update the hash object h with the serialized content of the port data"""
+		reader = self.reader()
+		try:
+			while True:
+				h.update(reader.next_raw())
+				h.update("\n")
+		except StopIteration:
+			pass
+		finally:
+			reader.close()
+
 
 class DataReader(object):
 	def __init__(self, serializer = None):
@@ -93,6 +105,10 @@ class DataReader(object):
 	def next(self):
 		raise Exception("Unimplemented")
 
+	def next_raw(self):
+		"""Return the next value without unmarshalling it"""
+		raise Exception("Unimplemented")
+
 	def __iter__(self):
 		return self
 
@@ -52,11 +52,19 @@ __STATES = [
 	READY, PAUSED, WAITING, RUNNING, FINISHED, FAILED ]
 
 __MAP = {}
+__ID_MAP = {}
 for s in __STATES:
 	__MAP[s.title] = s
+	__ID_MAP[s.id] = s
 
 def from_title(title):
 	if title not in __MAP:
 		raise UndefinedState(title)
 
-	return __MAP[title]
\ No newline at end of file
+	return __MAP[title]
+
+def from_id(id):
+	if id not in __ID_MAP:
+		raise UndefinedState(id)
+
+	return __ID_MAP[id]
\ No newline at end of file
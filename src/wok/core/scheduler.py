@@ -0,0 +1,138 @@
+###############################################################################
+#
+#    Copyright 2009-2011, Universitat Pompeu Fabra
+#
+#    This file is part of Wok.
+#
+#    Wok is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Wok is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses
+#
+###############################################################################
+
+import heapq
+
+class _InstanceShare(object):
+	def __init__(self, instance, weight, max_running):
+		self.instance = instance
+		self.weight = weight
+		self.max_running = max_running
+
+		# ready tasks not released yet as a heap of ((-rank, -priority), seq, task)
+		self.queue = []
+
+		# number of released tasks not finished yet
+		self.running = 0
+
+		# virtual time of the next task to release
+		self.vtime = 0.0
+
+	@property
+	def capped(self):
+		return self.max_running > 0 and self.running >= self.max_running
+
+class FairShareScheduler(object):
+	"""
+	Releases the ready tasks of the instances to the job manager using weighted fair queuing.
+
+	Every instance has a weight and optionally a maximum number of running tasks, both
+	taken from its configuration (wok.share.weight and wok.share.max_running).
+	At most window tasks are kept released (0 means no limit). Every released task advances
+	the virtual time of its instance by 1 / weight and the next task is always taken from the
+	instance with the lowest virtual time, so the tasks released for each instance are
+	proportional to its weight. Instances that become ready start at the current virtual time,
+	so they don't need to wait for the tasks already queued by other instances.
+	Within an instance tasks are released by critical path rank and then by priority.
+	"""
+
+	def __init__(self, window = 0):
+		self.window = window
+
+		self._shares = {}
+
+		self._seq = 0
+
+		self._running = 0
+
+		# virtual time of the last released task
+		self._vtime = 0.0
+
+	def _share(self, instance):
+		share = self._shares.get(instance.name)
+		if share is None:
+			conf = instance.conf["wok"]
+			weight = conf.get("share.weight", 1.0, dtype=float)
+			if weight <= 0:
+				raise Exception("Invalid share weight for instance {}: {}".format(instance.name, weight))
+			max_running = conf.get("share.max_running", 0, dtype=int)
+			share = self._shares[instance.name] = _InstanceShare(instance, weight, max_running)
+		return share
+
+	def push(self, instance, tasks):
+		"Adds ready tasks of an instance"
+
+		share = self._share(instance)
+		if len(share.queue) == 0:
+			share.vtime = max(share.vtime, self._vtime)
+
+		for task in tasks:
+			heapq.heappush(share.queue, ((-task.rank, -task.priority), self._seq, task))
+			self._seq += 1
+
+	def update_ranks(self, instance):
+		"Orders again the queued tasks of an instance after the ranks of its modules changed"
+
+		share = self._shares.get(instance.name)
+		if share is None:
+			return
+
+		share.queue = [((-task.rank, -task.priority), seq, task) for key, seq, task in share.queue]
+		heapq.heapify(share.queue)
+
+	def release(self):
+		"Returns the list of tasks to submit now"
+
+		tasks = []
+		while self.window <= 0 or self._running < self.window:
+			share = None
+			for s in self._shares.itervalues():
+				if len(s.queue) > 0 and not s.capped and (share is None or s.vtime < share.vtime):
+					share = s
+
+			if share is None:
+				break
+
+			tasks += [heapq.heappop(share.queue)[2]]
+
+			self._vtime = share.vtime
+			share.vtime += 1.0 / share.weight
+			share.running += 1
+			self._running += 1
+
+		return tasks
+
+	@property
+	def num_queued(self):
+		"Number of tasks not released yet"
+
+		return sum([len(s.queue) for s in self._shares.itervalues()])
+
+	def task_done(self, task):
+		"Notifies that a released task has finished"
+
+		share = self._shares.get(task.instance.name)
+		if share is None or share.running == 0:
+			return
+
+		share.running -= 1
+		self._running -= 1
+
@@ -88,6 +88,19 @@ class SfsLogs(object):
 		cur.close()
 		conn.close()
 
+	def remove_last(self, instance_name, module_id, task_index, count):
+		"Removes the last count logs of a task"
+
+		if count <= 0 or not self.exist(instance_name, module_id, task_index):
+			return
+
+		conn = self.__open_conn(instance_name, module_id, task_index)
+		cur = conn.cursor()
+		cur.execute("DELETE FROM logs WHERE rowid IN (SELECT rowid FROM logs ORDER BY rowid DESC LIMIT ?)", (count,))
+		conn.commit()
+		cur.close()
+		conn.close()
+
 	def query(self, instance_name, module_id, task_index):
 		conn = self.__open_conn(instance_name, module_id, task_index)
 		cur = conn.cursor()
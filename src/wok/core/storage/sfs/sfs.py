@@ -25,6 +25,7 @@ import json
 
 from wok.element import DataElement, DataFactory, DataElementJsonEncoder
 from wok.core.storage import Storage, StorageContext
+from wok.core.metrics import get_metrics, timed
 
 from wok.core.storage.sfs.logs import SfsLogs
 
@@ -53,6 +54,9 @@ _LOG_LEVEL_NAME = {
 	4 : "error"
 }
 
+_SAVE_TASK_CONFIG_TIME = get_metrics().timer("wok_storage_save_task_config_seconds",
+													"Time spent writing task configuration files")
+
 class SfsStorage(Storage):
 	"""
 	Implements Storage interface for a Shared File System (i.e. NFS).
@@ -128,6 +132,7 @@ class SfsStorage(Storage):
 
 	# Tasks ====================================================================
 
+	@timed(_SAVE_TASK_CONFIG_TIME)
 	def save_task_config(self, task):
 		"Save a task configuration"
 
@@ -30,6 +30,7 @@ from wok.server.views.home import home
 from wok.server.views.workflows import workflows
 from wok.server.views.monitoring import monitoring
 from wok.server.views.monitoring_api import monitoring_api
+from wok.server.views.metrics_api import metrics_api
 from wok.server.views.files import files
 from wok.server.views.settings import settings
 
@@ -52,6 +53,7 @@ app.register_module(workflows, url_prefix="/workflows")
 
 app.register_module(monitoring, url_prefix="/monitoring")
 app.register_module(monitoring_api, url_prefix="/api/monitoring")
+app.register_module(metrics_api, url_prefix="/api/metrics")
 
 app.register_module(files, url_prefix="/files")
 
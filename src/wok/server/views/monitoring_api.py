@@ -31,9 +31,8 @@ def instance_state(name):
 	if inst is None:
 		abort(404)
 
-	e = inst.to_element()
-
-	return make_json_response(e.to_native())
+	# the snapshot is immutable and its data is already native
+	return make_json_response(inst.snapshot().data)
 
 @monitoring_api.route("/task/logs/<instance_name>/<module_id>/<task_index>")
 def task_logs(instance_name, module_id, task_index):
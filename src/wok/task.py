@@ -104,6 +104,9 @@ class Task(object):
 		module_path = cmd_conf["module_path"]
 		task_index = cmd_conf["task_index"]
 
+		# execution attempt when the job manager runs several copies of the task
+		attempt = cmd_conf.get("attempt")
+
 		storage_conf = cmd_conf["storage"]
 		storage = create_storage(
 								storage_conf["type"],
@@ -157,6 +160,8 @@ class Task(object):
 				self._in_ports += [port]
 
 			for port_conf in ports_conf.get("out", []):
+				if attempt is not None:
+					port_conf["attempt"] = int(attempt)
 				port = create_port(PORT_MODE_OUT, port_conf, storage)
 				self._port_map[port.name] = port
 				self._out_ports += [port]